@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pysam
+
+## Generator of synthetic, coordinate sorted single-cell BAM files for the benchmarks
+
+
+def randomSequences(rng, n, length):
+    r"""Returns n random DNA sequences of the given length"""
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)[rng.integers(0, 4, size=(n, length))]
+    return [x.tobytes().decode("ascii") for x in bases]
+
+
+def writeSyntheticBAM(
+    outPrefix,
+    nCells=100,
+    readsPerCell=1000,
+    paired=True,
+    duplicateRate=0.1,
+    umiLength=8,
+    cellTag="BC",
+    groupTag=None,
+    sampleName="sample1",
+    nChroms=2,
+    chromLength=10000000,
+    readLength=75,
+    fragmentLength=200,
+    peakFraction=0.5,
+    nPeaks=1000,
+    peakWidth=500,
+    seed=0,
+):
+    r"""
+    Writes a synthetic, indexed single-cell BAM file, along with the list of barcodes
+    and a group (cluster) file in the format expected by --groupInfo.
+
+    The fragments of each cell are placed either uniformly along the genome, or (for
+    ``peakFraction`` of them) in peaks shared by all cells, so that the cells have an
+    enrichment of signal. A fraction ``duplicateRate`` of the fragments are PCR duplicates
+    of another fragment of the same cell (same position, strand and UMI).
+
+    Parameters
+    ----------
+    outPrefix : str
+        The files <outPrefix>.bam (and .bai), <outPrefix>.barcodes.txt and <outPrefix>.groups.tsv are written.
+    nCells : int
+        Number of cells (barcodes).
+    readsPerCell : int
+        Number of fragments per cell (each fragment gives two reads if ``paired``).
+    paired : bool
+        Write paired-end reads.
+    duplicateRate : float
+        Fraction of duplicate fragments.
+    umiLength : int
+        Length of the UMIs (in the RX tag), 0 to skip the UMIs.
+    cellTag : str
+        The tag of the cell barcodes.
+    groupTag : str
+        If given, each read gets this tag with ``sampleName`` as value (e.g. SM).
+    sampleName : str
+        The sample name (in groupTag and in the group file).
+    nChroms, chromLength : int
+        Number and length of the chromosomes (chr1, chr2, ...).
+    readLength, fragmentLength : int
+        Read length and mean fragment length.
+    peakFraction : float
+        Fraction of the fragments in peaks.
+    nPeaks, peakWidth : int
+        Number and width of the peaks.
+    seed : int
+        Seed of the random number generator.
+
+    Returns
+    -------
+    dict
+        The file names, with keys bam, barcodes and groups.
+
+    Examples
+    --------
+
+    >>> import tempfile
+    >>> files = writeSyntheticBAM(tempfile.mkdtemp() + "/test", nCells=5, readsPerCell=20, nChroms=1, chromLength=100000)
+    >>> sum(1 for read in pysam.AlignmentFile(files["bam"]))
+    200
+    """
+    rng = np.random.default_rng(seed)
+    nFragments = nCells * readsPerCell
+
+    # unique barcodes
+    barcodes = []
+    seen = set()
+    while len(barcodes) < nCells:
+        for bc in randomSequences(rng, nCells, 12):
+            if bc not in seen and len(barcodes) < nCells:
+                seen.add(bc)
+                barcodes.append(bc)
+
+    ## fragments: cell, chromosome, start, length, strand and UMI
+    cell = np.repeat(np.arange(nCells), readsPerCell)
+    chrom = rng.integers(0, nChroms, size=nFragments)
+    fragLen = np.clip(rng.normal(fragmentLength, fragmentLength / 4, size=nFragments), readLength, None).astype(int)
+    start = rng.integers(0, chromLength - fragLen)
+    inPeak = rng.random(nFragments) < peakFraction
+    peakChrom = rng.integers(0, nChroms, size=nPeaks)
+    peakStart = rng.integers(0, chromLength - peakWidth - 2 * fragmentLength, size=nPeaks)
+    peak = rng.integers(0, nPeaks, size=inPeak.sum())
+    chrom[inPeak] = peakChrom[peak]
+    start[inPeak] = peakStart[peak] + rng.integers(0, peakWidth, size=len(peak))
+    isReverse = rng.random(nFragments) < 0.5
+    umi = np.array(randomSequences(rng, nFragments, umiLength) if umiLength else [""] * nFragments, dtype=object)
+
+    # duplicates copy an earlier fragment of the same cell
+    isDup = rng.random(nFragments) < duplicateRate
+    isDup[np.arange(nFragments) % readsPerCell == 0] = False
+    dups = np.where(isDup)[0]
+    orig = dups - 1 - (rng.random(len(dups)) * (dups % readsPerCell)).astype(int)
+    for arr in [chrom, fragLen, start, isReverse, umi]:
+        arr[dups] = arr[orig]
+
+    ## reads, sorted by position
+    if paired:
+        # mate 1 is on the strand of the fragment, mate 2 on the other one
+        readFrag = np.repeat(np.arange(nFragments), 2)
+        isRead1 = np.tile([True, False], nFragments)
+        readReverse = isReverse[readFrag] != ~isRead1
+        mateStart = start[readFrag] + fragLen[readFrag] - readLength
+        readStart = np.where(readReverse, mateStart, start[readFrag])
+        otherStart = np.where(readReverse, start[readFrag], mateStart)
+    else:
+        readFrag = np.arange(nFragments)
+        readReverse = isReverse
+        readStart = np.where(isReverse, start + fragLen - readLength, start)
+    order = np.lexsort((readStart, chrom[readFrag]))
+    sequences = randomSequences(rng, len(readFrag), readLength)
+    qualities = pysam.qualitystring_to_array("I" * readLength)
+
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": "chr{}".format(i + 1), "LN": chromLength} for i in range(nChroms)],
+    }
+    bamFile = outPrefix + ".bam"
+    with pysam.AlignmentFile(bamFile, "wb", header=header) as bam:
+        for i in order:
+            frag = readFrag[i]
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = "frag{}".format(frag)
+            read.query_sequence = sequences[i]
+            read.query_qualities = qualities
+            read.reference_id = int(chrom[frag])
+            read.reference_start = int(readStart[i])
+            read.mapping_quality = 60
+            read.cigar = [(0, readLength)]
+            read.is_reverse = bool(readReverse[i])
+            if paired:
+                read.is_paired = True
+                read.is_proper_pair = True
+                read.is_read1 = bool(isRead1[i])
+                read.is_read2 = not isRead1[i]
+                read.mate_is_reverse = not readReverse[i]
+                read.next_reference_id = int(chrom[frag])
+                read.next_reference_start = int(otherStart[i])
+                read.template_length = int(fragLen[frag]) * (-1 if readReverse[i] else 1)
+            tags = [(cellTag, barcodes[cell[frag]])]
+            if umiLength:
+                tags.append(("RX", umi[frag]))
+            if groupTag:
+                tags.append((groupTag, sampleName))
+            read.set_tags(tags)
+            bam.write(read)
+    pysam.index(bamFile)
+
+    barcodesFile = outPrefix + ".barcodes.txt"
+    with open(barcodesFile, "w") as f:
+        f.write("\n".join(barcodes) + "\n")
+
+    # two groups of cells, in the format of --groupInfo (sample, barcode, group)
+    groupsFile = outPrefix + ".groups.tsv"
+    with open(groupsFile, "w") as f:
+        f.write("sample\tbarcode\tgroup\n")
+        for i, bc in enumerate(barcodes):
+            f.write("{}\t{}\tgroup{}\n".format(sampleName, bc, i % 2))
+
+    return {"bam": bamFile, "barcodes": barcodesFile, "groups": groupsFile}
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tempfile
+
+from benchmarks.SyntheticBAM import writeSyntheticBAM
+
+## Time and memory benchmarks of the sincei tools on synthetic single-cell BAM files
+
+# command line of each tool, filled with the synthetic files ({bam}, {barcodes}, {groups}),
+# the output prefix ({out}) and the number of processors ({p})
+TOOLS = {
+    "scCountReads": "bins -b {bam} -bc {barcodes} -ct BC -o {out} -bs 10000 -p {p} --outFileFormat h5ad",
+    "scFilterStats": "-b {bam} -bc {barcodes} -ct BC -o {out}.txt -p {p}",
+    "scFragmentStore": "-b {bam} -bc {barcodes} -ct BC -o {out}.h5 -p {p}",
+    "scFilterBarcodes": "-b {bam} -w {barcodes} -ct BC -o {out}.txt -bs 100000 -p {p}",
+    "scBulkCoverage": "-b {bam} -l sample1 -i {groups} -ct BC -o {out} -of bigwig -n None -bs 100 -p {p}",
+    "scBAMops": "-b {bam} -i {groups} -ct BC --groupTag SM -o {out}.bam -p {p}",
+    "scJSD": "-b {bam} -bc {barcodes} -ct BC -o {out}.tsv -bs 10000 -n 1000 -p {p}",
+}
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="""
+        Generates a synthetic single-cell BAM file and records the run time and peak memory of
+        the sincei tools on it. The results are written as JSON, and two result files (e.g.
+        from two commits) can be compared with --compare.
+        """,
+        usage="python -m benchmarks.runBenchmarks -o results.json\n"
+        "       python -m benchmarks.runBenchmarks --compare old.json new.json",
+    )
+    parser.add_argument("--outFile", "-o", help="JSON file to write the results to.")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="Compare two result files instead of running the benchmarks.",
+    )
+    parser.add_argument(
+        "--tools",
+        nargs="+",
+        default=list(TOOLS.keys()),
+        choices=list(TOOLS.keys()),
+        help="Tools to benchmark.",
+    )
+    parser.add_argument("--workDir", help="Directory for the synthetic data and outputs (default: a temporary one).")
+    parser.add_argument("--cells", type=int, default=500, help="Number of cells.")
+    parser.add_argument("--readsPerCell", type=int, default=2000, help="Number of fragments per cell.")
+    parser.add_argument("--singleEnd", action="store_true", help="Generate single-end instead of paired-end reads.")
+    parser.add_argument("--duplicateRate", type=float, default=0.1, help="Fraction of duplicate fragments.")
+    parser.add_argument("--umiLength", type=int, default=8, help="UMI length (0 for no UMIs).")
+    parser.add_argument("--chroms", type=int, default=2, help="Number of chromosomes.")
+    parser.add_argument("--chromLength", type=int, default=10000000, help="Length of the chromosomes.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data.")
+    parser.add_argument("--numberOfProcessors", "-p", type=int, default=1, help="Processors used by the tools.")
+    parser.add_argument("--repeats", type=int, default=1, help="Number of runs of each tool (the fastest is kept).")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="With --compare, relative increase of the time or memory reported as a regression.",
+    )
+    return parser
+
+
+def gitInfo():
+    r"""Returns the current commit of the sincei repository and whether the tree has local changes"""
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo, stderr=subprocess.DEVNULL)
+        status = subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo, stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit.decode().strip(), "dirty": len(status.strip()) > 0}
+
+
+def runTool(tool, toolArgs):
+    r"""
+    Runs a sincei tool in a new process.
+
+    Returns
+    -------
+    dict
+        The wall and CPU time (s), the peak resident memory (MB) and the exit status.
+    """
+    command = [
+        sys.executable,
+        "-c",
+        "import sys; from sincei.{} import main; sys.exit(main(sys.argv[1:]))".format(tool),
+    ] + toolArgs
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # unlike getrusage, wait4 gives the resource usage of this tool run only (with its worker processes)
+    stderr = proc.stderr.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    wallTime = time.perf_counter() - start
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    result = {
+        "wallTime": round(wallTime, 3),
+        "cpuTime": round(usage.ru_utime + usage.ru_stime, 3),
+        # ru_maxrss is in kB on linux and in bytes on macOS, and is the maximum over the process and its children
+        "maxRSS": round(usage.ru_maxrss / (1024.0**2 if sys.platform == "darwin" else 1024.0), 1),
+        "returncode": proc.returncode,
+    }
+    if proc.returncode != 0:
+        result["error"] = stderr.decode(errors="replace")[-2000:]
+    return result
+
+
+def runBenchmarks(args):
+    workDir = args.workDir if args.workDir else tempfile.mkdtemp(prefix="sincei_benchmarks_")
+    os.makedirs(workDir, exist_ok=True)
+    params = {
+        "nCells": args.cells,
+        "readsPerCell": args.readsPerCell,
+        "paired": not args.singleEnd,
+        "duplicateRate": args.duplicateRate,
+        "umiLength": args.umiLength,
+        "nChroms": args.chroms,
+        "chromLength": args.chromLength,
+        "seed": args.seed,
+    }
+    sys.stderr.write("Generating the synthetic BAM file in {}\n".format(workDir))
+    start = time.perf_counter()
+    files = writeSyntheticBAM(os.path.join(workDir, "synthetic"), groupTag="SM", **params)
+    generationTime = time.perf_counter() - start
+
+    results = {}
+    for tool in args.tools:
+        toolArgs = TOOLS[tool].format(out=os.path.join(workDir, tool), p=args.numberOfProcessors, **files).split()
+        runs = []
+        for _ in range(args.repeats):
+            sys.stderr.write("Running {}\n".format(tool))
+            runs.append(runTool(tool, toolArgs))
+        best = min(runs, key=lambda x: x["wallTime"])
+        best["wallTimes"] = [x["wallTime"] for x in runs]
+        best["maxRSS"] = max(x["maxRSS"] for x in runs)
+        results[tool] = best
+        if best["returncode"] != 0:
+            sys.stderr.write("{} failed:\n{}\n".format(tool, best["error"]))
+
+    try:
+        from importlib.metadata import version
+
+        sinceiVersion = version("sincei")
+    except Exception:
+        sinceiVersion = None
+
+    return {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git": gitInfo(),
+        "sinceiVersion": sinceiVersion,
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "parameters": dict(params, numberOfProcessors=args.numberOfProcessors, repeats=args.repeats),
+        "generationTime": round(generationTime, 3),
+        "results": results,
+    }
+
+
+def compareResults(old, new, threshold=0.1):
+    r"""
+    Returns a table comparing the time and memory of the tools of two benchmark results,
+    and whether any tool got slower or bigger by more than the threshold.
+
+    >>> old = {"results": {"scJSD": {"wallTime": 10.0, "maxRSS": 100.0, "returncode": 0}}}
+    >>> new = {"results": {"scJSD": {"wallTime": 12.0, "maxRSS": 100.0, "returncode": 0}}}
+    >>> table, regression = compareResults(old, new)
+    >>> table.splitlines()[1].split()
+    ['scJSD', '10.0', '12.0', '1.2', '100.0', '100.0', '1.0', 'REGRESSION']
+    >>> regression
+    True
+    """
+    lines = ["\t".join(["tool", "oldTime", "newTime", "timeRatio", "oldRSS", "newRSS", "rssRatio"])]
+    regression = False
+    for tool in new["results"]:
+        if tool not in old["results"]:
+            continue
+        o = old["results"][tool]
+        n = new["results"][tool]
+        if o["returncode"] != 0 or n["returncode"] != 0:
+            lines.append("{}\tfailed (old: {}, new: {})".format(tool, o["returncode"], n["returncode"]))
+            regression = regression or n["returncode"] != 0
+            continue
+        timeRatio = n["wallTime"] / o["wallTime"] if o["wallTime"] > 0 else float("nan")
+        rssRatio = n["maxRSS"] / o["maxRSS"] if o["maxRSS"] > 0 else float("nan")
+        line = [tool, o["wallTime"], n["wallTime"], round(timeRatio, 2), o["maxRSS"], n["maxRSS"], round(rssRatio, 2)]
+        if timeRatio > 1 + threshold or rssRatio > 1 + threshold:
+            line.append("REGRESSION")
+            regression = True
+        lines.append("\t".join([str(x) for x in line]))
+    return "\n".join(lines), regression
+
+
+def main(args=None):
+    args = parseArguments().parse_args(args)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        table, regression = compareResults(old, new, args.threshold)
+        print(table)
+        return 1 if regression else 0
+
+    results = runBenchmarks(args)
+    out = json.dumps(results, indent=2)
+    if args.outFile:
+        with open(args.outFile, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+    return 1 if any(x["returncode"] != 0 for x in results["results"].values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import hashlib
+
+## Checkpoints of the genome chunks counted by scCountReads (see --checkpointDir and --resume)
+# The workers write the counts of each chunk to shard files in the checkpoint directory, and
+# append a line to the manifest once the shards are complete. A line has the coordinates of
+# the chunk, the hash of the parameters of the run and the shard files. A run resumed with
+# the same parameters re-uses the chunks in the manifest, and only counts the missing ones.
+
+MANIFEST = "manifest.jsonl"
+
+
+def getParamsHash(params):
+    r"""
+    Returns a hash of the parameters (a dict of JSON serializable values, others are converted
+    to strings), independent of the order of the keys.
+
+    >>> getParamsHash({"binLength": 1000, "region": None}) == getParamsHash({"region": None, "binLength": 1000})
+    True
+    >>> getParamsHash({"binLength": 1000}) == getParamsHash({"binLength": 2000})
+    False
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def getFileSignature(fileName):
+    r"""Returns the path, size and modification time of a file, to detect that it changed"""
+    if fileName is None or not os.path.exists(fileName):
+        return fileName
+    stat = os.stat(fileName)
+    return [os.path.abspath(fileName), stat.st_size, int(stat.st_mtime)]
+
+
+def getChunkFileName(checkpointDir, chrom, start, end, suffix=""):
+    r"""
+    Returns the shard file of a chunk in the checkpoint directory.
+
+    >>> getChunkFileName("ckpt", "chr1", 0, 1000, "_5000bp")
+    'ckpt/chunk_chr1_0_1000_5000bp.npz'
+    """
+    return os.path.join(checkpointDir, "chunk_{}_{}_{}{}.npz".format(chrom, start, end, suffix))
+
+
+def readManifest(checkpointDir):
+    r"""Returns the entries of the manifest (an incomplete last line, from an interrupted write, is skipped)"""
+    entries = []
+    manifest = os.path.join(checkpointDir, MANIFEST)
+    if not os.path.exists(manifest):
+        return entries
+    with open(manifest) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+
+def openCheckpoint(checkpointDir, paramsHash, resume=False):
+    r"""
+    Prepares the checkpoint directory for a run.
+
+    With ``resume``, returns a dict mapping the (chrom, start, end) of the chunks already counted
+    with the same parameters to their shard files, and only these are kept in the manifest. Chunks
+    counted with other parameters, or with missing shards, are counted again. Otherwise, the chunks
+    of a previous run are removed.
+
+    Examples
+    --------
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> openCheckpoint(d, "abc")
+    {}
+    >>> open(getChunkFileName(d, "chr1", 0, 10), "w").close()
+    >>> addChunk(d, "abc", "chr1", 0, 10, [getChunkFileName(d, "chr1", 0, 10)])
+    >>> list(openCheckpoint(d, "abc", resume=True))
+    [('chr1', 0, 10)]
+    >>> openCheckpoint(d, "other", resume=True)
+    {}
+    >>> removeCheckpoint(d)
+    >>> os.path.exists(d)
+    False
+    """
+    os.makedirs(checkpointDir, exist_ok=True)
+    if not resume:
+        removeCheckpoint(checkpointDir, removeDir=False)
+        return {}
+
+    completed = {}
+    skipped = 0
+    for entry in readManifest(checkpointDir):
+        if entry["params"] != paramsHash or not all(os.path.exists(x) for x in entry["files"]):
+            skipped += 1
+            continue
+        completed[(entry["chrom"], entry["start"], entry["end"])] = entry["files"]
+    # the manifest is re-written with the chunks kept, the others are overwritten by this run
+    with open(os.path.join(checkpointDir, MANIFEST + ".tmp"), "w") as f:
+        for (chrom, start, end), files in completed.items():
+            entry = {"chrom": chrom, "start": start, "end": end, "params": paramsHash, "files": files}
+            f.write(json.dumps(entry) + "\n")
+    os.replace(os.path.join(checkpointDir, MANIFEST + ".tmp"), os.path.join(checkpointDir, MANIFEST))
+    if skipped:
+        sys.stderr.write(
+            "{} chunks of the checkpoint were computed with other parameters (or are incomplete), "
+            "they are counted again.\n".format(skipped)
+        )
+    sys.stderr.write("Resuming from {} chunks in {}\n".format(len(completed), checkpointDir))
+    return completed
+
+
+def addChunk(checkpointDir, paramsHash, chrom, start, end, files):
+    r"""Records that the shards of a chunk are complete (called by the workers, lines are appended at once)"""
+    line = json.dumps({"chrom": chrom, "start": int(start), "end": int(end), "params": paramsHash, "files": files})
+    with open(os.path.join(checkpointDir, MANIFEST), "a") as f:
+        f.write(line + "\n")
+
+
+def removeCheckpoint(checkpointDir, removeDir=True):
+    r"""Removes the manifest and the chunk shards from the checkpoint directory (and the directory, if empty)"""
+    if not os.path.isdir(checkpointDir):
+        return
+    for fileName in os.listdir(checkpointDir):
+        if fileName == MANIFEST or (fileName.startswith("chunk_") and fileName.endswith(".npz")):
+            os.remove(os.path.join(checkpointDir, fileName))
+    if removeDir and not os.listdir(checkpointDir):
+        os.rmdir(checkpointDir)
@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import time
+import resource
+import multiprocessing
+
+## Runtime statistics of the genome chunks processed by the mapReduce workers (see --chunkReport)
+# Each worker appends one record per chunk to its own file in a report directory, the main
+# process merges them into a JSON or TSV report once all chunks are done.
+
+
+def getBytesRead():
+    r"""
+    Returns the number of bytes read so far by the current process (the compressed BAM
+    blocks, and any other files), or None if this is not available (only on linux).
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def getPeakRSS():
+    r"""Returns the peak resident memory of the current process, in MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on linux, bytes on macOS
+    return rss / (1024.0**2 if sys.platform == "darwin" else 1024.0)
+
+
+class ChunkStats(object):
+    r"""
+    Collects the runtime statistics of one genome chunk: wall time, number of reads
+    fetched, number of reads rejected by each filter, bytes read and peak memory
+    of the worker.
+
+    Examples
+    --------
+
+    >>> stats = ChunkStats("chr1", 0, 1000)
+    >>> stats.addReads(10, {"minMappingQuality": 2})
+    >>> stats.addReads(5, {"minMappingQuality": 1, "duplicate": 1})
+    >>> record = stats.finish()
+    >>> record["chrom"], record["start"], record["end"], record["readsFetched"]
+    ('chr1', 0, 1000, 15)
+    >>> record["rejected"]
+    {'minMappingQuality': 3, 'duplicate': 1}
+    """
+
+    def __init__(self, chrom, start, end):
+        self.chrom = chrom
+        self.start = int(start)
+        self.end = int(end)
+        self.readsFetched = 0
+        self.rejected = {}
+        self._startTime = time.perf_counter()
+        self._startBytes = getBytesRead()
+
+    def addReads(self, fetched, rejected=None):
+        r"""Adds the number of reads fetched, and a dict with the number of reads rejected per filter"""
+        self.readsFetched += fetched
+        if rejected:
+            for name, n in rejected.items():
+                if n:
+                    self.rejected[name] = self.rejected.get(name, 0) + n
+
+    def finish(self):
+        r"""Returns the statistics of the chunk as a dict"""
+        bytesRead = getBytesRead()
+        if bytesRead is not None and self._startBytes is not None:
+            bytesRead -= self._startBytes
+        return {
+            "chrom": self.chrom,
+            "start": self.start,
+            "end": self.end,
+            "process": multiprocessing.current_process().name,
+            "wallTime": round(time.perf_counter() - self._startTime, 6),
+            "readsFetched": self.readsFetched,
+            "rejected": self.rejected,
+            "bytesRead": bytesRead,
+            "peakRSS": round(getPeakRSS(), 1),
+        }
+
+
+def writeChunkStats(reportDir, record):
+    r"""Appends the record of a chunk to the file of the current process in reportDir"""
+    with open(os.path.join(reportDir, "chunks.{}.jsonl".format(os.getpid())), "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def readChunkStats(reportDir):
+    r"""Returns the records written to reportDir by all processes, sorted by position"""
+    records = []
+    for fileName in sorted(os.listdir(reportDir)):
+        if not fileName.endswith(".jsonl"):
+            continue
+        with open(os.path.join(reportDir, fileName)) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return sorted(records, key=lambda x: (x["chrom"], x["start"], x["end"]))
+
+
+def summarize(records):
+    r"""
+    Aggregates the records of all chunks.
+
+    >>> records = [
+    ...     {"wallTime": 1.0, "readsFetched": 10, "rejected": {"duplicate": 2}, "bytesRead": 100, "peakRSS": 50.0},
+    ...     {"wallTime": 3.0, "readsFetched": 30, "rejected": {"duplicate": 1, "blacklist": 4}, "bytesRead": None,
+    ...      "peakRSS": 70.0},
+    ... ]
+    >>> s = summarize(records)
+    >>> s["chunks"], s["wallTime"], s["maxChunkWallTime"], s["readsFetched"], s["bytesRead"], s["peakRSS"]
+    (2, 4.0, 3.0, 40, 100, 70.0)
+    >>> s["rejected"]
+    {'blacklist': 4, 'duplicate': 3}
+    """
+    rejected = {}
+    for record in records:
+        for name, n in record["rejected"].items():
+            rejected[name] = rejected.get(name, 0) + n
+    return {
+        "chunks": len(records),
+        "wallTime": round(sum(x["wallTime"] for x in records), 6),
+        "maxChunkWallTime": max([x["wallTime"] for x in records], default=0),
+        "readsFetched": sum(x["readsFetched"] for x in records),
+        "rejected": dict(sorted(rejected.items())),
+        "bytesRead": sum(x["bytesRead"] for x in records if x["bytesRead"] is not None),
+        "peakRSS": max([x["peakRSS"] for x in records], default=0),
+    }
+
+
+def writeReport(reportDir, fileName):
+    r"""
+    Writes the records of all chunks in reportDir to fileName. Files ending with .json get
+    the records and their summary (see `summarize`) as JSON, all others a tab separated
+    table with one chunk per row and one column per filter (reads rejected).
+    """
+    records = readChunkStats(reportDir)
+    if fileName.endswith(".json"):
+        with open(fileName, "w") as f:
+            json.dump({"summary": summarize(records), "chunks": records}, f, indent=1)
+            f.write("\n")
+        return
+
+    filters = sorted(set(name for x in records for name in x["rejected"]))
+    columns = ["chrom", "start", "end", "process", "wallTime", "readsFetched", "bytesRead", "peakRSS"]
+    with open(fileName, "w") as f:
+        f.write("\t".join(columns + ["rejected_" + name for name in filters]) + "\n")
+        for record in records:
+            values = [record[x] for x in columns] + [record["rejected"].get(name, 0) for name in filters]
+            f.write("\t".join(["NA" if x is None else str(x) for x in values]) + "\n")
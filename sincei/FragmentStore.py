@@ -0,0 +1,518 @@
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import h5py
+from scipy import sparse
+
+import deeptools.utilities
+from deeptools import bamHandler
+
+from sincei import MapReduce as mapReduce
+from sincei.ReadCounter import CountReadsPerBin, open_worker_resources, close_worker_resources, cast_counts
+from sincei.ReadFilter import ReadFilter
+from sincei.Regions import Regions
+from sincei.Utilities import DuplicateFilter
+from sincei.WriteCounts import writeShard
+
+## Columnar store of the filtered fragments of BAM files (see scFragmentStore)
+# The fragments are extracted once from the BAM files and written to an HDF5 file, with one
+# compressed column per attribute and chromosome, sorted by start position. A coarse index
+# gives the rows of each window of the genome, so that the fragments of a region can be
+# read without scanning the chromosome, and counted in bins of any size with numpy.
+# The reads of a proper pair are stored in one row (the fragment, with the end of the first
+# read and the start of its mate), so that the reads can be counted as from the BAM files.
+
+STORE_FORMAT = "sincei fragment store"
+# version 2 added the readEnd and mateStart columns
+STORE_VERSION = 2
+
+# columns of the store (besides the chromosome, which is the group of the columns)
+COLUMNS = {
+    "start": np.int64,
+    "end": np.int64,
+    "readEnd": np.int64,
+    "mateStart": np.int64,
+    "barcode": np.uint32,
+    "strand": np.int8,
+    "mapq": np.uint8,
+    "duplicate": np.bool_,
+}
+
+# number of rows per compressed HDF5 chunk
+CHUNK_ROWS = 65536
+
+
+def isFragmentStore(fileName):
+    r"""Returns True if fileName is a fragment store written by scFragmentStore"""
+    if not os.path.isfile(fileName) or not h5py.is_hdf5(fileName):
+        return False
+    with h5py.File(fileName, "r") as f:
+        return f.attrs.get("format") == STORE_FORMAT
+
+
+def extractFragments_wrapper(args):
+    r"""Passes the arguments to FragmentStoreWriter.get_fragments_of_region (required by multiprocessing)"""
+    return FragmentStoreWriter.get_fragments_of_region(*args)
+
+
+def countBins_wrapper(args):
+    r"""Passes the arguments to countBinsOfChunk (required by multiprocessing)"""
+    return countBinsOfChunk(*args)
+
+
+# the store opened in the current process, and the output column of its barcodes (see openWorkerStore)
+_worker_store = {}
+
+
+def openWorkerStore(fileName, columnIndex=None, nColumns=None):
+    r"""
+    Opens the store for the current process. This is used as initializer of the mapReduce worker
+    pool of countStore, so that each worker opens the store (and receives the output columns of
+    the barcodes) only once instead of once per genome chunk.
+    """
+    closeWorkerStore()
+    _worker_store["store"] = FragmentStore(fileName)
+    _worker_store["columnIndex"] = columnIndex
+    _worker_store["nColumns"] = nColumns
+
+
+def closeWorkerStore():
+    r"""Closes the store opened by openWorkerStore in the current process"""
+    if "store" in _worker_store:
+        _worker_store["store"].close()
+    _worker_store.clear()
+
+
+def countBinsOfChunk(chrom, start, end, binLength, shardDir, countDtype, countArgs):
+    r"""
+    Counts the reads of a chunk of the genome in the store opened by openWorkerStore (see
+    FragmentStore.count_bins), and writes the counts to a shard in shardDir.
+
+    Returns
+    -------
+    str
+        The shard file.
+    """
+    counts, regionList = _worker_store["store"].count_bins(
+        chrom,
+        start,
+        end,
+        binLength,
+        columnIndex=_worker_store["columnIndex"],
+        nColumns=_worker_store["nColumns"],
+        **countArgs,
+    )
+    fd, shardFile = tempfile.mkstemp(suffix=".npz", dir=shardDir)
+    os.close(fd)
+    writeShard(shardFile, cast_counts(counts, countDtype), regionList)
+    return shardFile
+
+
+def countStore(
+    fileName,
+    binLength,
+    shardDir,
+    columnIndex=None,
+    nColumns=None,
+    region=None,
+    blackListFileName=None,
+    genomeChunkSize=None,
+    numberOfProcessors=1,
+    countDtype="uint8",
+    verbose=False,
+    **countArgs,
+):
+    r"""
+    Counts the reads of a fragment store in bins of binLength, and writes the counts of each chunk
+    of the genome to a shard in shardDir. The chunks are those of CountReadsPerBin: without the
+    blacklisted regions, and restricted to the region (chrom:start:end) if given. They are counted
+    by numberOfProcessors processes. The other parameters are those of FragmentStore.count_bins.
+
+    Returns
+    -------
+    list
+        The shard files, in the order of the chunks.
+    """
+    with FragmentStore(fileName) as store:
+        chromSizes = store.chromSizes
+    # chunks start at a bin
+    chunkLength = max((genomeChunkSize or 10000000) // binLength, 1) * binLength
+    if region:
+        # as in CountReadsPerBin.run, the region starts at a bin
+        region += ":{}".format(binLength)
+
+    try:
+        shardFiles = mapReduce.mapReduce(
+            [binLength, shardDir, countDtype, countArgs],
+            countBins_wrapper,
+            chromSizes,
+            genomeChunkLength=chunkLength,
+            region=region,
+            blackListFileName=blackListFileName,
+            numberOfProcessors=numberOfProcessors,
+            verbose=verbose,
+            initializer=openWorkerStore,
+            initargs=(fileName, columnIndex, nColumns),
+        )
+    finally:
+        # the store is opened in the current process if no worker pool was used
+        closeWorkerStore()
+    return shardFiles
+
+
+class FragmentStoreWriter(CountReadsPerBin):
+    r"""
+    Extracts the fragments of BAM files that pass the read filters, and writes them to a
+    fragment store.
+
+    One fragment is stored per proper pair (from the left-most mate, spanning both mates),
+    and per read otherwise (spanning the aligned part of the read). Each fragment has the
+    columns start, end, readEnd (the end of the left-most mate, or end for single reads),
+    mateStart (the start of the other mate, -1 for single reads), barcode (the column of the
+    barcode in ``labels``), strand (1 or -1, the strand of the read the fragment was taken
+    from), mapq and duplicate. The read filters, mapq and duplicates are those of the
+    left-most mate. Duplicates are detected with ``duplicateFilter`` (if given, otherwise
+    the duplicate flag of the BAM file is used), they are flagged but not removed, so that
+    they can be kept or removed when counting.
+
+    The parameters are those of sincei.ReadCounter.CountReadsPerBin. Reads are not extended
+    and ``maxPairedFragmentLength`` is the longest fragment of a proper pair (longer ones are
+    stored as two reads).
+
+    Examples
+    --------
+
+    >>> import tempfile
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/tests/_data/"
+    >>> bamFiles = [root + "SL2-1.bam"]
+    >>> barcodes = [x.strip() for x in open(root + "test_barcodes.txt")]
+    >>> fileName = tempfile.mkdtemp() + "/fragments.h5"
+    >>> w = FragmentStoreWriter(bamFiles, barcodes=barcodes, cellTag="BC", groupLabels=barcodes,
+    ...                         region="chr1:23365000:23385000")
+    >>> w.run(fileName)
+    >>> with FragmentStore(fileName) as store:
+    ...     store.fetch("chr1", 23380000, 23385000)["start"]
+    array([23380330, 23380363, 23380506, 23380506, 23383524, 23383524])
+    """
+
+    def __init__(self, bamFilesList, maxPairedFragmentLength=1000, indexWindow=10000, **kwargs):
+        kwargs.setdefault("binLength", 1)
+        kwargs.setdefault("stepSize", 1)
+        super(FragmentStoreWriter, self).__init__(bamFilesList, **kwargs)
+        self.maxPairedFragmentLength = maxPairedFragmentLength
+        self.indexWindow = indexWindow
+        self.tmpDir = None
+
+    def get_fragments_of_region(self, chrom, start, end):
+        r"""
+        Returns the fragments starting in [start, end) as a dict of column arrays, sorted
+        by start, end and barcode. If ``tmpDir`` is set, the columns are written to a
+        .npz file there instead, and (chrom, file name) is returned.
+        """
+        resources = self.get_worker_resources()
+        barcodeIndex = self.barcodeIndex
+        useGroups = self.groupTag and self.groupLabels
+        readFilter = ReadFilter(
+            minMappingQuality=self.minMappingQuality,
+            samFlagInclude=self.samFlag_include,
+            samFlagExclude=self.samFlag_exclude,
+            minFragmentLength=self.minFragmentLength,
+            maxFragmentLength=self.maxFragmentLength,
+            blackList=resources["blackList"],
+            minAlignedFraction=self.minAlignedFraction,
+            GCcontentFilter=self.GCcontentFilter,
+            motifFilter=self.motifFilter,
+            twoBitGenome=resources["twoBitGenome"] if self.motifFilter else None,
+        )
+        dupFilter = DuplicateFilter(self.duplicateFilter, mode="last") if self.duplicateFilter else None
+
+        columns = dict((name, []) for name in COLUMNS)
+        for i, bamHandle in enumerate(resources["bamHandles"]):
+            if chrom not in bamHandle.references:
+                continue
+            # barcodes of the following BAM files are in the next columns
+            colOffset = i * len(barcodeIndex)
+            readFilter.prefetch(chrom, start, end)
+            if dupFilter is not None:
+                dupFilter.reset()
+            for read in bamHandle.fetch(chrom, start, end):
+                # reads starting before the chunk are stored with the previous one
+                if read.reference_start < start:
+                    continue
+                isPair = self.is_proper_pair(read, self.maxPairedFragmentLength)
+                if isPair and read.is_reverse:
+                    # stored with the left-most mate
+                    continue
+                try:
+                    bc = read.get_tag(self.cellTag)
+                    if useGroups:
+                        col = barcodeIndex.get((read.get_tag(self.groupTag), bc))
+                    else:
+                        col = barcodeIndex.get(bc)
+                except KeyError:
+                    continue
+                if col is None or readFilter.check(read, chrom) is not None:
+                    continue
+
+                columns["start"].append(read.reference_start)
+                columns["end"].append(
+                    read.reference_start + abs(read.template_length) if isPair else read.reference_end
+                )
+                columns["readEnd"].append(read.reference_end)
+                columns["mateStart"].append(read.next_reference_start if isPair else -1)
+                columns["barcode"].append(col + colOffset)
+                columns["strand"].append(-1 if read.is_reverse else 1)
+                columns["mapq"].append(read.mapping_quality)
+                columns["duplicate"].append(
+                    dupFilter.isDuplicate(read, col) if dupFilter is not None else read.is_duplicate
+                )
+
+        columns = dict((name, np.asarray(x, dtype=COLUMNS[name])) for name, x in columns.items())
+        # the fragments of the BAM files are merged
+        order = np.lexsort((columns["barcode"], columns["end"], columns["start"]))
+        columns = dict((name, x[order]) for name, x in columns.items())
+
+        if self.tmpDir is None:
+            return columns
+        if len(order) == 0:
+            return chrom, None
+        _file = tempfile.NamedTemporaryFile(dir=self.tmpDir, suffix=".npz", delete=False)
+        _file.close()
+        np.savez(_file.name, **columns)
+        return chrom, _file.name
+
+    def run(self, fileName, allArgs=None):
+        r"""Extracts the fragments of all chunks of the genome (or ``region``) and writes them to fileName"""
+        bamFilesHandles = [bamHandler.openBam(x) for x in self.bamFilesList]
+        chromSizes, _ = deeptools.utilities.getCommonChrNames(bamFilesHandles, verbose=self.verbose)
+        if len(self.chrsToSkip):
+            chromSizes = [x for x in chromSizes if x[0] not in self.chrsToSkip]
+        chunkSize = self.genomeChunkSize
+        if chunkSize is None:
+            genomeSize = sum(x[1] for x in chromSizes)
+            chunkSize = self.get_chunk_length(bamFilesHandles, genomeSize, chromSizes, [x[1] for x in chromSizes])
+        [x.close() for x in bamFilesHandles]
+
+        self.tmpDir = tempfile.mkdtemp(prefix="scFragmentStore_")
+        self.share_lookup_tables()
+        try:
+            res = mapReduce.mapReduce(
+                [],
+                extractFragments_wrapper,
+                chromSizes,
+                self_=self,
+                genomeChunkLength=chunkSize,
+                blackListFileName=self.blackListFileName,
+                region=self.region,
+                numberOfProcessors=self.numberOfProcessors,
+                verbose=self.verbose,
+                initializer=open_worker_resources,
+                initargs=self.get_worker_resources_args(),
+                bamFiles=self.bamFilesList,
+            )
+            close_worker_resources()
+            self.write_store(fileName, chromSizes, res)
+        finally:
+            self.remove_lookup_tables()
+            shutil.rmtree(self.tmpDir, ignore_errors=True)
+            self.tmpDir = None
+
+    def write_store(self, fileName, chromSizes, chunkFiles):
+        r"""Writes the fragments of the chunks (a list of (chrom, .npz file), in genome order) to the store"""
+        nColumns = len(self.barcodeIndex) * len(self.bamFilesList)
+        if self.groupLabels and len(self.groupLabels) == nColumns:
+            labels = list(self.groupLabels)
+        else:
+            labels = [str(x) for x in range(nColumns)]
+
+        with h5py.File(fileName, "w") as f:
+            f.attrs["format"] = STORE_FORMAT
+            f.attrs["version"] = STORE_VERSION
+            f.attrs["indexWindow"] = self.indexWindow
+            f.attrs["duplicateFilter"] = self.duplicateFilter if self.duplicateFilter else "BAM flag"
+            f.create_dataset("labels", data=labels, dtype=h5py.string_dtype())
+            f.create_dataset("chromNames", data=[x[0] for x in chromSizes], dtype=h5py.string_dtype())
+            f.create_dataset("chromLengths", data=[x[1] for x in chromSizes], dtype=np.int64)
+
+            for chrom, size in chromSizes:
+                group = f.create_group("fragments/{}".format(chrom))
+                for name, dtype in COLUMNS.items():
+                    group.create_dataset(
+                        name,
+                        shape=(0,),
+                        maxshape=(None,),
+                        dtype=dtype,
+                        chunks=(CHUNK_ROWS,),
+                        compression="gzip",
+                        shuffle=True,
+                    )
+                # number of fragments starting in each window of the index
+                windowCounts = np.zeros(int(np.ceil(size / float(self.indexWindow))) + 1, dtype=np.int64)
+                maxLength = 0
+                for _chrom, chunkFile in chunkFiles:
+                    if _chrom != chrom or chunkFile is None:
+                        continue
+                    with np.load(chunkFile) as chunk:
+                        n = len(chunk["start"])
+                        for name in COLUMNS:
+                            dataset = group[name]
+                            dataset.resize((dataset.shape[0] + n,))
+                            dataset[-n:] = chunk[name]
+                        windowCounts += np.bincount(chunk["start"] // self.indexWindow, minlength=len(windowCounts))
+                        maxLength = max(maxLength, int((chunk["end"] - chunk["start"]).max()))
+                    os.remove(chunkFile)
+                # rows of the fragments starting before each window
+                group.create_dataset("index", data=np.concatenate([[0], np.cumsum(windowCounts)[:-1]]))
+                group.attrs["maxLength"] = maxLength
+                if self.verbose:
+                    sys.stderr.write("{}: {} fragments\n".format(chrom, group["start"].shape[0]))
+
+
+class FragmentStore(object):
+    r"""
+    Reads a fragment store written by FragmentStoreWriter (scFragmentStore).
+
+    Parameters
+    ----------
+    fileName : str
+        The store (.h5).
+
+    Attributes
+    ----------
+    labels : list
+        The labels (sample::barcode) of the barcode ids of the fragments.
+    chromSizes : list
+        List of (chromosome, length) tuples.
+    duplicateFilter : str
+        The duplicate filter the duplicates were detected with ("BAM flag" for the duplicates
+        marked in the BAM files).
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._h5 = h5py.File(fileName, "r")
+        if self._h5.attrs.get("format") != STORE_FORMAT:
+            self._h5.close()
+            raise ValueError("{} is not a fragment store written by scFragmentStore".format(fileName))
+        if self._h5.attrs.get("version") != STORE_VERSION:
+            self._h5.close()
+            raise ValueError(
+                "{} was written by another version of scFragmentStore, please write it again".format(fileName)
+            )
+        self.labels = list(self._h5["labels"].asstr()[:])
+        self.chromSizes = list(zip(self._h5["chromNames"].asstr()[:], [int(x) for x in self._h5["chromLengths"][:]]))
+        self.indexWindow = int(self._h5.attrs["indexWindow"])
+        self.duplicateFilter = self._h5.attrs["duplicateFilter"]
+
+    def close(self):
+        self._h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def fetch(self, chrom, start=0, end=None, columns=None):
+        r"""
+        Returns the fragments overlapping [start, end) of chrom as a dict of column arrays
+        (all columns by default), sorted by start position. Only the rows of the windows of
+        the index that can contain such fragments are read.
+        """
+        if columns is None:
+            columns = list(COLUMNS)
+        if "fragments/{}".format(chrom) not in self._h5:
+            return dict((name, np.zeros(0, dtype=COLUMNS[name])) for name in columns)
+        group = self._h5["fragments/{}".format(chrom)]
+        index = group["index"][:]
+        if end is None:
+            end = dict(self.chromSizes)[chrom]
+        firstWindow = max(0, start - int(group.attrs["maxLength"])) // self.indexWindow
+        lastWindow = int(np.ceil(end / float(self.indexWindow)))
+        first = index[min(firstWindow, len(index) - 1)]
+        last = index[lastWindow] if lastWindow < len(index) else group["start"].shape[0]
+
+        starts = group["start"][first:last]
+        ends = group["end"][first:last]
+        keep = (starts < end) & (ends > start)
+        fragments = {"start": starts[keep], "end": ends[keep]}
+        for name in columns:
+            if name not in fragments:
+                fragments[name] = group[name][first:last][keep]
+        return dict((name, fragments[name]) for name in columns)
+
+    def count_bins(
+        self,
+        chrom,
+        start,
+        end,
+        binLength,
+        columnIndex=None,
+        nColumns=None,
+        minMappingQuality=None,
+        removeDuplicates=False,
+    ):
+        r"""
+        Counts the reads overlapping each bin of size binLength between start and end (the
+        last bin can be shorter), as CountReadsPerBin counts the reads of the BAM files (without
+        extension): each read is counted once in every bin it overlaps, so that the mates of a
+        proper pair are both counted, once each, in a bin they both overlap. Split reads are
+        counted as if they were not split.
+
+        Parameters
+        ----------
+        columnIndex : numpy array
+            The output column of each barcode id of the store (-1 to skip the barcode). By
+            default, the columns are the barcode ids.
+        nColumns : int
+            The number of output columns (by default, the number of labels).
+        minMappingQuality : int
+            Skip the fragments with a lower mapping quality (both reads of a proper pair are
+            skipped if the left-most mate has a lower mapping quality).
+        removeDuplicates : bool
+            Skip the fragments flagged as duplicate.
+
+        Returns
+        -------
+        tuple
+            The counts as CSR matrix (rows = bins, cols = barcodes) and the bins (sincei.Regions).
+        """
+        if nColumns is None:
+            nColumns = len(self.labels) if columnIndex is None else int(columnIndex.max()) + 1
+        fragments = self.fetch(
+            chrom, start, end, columns=["start", "end", "readEnd", "mateStart", "barcode", "mapq", "duplicate"]
+        )
+        keep = np.ones(len(fragments["start"]), dtype=bool)
+        if minMappingQuality:
+            keep &= fragments["mapq"] >= minMappingQuality
+        if removeDuplicates:
+            keep &= ~fragments["duplicate"]
+        cols = fragments["barcode"].astype(np.int64)
+        if columnIndex is not None:
+            cols = columnIndex[cols]
+            keep &= cols >= 0
+
+        # the reads: the first read of each fragment, and the mate of the proper pairs
+        isPair = keep & (fragments["mateStart"] >= 0)
+        readStarts = np.concatenate([fragments["start"][keep], fragments["mateStart"][isPair]])
+        readEnds = np.concatenate([fragments["readEnd"][keep], fragments["end"][isPair]])
+        readCols = np.concatenate([cols[keep], cols[isPair]])
+        inChunk = (readEnds > start) & (readStarts < end) & (readEnds > readStarts)
+        readStarts, readEnds, readCols = readStarts[inChunk], readEnds[inChunk], readCols[inChunk]
+
+        nBins = int(np.ceil((end - start) / float(binLength)))
+        firstBin = np.maximum(readStarts - start, 0) // binLength
+        lastBin = np.minimum((readEnds - 1 - start) // binLength, nBins - 1)
+        # one entry per (read, overlapped bin)
+        nBinsPerRead = lastBin - firstBin + 1
+        rows = np.repeat(firstBin, nBinsPerRead) + (
+            np.arange(nBinsPerRead.sum()) - np.repeat(np.cumsum(nBinsPerRead) - nBinsPerRead, nBinsPerRead)
+        )
+        counts = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.uint32), (rows, np.repeat(readCols, nBinsPerRead))),
+            shape=(nBins, nColumns),
+        )
+        counts.sum_duplicates()
+        return counts, Regions.from_tiles(chrom, start, end, binLength)
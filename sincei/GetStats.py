@@ -3,7 +3,6 @@ import os
 
 from deeptools import parserCommon, bamHandler, utilities
 from deeptools.mapReduce import mapReduce
-from deeptoolsintervals import GTF
 
 import numpy as np
 import py2bit
@@ -12,6 +11,7 @@ import pandas as pd
 ## own functions
 scriptdir = os.path.join(os.path.abspath(os.pardir), "sincei")
 from sincei.Utilities import *
+from sincei.ReadFilter import ReadFilter
 
 
 def getStats_worker(arglist):
@@ -53,44 +53,37 @@ def getStats_worker(arglist):
     ## open genome if needed
     if args.genome2bit:
         twoBitGenome = py2bit.open(args.genome2bit, True)
-    ## open blacklist file
+    ## blacklist (parsed once per process)
     blackList = None
     if args.blackListFileName is not None:
-        blackList = GTF(args.blackListFileName)
+        blackList = getBlacklistIndex(args.blackListFileName)
 
     o = []
     for fname in args.bamfiles:
         fh = bamHandler.openBam(fname)
         chromUse = utilities.mungeChromosome(chrom, fh.references)
-        prev_pos = set()
-        lpos = None
+        readFilter = ReadFilter(
+            minMappingQuality=args.minMappingQuality,
+            blackList=blackList,
+            minAlignedFraction=args.minAlignedFraction,
+            motifFilter=args.motifFilter,
+            twoBitGenome=twoBitGenome if args.genome2bit else None,
+        )
+        # duplicates are reported, not filtered
+        dupFilter = DuplicateFilter(args.duplicateFilter)
         ## initiate a dict with all values to keep per read
         info_list = []  # dict.fromkeys(['barcode', 'position', 'duplicate', 'GCcontent', 'strand'])
+        sequences = []
 
+        readFilter.prefetch(chrom, start, end)
         for read in fh.fetch(chromUse, start, end):
             ## general filtering
             if read.pos < start:
                 # ensure that we never double count (in case distanceBetweenBins == 0)
                 continue
-            if read.flag & 4:
-                # Ignore unmapped reads, they were counted already
+            # unmapped reads, MAPQ, aligned fraction, blacklist and motifs
+            if readFilter.check(read, chrom) is not None:
                 continue
-            if args.minMappingQuality and read.mapq < args.minMappingQuality:
-                continue
-            if args.minAlignedFraction:
-                if not checkAlignedFraction(read, args.minAlignedFraction):
-                    continue
-            if blackList and blackList.findOverlaps(
-                chrom,
-                read.reference_start,
-                read.reference_start + read.infer_query_length(always=False) - 1,
-            ):
-                continue
-            if args.motifFilter:
-                test = [checkMotifs(read, chrom, twoBitGenome, m[0], m[1]) for m in args.motifFilter]
-                # if none given motif found, return true
-                if not any(test):
-                    continue
 
             # now collect info
             info = [None for n in range(0, 8)]
@@ -110,31 +103,29 @@ def getStats_worker(arglist):
             info[2] = read.reference_start
 
             ## Duplicates
-            tup = getDupFilterTuple(read, bc, args.duplicateFilter)
-            if lpos is not None and lpos == read.reference_start and tup in prev_pos:
+            lpos = dupFilter.lastPosition
+            if dupFilter.isDuplicate(read, bc):
                 info[3] = True  # read is duplicate
                 info[4] = 0
             else:
                 info[3] = False
             if lpos != read.reference_start:
-                prev_pos.clear()
                 ## add distance to last read
                 if lpos is None:
                     info[4] = 0
                 else:
                     info[4] = abs(float(lpos - read.reference_start))
-                ## also add the distance of this read to previous pos
-
-            lpos = read.reference_start
-            prev_pos.add(tup)
 
-            info[5] = checkGCcontent(read, args.GCcontentFilter[0], args.GCcontentFilter[1], returnGC=True)
+            # GC content (info[5]) is computed for all reads at once below
+            sequences.append(read.query_sequence)
             # filterRNAstrand
             info[6] = read.is_reverse
             if args.getReadID:
                 info[7] = read.query_name
             info_list.append(info)
         fh.close()
+        for info, gc in zip(info_list, getGCcontent(sequences)):
+            info[5] = gc
 
         # out is an array with row = len(barcode) [384], column = len(stats) [11]
         o.append(info_list)
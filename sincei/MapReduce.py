@@ -0,0 +1,386 @@
+import os
+import struct
+import multiprocessing
+import random
+import numpy as np
+import pysam
+from deeptoolsintervals import GTF
+
+# deepTools functions re-used to define the chunks
+from deeptools.mapReduce import getUserRegion, blSubtract
+
+debug = 0
+
+# size of the windows of the linear index of .bai files
+BAI_WINDOW = 16384
+# approximate compression ratio of BAM files, for the size of the last block of a chromosome
+BGZF_RATIO = 3.0
+
+
+def readIndexDensity(bamFile):
+    r"""
+    Reads the linear index of the .bai index of a BAM file, and returns the amount of data
+    (approximately, in compressed bytes) of the reads starting in each 16 kb window.
+
+    Returns
+    -------
+    dict
+        chromosome name: numpy array with one value per window. Empty if the file has no .bai
+        index (e.g. a .csi index or a bigWig file).
+
+    >>> import os
+    >>> bam = os.path.join(os.path.dirname(__file__), "tests", "_data", "SL2-1.bam")
+    >>> density = readIndexDensity(bam)
+    >>> window = 23370000 // BAI_WINDOW
+    >>> bool(density["chr1"][window] > 0), bool(density["chr1"][:window - 10].sum() > 0)
+    (True, False)
+    """
+    indexFile = bamFile + ".bai"
+    if not os.path.exists(indexFile):
+        indexFile = os.path.splitext(bamFile)[0] + ".bai"
+    try:
+        with open(indexFile, "rb") as f:
+            data = f.read()
+        with pysam.AlignmentFile(bamFile) as bam:
+            references = bam.references
+    except (OSError, ValueError):
+        return {}
+    if data[:4] != b"BAI\x01":
+        return {}
+
+    def toBytes(voffsets):
+        # compressed offset of the block, plus the offset within the block scaled to the compressed
+        # size of the block (the distance to the next block in the index)
+        blocks = voffsets >> 16
+        within = voffsets & 0xFFFF
+        starts = np.unique(blocks)
+        nextBlock = np.append(starts, starts[-1] + 65536 / BGZF_RATIO)[np.searchsorted(starts, blocks, "right")]
+        return blocks + within * (nextBlock - blocks) / 65536.0
+
+    density = {}
+    (nRef,) = struct.unpack_from("<i", data, 4)
+    pos = 8
+    for ref in range(nRef):
+        (nBin,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+        refEnd = 0
+        for _ in range(nBin):
+            binId, nChunk = struct.unpack_from("<Ii", data, pos)
+            pos += 8
+            if binId != 37450 and nChunk > 0:
+                # the end of the data of the chromosome
+                chunks = np.frombuffer(data, dtype="<u8", count=2 * nChunk, offset=pos)
+                refEnd = max(refEnd, int(chunks[1::2].max()))
+            pos += 16 * nChunk
+        (nIntv,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+        ioffsets = np.frombuffer(data, dtype="<u8", count=nIntv, offset=pos).astype(np.int64)
+        pos += 8 * nIntv
+        if nIntv == 0 or ref >= len(references):
+            continue
+        # windows without reads have the offset of the next read (or 0 at the start)
+        offsets = np.maximum.accumulate(np.append(ioffsets, refEnd))
+        density[references[ref]] = np.diff(toBytes(offsets))
+    return density
+
+
+def getIndexDensity(bamFiles):
+    r"""
+    Returns the sum of the density (see readIndexDensity) of the BAM files per chromosome,
+    or None if none of the files has a .bai index.
+    """
+    density = {}
+    for bamFile in bamFiles:
+        for chrom, values in readIndexDensity(bamFile).items():
+            if chrom in density:
+                n = max(len(density[chrom]), len(values))
+                density[chrom] = np.pad(density[chrom], (0, n - len(density[chrom]))) + np.pad(
+                    values, (0, n - len(values))
+                )
+            else:
+                density[chrom] = values
+    return density if density else None
+
+
+def getChunkWork(density, start, end):
+    r"""
+    Returns the amount of data of the reads in [start, end), with the windows at the ends
+    counted in proportion of their overlap.
+
+    >>> getChunkWork(np.array([10.0, 20.0, 30.0]), 0, 3 * BAI_WINDOW)
+    60.0
+    >>> getChunkWork(np.array([10.0, 20.0, 30.0]), BAI_WINDOW // 2, BAI_WINDOW + BAI_WINDOW // 4)
+    10.0
+    """
+    if density is None or len(density) == 0:
+        return 0.0
+    cumulative = np.concatenate([[0.0], np.cumsum(density)])
+    positions = np.arange(len(cumulative)) * BAI_WINDOW
+    work = np.interp([start, end], positions, cumulative)
+    return float(work[1] - work[0])
+
+
+def splitChunk(density, start, end, maxWork, alignment=1):
+    r"""
+    Splits [start, end) into pieces with about equal amounts of data, none larger than
+    maxWork (when possible). The cut points are multiples of `alignment` from start.
+
+    Returns
+    -------
+    list
+        the [start, end] pieces.
+
+    >>> density = np.array([1.0, 1.0, 10.0, 10.0])
+    >>> splitChunk(density, 0, 4 * BAI_WINDOW, 100)
+    [[0, 65536]]
+    >>> splitChunk(density, 0, 4 * BAI_WINDOW, 8, alignment=1000)
+    [[0, 42000], [42000, 54000], [54000, 65536]]
+    """
+    work = getChunkWork(density, start, end)
+    nPieces = int(np.ceil(work / maxWork)) if maxWork > 0 else 1
+    if nPieces <= 1:
+        return [[start, end]]
+    cumulative = np.concatenate([[0.0], np.cumsum(density)])
+    positions = np.arange(len(cumulative)) * BAI_WINDOW
+    offset = np.interp(start, positions, cumulative)
+    # positions at which the cumulative work reaches 1/n, 2/n, ... of the chunk
+    cuts = np.interp(offset + work * np.arange(1, nPieces) / nPieces, cumulative, positions)
+    cuts = start + np.round((cuts - start) / alignment).astype(np.int64) * alignment
+    cuts = [int(x) for x in np.unique(cuts) if start < x < end]
+    bounds = [start] + cuts + [end]
+    return [[a, b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def _runTask(args):
+    r"""Calls func on a task and returns its index with the result (for imap_unordered)"""
+    i, func, task = args
+    return i, func(task)
+
+
+def mapReduce(
+    staticArgs,
+    func,
+    chromSize,
+    genomeChunkLength=None,
+    region=None,
+    bedFile=None,
+    blackListFileName=None,
+    numberOfProcessors=4,
+    verbose=False,
+    includeLabels=False,
+    keepExons=False,
+    transcriptID="transcriptID",
+    exonID="exonID",
+    transcript_id_designator="transcript_id",
+    self_=None,
+    initializer=None,
+    initargs=(),
+    bamFiles=None,
+    splitChunks=True,
+    chunkAlignment=1,
+):
+    r"""
+    Split the genome into parts that are sent to workers using a defined
+    number of processors. Results are collected and returned.
+
+    This is the deepTools mapReduce, extended with a worker initializer. For each
+    genomic region the given `func` is called using the parameters
+    (chrom, start, end, staticArgs), or (self_, chrom, start, end, staticArgs)
+    if `self_` is given.
+
+    Parameters
+    ----------
+    staticArgs : list
+        *pickable* arguments that are sent to `func` for each chunk.
+    func : function
+        function to call for each chunk.
+    chromSize : list
+        list of tuples containing the chromosome name and its length.
+    genomeChunkLength : int
+        length (bp) of the chunks sent to the workers.
+    region : str
+        restrict the chunks to a region. The format is chr:start:end:tileSize
+        (see `deeptools.mapReduce.getUserRegion`).
+    bedFile : list
+        if given, the list of bed regions that overlap each chunk is appended
+        to the arguments of `func`.
+    blackListFileName : str
+        regions to exclude from all computations, with genomeChunkLength resolution.
+    numberOfProcessors : int
+        number of processes to use.
+    includeLabels : bool
+        return a tuple of (results, labels), with the group and transcript labels of the bed file.
+    self_ : object
+        in case mapReduce should call a method of an object, the object (self).
+    initializer : function
+        if given, called as ``initializer(*initargs)`` once in each worker process before
+        any chunk is processed (or once in the current process if no pool is used). This can
+        be used to open files only once per worker, instead of once per chunk.
+    initargs : tuple
+        arguments for the `initializer`.
+    bamFiles : list
+        if given, the read density of these BAM files is estimated from their .bai index. Chunks
+        with more reads than the average chunk are split into pieces with about the average number
+        of reads (see `splitChunks`), and the tasks are sent to the workers from the one with the
+        most reads to the one with the least, each worker taking the next task as soon as it is
+        done with the previous one. This avoids that a few chunks of high coverage (e.g. chrM)
+        keep a worker busy while the others are idle.
+    splitChunks : bool
+        split the chunks with many reads (only with `bamFiles`). Set to False if the chunks
+        themselves matter, e.g. when they are used as sampling windows.
+    chunkAlignment : int
+        the pieces of the split chunks start at multiples of this from the start of the chunk,
+        e.g. the bin size, so that the bins are the same as without splitting.
+
+    Returns
+    -------
+    list
+        The results of `func`, in the order of the chunks (chromosome, then start position).
+    """
+
+    if not genomeChunkLength:
+        genomeChunkLength = 1e5
+    genomeChunkLength = int(genomeChunkLength)
+
+    if verbose:
+        print("genome partition size for multiprocessing: {0}".format(genomeChunkLength))
+
+    region_start = 0
+    region_end = None
+
+    # if a region is set, that means that the task should only cover
+    # the given genomic position
+    if region:
+        chromSize, region_start, region_end, genomeChunkLength = getUserRegion(chromSize, region)
+        if verbose:
+            print(
+                "chrom size: {0}, region start: {1}, region end: {2}, "
+                "genome chunk length sent to each procesor: {3}".format(
+                    chromSize, region_start, region_end, genomeChunkLength
+                )
+            )
+
+    if bedFile:
+        defaultGroup = None
+        if len(bedFile) == 1:
+            defaultGroup = "genes"
+        bed_interval_tree = GTF(
+            bedFile,
+            defaultGroup=defaultGroup,
+            transcriptID=transcriptID,
+            exonID=exonID,
+            transcript_id_designator=transcript_id_designator,
+            keepExons=keepExons,
+        )
+
+    if blackListFileName:
+        blackList = GTF(blackListFileName)
+
+    density = None
+    maxWork = 0
+    if bamFiles:
+        density = getIndexDensity(bamFiles)
+    if density is not None and splitChunks:
+        # the average amount of data of a chunk
+        totalWork = 0.0
+        nChunks = 0
+        for chrom, size in chromSize:
+            start = 0 if region_start == 0 else region_start
+            totalWork += getChunkWork(density.get(chrom), start, size)
+            nChunks += int(np.ceil((size - start) / float(genomeChunkLength)))
+        maxWork = totalWork / max(nChunks, 1)
+
+    TASKS = []
+    WORK = []
+    # iterate over all chromosomes
+    for chrom, size in chromSize:
+        # the start is zero unless a specific region is defined
+        start = 0 if region_start == 0 else region_start
+        for startPos in range(start, size, genomeChunkLength):
+            endPos = min(size, startPos + genomeChunkLength)
+
+            # chunks with many reads are split
+            if maxWork > 0:
+                pieces = splitChunk(density.get(chrom), startPos, endPos, maxWork, chunkAlignment)
+            else:
+                pieces = [[startPos, endPos]]
+
+            # Reject a chunk if it overlaps
+            regions = []
+            for piece in pieces:
+                if blackListFileName:
+                    regions.extend(blSubtract(blackList, chrom, piece))
+                else:
+                    regions.append(piece)
+
+            for reg in regions:
+                if self_ is not None:
+                    argsList = [self_]
+                else:
+                    argsList = []
+
+                argsList.extend([chrom, reg[0], reg[1]])
+                # add to argument list the static list received the the function
+                argsList.extend(staticArgs)
+
+                # if a bed file is given, append to the TASK list,
+                # a list of bed regions that overlap with the
+                # current genomeChunk.
+                if bedFile:
+                    if includeLabels:
+                        bed_regions_list = [
+                            [chrom, x[4], x[2], x[3], x[5], x[6]]
+                            for x in bed_interval_tree.findOverlaps(
+                                chrom,
+                                reg[0],
+                                reg[1],
+                                trimOverlap=True,
+                                numericGroups=True,
+                                includeStrand=True,
+                            )
+                        ]
+                    else:
+                        bed_regions_list = [
+                            [chrom, x[4], x[5], x[6]]
+                            for x in bed_interval_tree.findOverlaps(
+                                chrom, reg[0], reg[1], trimOverlap=True, includeStrand=True
+                            )
+                        ]
+
+                    if len(bed_regions_list) == 0:
+                        continue
+                    # add to argument list, the position of the bed regions to use
+                    argsList.append(bed_regions_list)
+
+                TASKS.append(tuple(argsList))
+                if density is not None:
+                    WORK.append(getChunkWork(density.get(chrom), reg[0], reg[1]))
+
+    if len(TASKS) > 1 and numberOfProcessors > 1:
+        if verbose:
+            print(("using {} processors for {} " "number of tasks".format(numberOfProcessors, len(TASKS))))
+        order = list(range(len(TASKS)))
+        if density is not None:
+            # the largest tasks first, so that the small ones fill the gaps at the end
+            order.sort(key=lambda i: -WORK[i])
+        else:
+            # shuffle the tasks to balance the load
+            random.shuffle(order)
+        pool = multiprocessing.Pool(numberOfProcessors, initializer=initializer, initargs=initargs)
+        # one task at a time per worker, the results are put back in order
+        res = [None] * len(TASKS)
+        for i, r in pool.imap_unordered(_runTask, [(i, func, TASKS[i]) for i in order], chunksize=1):
+            res[i] = r
+        pool.close()
+        pool.join()
+    else:
+        if initializer is not None:
+            initializer(*initargs)
+        res = list(map(func, TASKS))
+
+    if includeLabels:
+        if bedFile:
+            return res, bed_interval_tree.labels
+        else:
+            return res, None
+    return res
@@ -14,7 +14,7 @@ def inputOutputOptions(args=None, opts=None, requiredOpts=[], suppress_args=None
             "--input",
             "-i",
             metavar="LOOM",
-            help="Input file in .loom format",
+            help="Input file in .loom format (.h5ad and .zarr files written by scCountReads are also accepted)",
             required=True,
         )
     elif "bamfiles" in opts:
@@ -86,13 +86,15 @@ def inputOutputOptions(args=None, opts=None, requiredOpts=[], suppress_args=None
             type=str,
             help="The file to write results to. For `scFilterStats`, `scFilterBarcodes` "
             "and `scJSD`, the output file is a .txt file. For other tools, the output file is "
-            "an updated .loom object with the result of the requested operation. ",
+            "an updated .loom object with the result of the requested operation "
+            "(or .h5ad/.zarr, if the file name has this extension). For `scFragmentStore`, "
+            "the output file is the fragment store (.h5).",
             required=True if "outFile" in requiredOpts else False,
         )
     return parser
 
 
-def otherOptions(args=None):
+def otherOptions(args=None, chunkReport=False):
     parser = argparse.ArgumentParser(add_help=False)
     group = parser.add_argument_group("Other options")
 
@@ -100,6 +102,17 @@ def otherOptions(args=None):
 
     group.add_argument("--verbose", "-v", help="Set to see processing messages.", action="store_true")
 
+    if chunkReport:
+        group.add_argument(
+            "--chunkReport",
+            metavar="FILE",
+            help="Write runtime statistics of each genome chunk processed (wall time, reads fetched, "
+            "reads rejected by each filter, bytes read and peak memory of the worker) to this file. "
+            "The report is written as JSON (with a summary of all chunks) if the file name ends "
+            "with .json, otherwise as a tab separated table with one chunk per row.",
+            default=None,
+        )
+
     group.add_argument("--version", action="version", version="%(prog)s {}".format(__version__))
 
     return parser
@@ -573,6 +586,28 @@ def numberOfProcessors(string):
     return numberOfProcessors
 
 
+def memorySize(string):
+    r"""
+    Converts a memory size with an optional K, M, G or T suffix (default: M) to bytes.
+
+    >>> memorySize("4G"), memorySize("500"), memorySize("1.5k")
+    (4294967296, 524288000, 1536)
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    string = string.strip().upper().rstrip("B")
+    unit = units["M"]
+    if string and string[-1] in units:
+        unit = units[string[-1]]
+        string = string[:-1]
+    try:
+        size = int(float(string) * unit)
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} is not a valid memory size".format(string))
+    if size <= 0:
+        raise argparse.ArgumentTypeError("the memory size must be positive")
+    return size
+
+
 def smartLabel(label):
     """
     Remove the path name and the last extension from the file name
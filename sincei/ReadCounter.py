@@ -1,21 +1,28 @@
 import shutil
 import os
+import bisect
+import pickle
+import tempfile
 import time
 import sys
 import multiprocessing
 import numpy as np
+from scipy import sparse
 
-# import scipy as sc
 # deepTools packages
 import deeptools.utilities
 from deeptools import bamHandler
-from deeptools import mapReduce
-from deeptoolsintervals import GTF
 import pyBigWig
 import py2bit
 
 ## own functions
 from sincei.Utilities import *
+from sincei.WriteCounts import writeShard
+from sincei.Regions import Regions
+from sincei.ReadFilter import ReadFilter
+from sincei.ChunkReport import ChunkStats, writeChunkStats
+from sincei import Checkpoint
+from sincei import MapReduce as mapReduce
 
 debug = 0
 old_settings = np.seterr(all="ignore")
@@ -32,6 +39,32 @@ def remove_row_of_zeros(matrix):
     return matrix[to_keep, :]
 
 
+## unsigned integer types for the counts, in order of promotion
+COUNT_DTYPES = ["uint8", "uint16", "uint32", "uint64"]
+
+## SAM flags that differ between the mates of a pair (read/mate reverse strand, first/second in pair)
+MATE_SPECIFIC_FLAGS = 16 | 32 | 64 | 128
+
+
+def cast_counts(counts, dtype):
+    r"""
+    Casts the counts (numpy array or scipy sparse matrix) to the given unsigned integer type.
+    If the largest count does not fit in this type, the next larger type that fits is used.
+
+    >>> cast_counts(np.array([[1.0, 2.0], [0.0, 255.0]]), "uint8").dtype
+    dtype('uint8')
+    >>> cast_counts(sparse.csr_matrix(np.array([[1, 2], [0, 256]])), "uint8").dtype
+    dtype('uint16')
+    """
+    if sparse.issparse(counts):
+        maxCount = counts.data.max() if counts.nnz else 0
+    else:
+        maxCount = counts.max() if counts.size else 0
+    for dt in COUNT_DTYPES[COUNT_DTYPES.index(dtype) :]:
+        if maxCount <= np.iinfo(dt).max:
+            return counts.astype(dt)
+
+
 def estimateSizeFactors(m):
     r"""
     Compute size factors in the same way as DESeq2.
@@ -67,9 +100,207 @@ def countReadsInRegions_wrapper(args):
     return CountReadsPerBin.count_reads_in_region(*args)
 
 
+## files opened once per process and re-used for all the chunks processed by it
+_worker_resources = {}
+
+
+def open_worker_resources(bamFilesList, blackListFileName=None, genome2bit=None, tablesFile=None):
+    r"""
+    Opens the BAM files, the blacklist and the 2bit genome for the current process, and
+    loads the lookup tables (see CountReadsPerBin.share_lookup_tables) if a file is given.
+    This is used as initializer of the mapReduce worker pool, so that each worker opens
+    the files only once instead of once per genome chunk.
+
+    Returns
+    -------
+    dict
+        with keys bamHandles, blackList, twoBitGenome and tables (None if not given).
+    """
+    close_worker_resources()
+    bam_handles = []
+    for fname in bamFilesList:
+        try:
+            bam_handles.append(bamHandler.openBam(fname))
+        except SystemExit:
+            sys.exit(sys.exc_info()[1])
+        except:
+            bam_handles.append(pyBigWig.open(fname))
+
+    _worker_resources["key"] = (tuple(bamFilesList), blackListFileName, genome2bit, tablesFile)
+    _worker_resources["bamHandles"] = bam_handles
+    _worker_resources["blackList"] = getBlacklistIndex(blackListFileName) if blackListFileName is not None else None
+    _worker_resources["twoBitGenome"] = py2bit.open(genome2bit, True) if genome2bit else None
+    _worker_resources["tables"] = load_lookup_tables(tablesFile) if tablesFile is not None else None
+    return _worker_resources
+
+
+def load_lookup_tables(tablesFile):
+    r"""
+    Returns the lookup tables written by CountReadsPerBin.share_lookup_tables (a dict of
+    attribute name -> value). The file is read once per process.
+    """
+    if _worker_resources.get("tablesFile") != tablesFile:
+        with open(tablesFile, "rb") as f:
+            _worker_resources["tables"] = pickle.load(f)
+        _worker_resources["tablesFile"] = tablesFile
+    return _worker_resources["tables"]
+
+
+def close_worker_resources():
+    r"""
+    Closes the files opened by open_worker_resources in the current process.
+    """
+    for bam in _worker_resources.get("bamHandles", []):
+        bam.close()
+    if _worker_resources.get("twoBitGenome") is not None:
+        _worker_resources["twoBitGenome"].close()
+    _worker_resources.clear()
+
+
 ######### --------------- Class definitions --------------
 
 
+class CooBuffer(object):
+    r"""Growable (row, col, value) buffers to accumulate sparse counts.
+
+    The buffers start small and double in size whenever they are full, so that the memory
+    used scales with the number of non-zero (bin, cell) entries instead of bins * cells.
+
+    >>> buf = CooBuffer(capacity=2)
+    >>> buf.extend([0, 1, 2], [1, 1, 1], [1, 1, 1])
+    >>> buf.extend([2], [1], [5])
+    >>> buf.to_csr((4, 2)).toarray()
+    array([[0, 1],
+           [0, 1],
+           [0, 6],
+           [0, 0]])
+    """
+
+    def __init__(self, capacity=1024, dtype=np.int64):
+        self.rows = np.empty(capacity, dtype=np.int32)
+        self.cols = np.empty(capacity, dtype=np.int32)
+        self.vals = np.empty(capacity, dtype=dtype)
+        self.n = 0
+
+    def _grow(self, needed):
+        capacity = len(self.rows)
+        while capacity < needed:
+            capacity *= 2
+        self.rows = np.resize(self.rows, capacity)
+        self.cols = np.resize(self.cols, capacity)
+        self.vals = np.resize(self.vals, capacity)
+
+    def extend(self, rows, cols, vals):
+        r"""Append arrays of rows, columns and values"""
+        n = len(rows)
+        if self.n + n > len(self.rows):
+            self._grow(self.n + n)
+        self.rows[self.n : self.n + n] = rows
+        self.cols[self.n : self.n + n] = cols
+        self.vals[self.n : self.n + n] = vals
+        self.n += n
+
+    def to_csr(self, shape):
+        r"""Return the accumulated entries as a CSR matrix, summing duplicated entries"""
+        mat = sparse.coo_matrix(
+            (self.vals[: self.n], (self.rows[: self.n], self.cols[: self.n])),
+            shape=shape,
+        ).tocsr()
+        mat.eliminate_zeros()
+        return mat
+
+
+class WindowReads(object):
+    r"""Reads fetched once for a window spanning several nearby features (see ``featureMergeDistance``).
+
+    The reads passing the filters are kept in fetch order (sorted by start) with the span of their
+    alignment, their duplicate key and their fragment blocks. The reads that a fetch of one feature
+    would return are found with a sorted-interval index (the starts, and the cumulative maximum of
+    the ends), and the duplicates are removed among them as during that fetch: a read is a duplicate
+    if its key is the one of the previous read (see sincei.Utilities.DuplicateFilter, mode "last").
+
+    >>> w = WindowReads()
+    >>> w.add(10, 60, 1, 0, 1, [(10, 60)])
+    >>> w.add(10, 60, 1, 0, 1, [(10, 60)])
+    >>> w.add(30, 40, 2, 1, 1, [(30, 40)])
+    >>> w.add(50, 90, 3, 0, 1, [(50, 70), (80, 90)])
+    >>> starts, ends, cols, reads, weights, nDuplicates = w.fragments(45, 100)
+    >>> starts, ends, reads, nDuplicates
+    (array([10, 50, 80]), array([60, 70, 90]), array([0, 3, 3]), 1)
+    >>> w.fragments(35, 38)[0]
+    array([10, 30])
+    """
+
+    def __init__(self):
+        self.spanStarts = []
+        self.spanEnds = []
+        self.keys = []
+        self.blockOffsets = [0]
+        self.blockStarts = []
+        self.blockEnds = []
+        self.blockCols = []
+        self.blockWeights = []
+        self._index = None
+
+    def add(self, spanStart, spanEnd, key, col, weight, blocks):
+        r"""Appends a read that passed the filters (key is None without duplicate filter) and its blocks"""
+        self.spanStarts.append(spanStart)
+        self.spanEnds.append(spanEnd)
+        self.keys.append(key)
+        for blockStart, blockEnd in blocks:
+            if blockStart is None or blockEnd is None:
+                continue
+            self.blockStarts.append(blockStart)
+            self.blockEnds.append(blockEnd)
+            self.blockCols.append(col)
+            self.blockWeights.append(weight)
+        self.blockOffsets.append(len(self.blockStarts))
+
+    def _build_index(self):
+        spanEnds = np.asarray(self.spanEnds, dtype=np.int64)
+        maxEnds = np.maximum.accumulate(spanEnds) if len(spanEnds) else spanEnds
+        keys = None
+        if len(self.keys) and self.keys[0] is not None:
+            keys = np.empty(len(self.keys), dtype=object)
+            keys[:] = self.keys
+        self._index = (
+            np.asarray(self.spanStarts, dtype=np.int64),
+            spanEnds,
+            maxEnds,
+            keys,
+            np.asarray(self.blockOffsets, dtype=np.int64),
+            np.asarray(self.blockStarts, dtype=np.int64),
+            np.asarray(self.blockEnds, dtype=np.int64),
+            np.asarray(self.blockCols, dtype=np.int64),
+            np.asarray(self.blockWeights, dtype=np.int64),
+        )
+
+    def fragments(self, start, end):
+        r"""
+        Returns the fragment blocks (starts, ends, barcode columns, read numbers and weights) of the
+        reads overlapping [start, end) that are not duplicates, and the number of duplicates.
+        """
+        if self._index is None:
+            self._build_index()
+        spanStarts, spanEnds, maxEnds, keys, offsets, bStarts, bEnds, bCols, bWeights = self._index
+        # the reads starting before the end, from the first one for which a read ending after the start was seen
+        first = np.searchsorted(maxEnds, start, side="right")
+        last = np.searchsorted(spanStarts, end, side="left")
+        reads = np.arange(first, max(first, last))
+        reads = reads[spanEnds[reads] > start]
+        nDuplicates = 0
+        if keys is not None and len(reads) > 1:
+            isDuplicate = np.zeros(len(reads), dtype=bool)
+            isDuplicate[1:] = keys[reads[1:]] == keys[reads[:-1]]
+            nDuplicates = int(isDuplicate.sum())
+            reads = reads[~isDuplicate]
+        nBlocks = offsets[reads + 1] - offsets[reads]
+        blocks = np.repeat(offsets[reads], nBlocks) + (
+            np.arange(nBlocks.sum()) - np.repeat(np.cumsum(nBlocks) - nBlocks, nBlocks)
+        )
+        return bStarts[blocks], bEnds[blocks], bCols[blocks], np.repeat(reads, nBlocks), bWeights[blocks], nDuplicates
+
+
 class CountReadsPerBin(object):
     r"""Collects coverage over multiple bam files using multiprocessing
 
@@ -193,12 +424,72 @@ class CountReadsPerBin(object):
     genomeChunkSize : int
         If not None, the length of the genome used for multiprocessing.
 
+    sparseOutput : bool
+        If true, the counts per chunk are accumulated as (bin, cell) entries in growable sparse
+        buffers instead of a dense array per barcode, and a scipy CSR matrix is returned.
+        Memory then scales with the number of non-zero entries rather than cells * bins.
+        Can not be combined with ``zerosToNans``.
+
+    countDtype : str
+        If given, the counts of each chunk are returned as unsigned integers of this type
+        (uint8, uint16 or uint32), which is promoted to a larger type for chunks where the
+        counts do not fit. "auto" selects the type based on the bin size and the sequencing
+        depth. Can not be combined with ``zerosToNans``.
+
+    shardDir : str
+        If given (requires ``sparseOutput``), each chunk writes its counts and region names
+        to a sparse shard (.npz) in this directory instead of sending them back to the main
+        process, and `run` returns the list of shard files in chunk order. The shards can be
+        merged with the functions in sincei.WriteCounts.
+
+    countFragmentsOnce : bool
+        If true (requires ``extendReads``), only the left-most mate of properly paired reads is
+        processed, and its fragment is counted for both mates. The counts are the same as when
+        both mates are processed, as long as the filters accept or reject both mates alike, but
+        the reads are fetched, filtered and assigned to cells only once per fragment. It can not be
+        combined with ``duplicateFilter``, or SAM flags that differ between the mates (16, 32, 64, 128).
+
+    memoryBudget : int
+        If given (in bytes), the genome chunks are sized so that the counts of the chunks processed
+        at the same time by all workers fit in this amount of memory, based on the number of
+        cells, the bin size, the count type and the number of processors. Otherwise the chunk
+        size only depends on the read density (unless ``genomeChunkSize`` is given).
+
+    chunkReportDir : str
+        If given, the runtime statistics of each chunk (see sincei.ChunkReport) are written
+        to this directory, from which they can be merged with ChunkReport.writeReport.
+
+    additionalBinSizes : list
+        Other bin sizes (multiples of ``binLength``) to count the reads in, from the same fetch and
+        filtering of the reads. The coarser bins are filled from the fragments collected for the
+        bins of ``binLength``, each fragment is counted once per bin it overlaps (as with a separate
+        run with that bin size). Requires ``sparseOutput``, and bins next to each other (``stepSize``
+        equal to ``binLength``, no ``bedFile``).
+
+    checkpointDir : str
+        If given (requires ``sparseOutput``), the shards of each chunk are written to this
+        directory instead of ``shardDir``, and recorded in a manifest with the coordinates of the
+        chunk and a hash of the parameters (see sincei.Checkpoint) once they are complete.
+
+    resume : bool
+        Re-use the chunks recorded in the manifest of ``checkpointDir`` with the same parameters,
+        and only count the missing ones. Otherwise, the chunks of a previous run are removed.
+
+    featureMergeDistance : int
+        If given (with a ``bedFile``), the features of a chunk whose fetch windows are closer than
+        this distance (in bp) are fetched together, and the reads of the window are assigned to the
+        overlapping features with a sorted-interval index (see WindowReads). The counts are the same
+        as with one fetch per feature (duplicates are removed per feature), but the reads of nearby
+        or overlapping features are only fetched, filtered and assigned to cells once.
+
     Returns
     -------
-    numpy array
+    numpy array (or scipy.sparse.csr_matrix if ``sparseOutput`` is true)
 
         Each row correspond to each bin/bed region and each column correspond to each of
-        the bamFiles.
+        the bamFiles. With ``additionalBinSizes``, `run` returns a dict with the counts of each
+        bin size (``binLength`` included), and a dict with the regions of each bin size (or the
+        shard files of each bin size and None, with ``shardDir``).
 
 
     Examples
@@ -217,6 +508,9 @@ class CountReadsPerBin(object):
            [0., 1., 1., 2.]])
     """
 
+    # attributes with one entry per cell, read once by each worker instead of sent with each chunk
+    LOOKUP_TABLES = ["barcodes", "groupLabels", "barcodeIndex", "clusterInfo"]
+
     def __init__(
         self,
         bamFilesList,
@@ -254,6 +548,16 @@ class CountReadsPerBin(object):
         bed_and_bin=False,
         sumCoveragePerBin=False,
         binarizeCoverage=False,
+        sparseOutput=False,
+        countDtype=None,
+        shardDir=None,
+        countFragmentsOnce=False,
+        memoryBudget=None,
+        chunkReportDir=None,
+        additionalBinSizes=None,
+        checkpointDir=None,
+        resume=False,
+        featureMergeDistance=None,
         statsList=[],
         mappedList=[],
     ):
@@ -332,6 +636,57 @@ class CountReadsPerBin(object):
         self.genome = genome2bit
         self.sumCoveragePerBin = sumCoveragePerBin
         self.binarizeCoverage = binarizeCoverage
+        self.sparseOutput = sparseOutput
+        self.countDtype = countDtype
+        self.shardDir = shardDir
+        self.countFragmentsOnce = countFragmentsOnce
+        self.memoryBudget = memoryBudget
+        self.chunkReportDir = chunkReportDir
+        # the bin sizes counted in addition to binLength, from the smallest to the largest
+        self.additionalBinSizes = sorted(set(additionalBinSizes or []) - set([binLength]))
+        self.checkpointDir = checkpointDir
+        self.resume = resume
+        # (chrom, start, end) -> shard files of the chunks counted by a previous run
+        self.completedChunks = {}
+        self.checkpointHash = None
+        if self.checkpointDir:
+            # the shards are written to the checkpoint
+            self.shardDir = self.checkpointDir
+        self.featureMergeDistance = featureMergeDistance
+
+        # hash table of barcode (or (group, barcode)) -> column, built once and shared with the workers
+        self.barcodeIndex = self.get_barcode_index()
+        # file of the lookup tables read by the workers (see share_lookup_tables)
+        self.tablesFile = None
+
+        if self.sparseOutput and self.zerosToNans:
+            raise ValueError("zerosToNans can not be used together with sparseOutput")
+        if self.countDtype and self.zerosToNans:
+            raise ValueError("zerosToNans can not be used together with countDtype")
+        if self.countDtype not in [None, "auto"] + COUNT_DTYPES:
+            raise ValueError("countDtype should be one of auto, {}".format(", ".join(COUNT_DTYPES)))
+        if self.shardDir and not self.sparseOutput:
+            raise ValueError("shardDir and checkpointDir require sparseOutput")
+        if self.countFragmentsOnce and self.defaultFragmentLength == "read length":
+            raise ValueError("countFragmentsOnce requires extendReads")
+        if self.countFragmentsOnce:
+            # the filters are only applied to the left-most mate, so they should accept or reject both mates alike
+            if self.duplicateFilter:
+                raise ValueError("countFragmentsOnce can not be used together with duplicateFilter")
+            if (self.samFlag_include or 0) & MATE_SPECIFIC_FLAGS or (self.samFlag_exclude or 0) & MATE_SPECIFIC_FLAGS:
+                raise ValueError(
+                    "countFragmentsOnce can not be used together with SAM flags that differ between the mates "
+                    "(16, 32, 64, 128)"
+                )
+        if self.additionalBinSizes:
+            if not self.sparseOutput or out_file_for_raw_data:
+                raise ValueError("additionalBinSizes requires sparseOutput")
+            if self.bedFile is not None or self.stepSize != self.binLength:
+                raise ValueError("additionalBinSizes requires bins next to each other (stepSize = binLength)")
+            if any(size % self.binLength for size in self.additionalBinSizes):
+                raise ValueError("additionalBinSizes should be multiples of the bin length")
+        if self.featureMergeDistance is not None and self.featureMergeDistance < 0:
+            raise ValueError("featureMergeDistance should not be negative")
 
         if out_file_for_raw_data:
             self.save_data = True
@@ -364,6 +719,130 @@ class CountReadsPerBin(object):
                 self.mappedList = []
                 self.statsList = []
 
+    def get_barcode_index(self):
+        r"""Returns a dict mapping each barcode to its column in the output of a BAM file.
+
+        In case of ``groupTag`` input the keys are (group, barcode) tuples, reconstructed from
+        the ``groupLabels`` (in the format group::barcode). Column ids follow the order of the
+        labels, and repeated labels share the same column.
+
+        >>> c = CountReadsPerBin([], 50, barcodes=["AA", "CC", "AA"], stepSize=50)
+        >>> c.get_barcode_index()
+        {'AA': 0, 'CC': 1}
+        >>> c = CountReadsPerBin([], 50, barcodes=["AA"], groupTag="SM", groupLabels=["s1::AA", "s2::AA"], stepSize=50)
+        >>> c.get_barcode_index()
+        {('s1', 'AA'): 0, ('s2', 'AA'): 1}
+        """
+        index = {}
+        if self.groupTag and self.groupLabels:  # multi-sample BAM input, use the reconstructed labels
+            for label in self.groupLabels:
+                grp, bc = label.rsplit("::", 1)
+                index.setdefault((grp, bc), len(index))
+        elif self.barcodes:
+            for bc in self.barcodes:
+                index.setdefault(bc, len(index))
+        return index
+
+    def get_checkpoint_params(self):
+        r"""Returns the parameters the counts of the chunks depend on, as a dict (see sincei.Checkpoint)"""
+        names = [
+            "binLength",
+            "stepSize",
+            "numberOfSamples",
+            "region",
+            "barcodes",
+            "cellTag",
+            "groupTag",
+            "groupLabels",
+            "motifFilter",
+            "genome",
+            "GCcontentFilter",
+            "minMappingQuality",
+            "duplicateFilter",
+            "chrsToSkip",
+            "center_read",
+            "samFlag_include",
+            "samFlag_exclude",
+            "minFragmentLength",
+            "maxFragmentLength",
+            "minAlignedFraction",
+            "defaultFragmentLength",
+            "maxPairedFragmentLength",
+            "zerosToNans",
+            "bed_and_bin",
+            "sumCoveragePerBin",
+            "binarizeCoverage",
+            "countDtype",
+            "countFragmentsOnce",
+            "additionalBinSizes",
+        ]
+        params = dict((name, getattr(self, name)) for name in names)
+        # the input files, with their size and modification time
+        params["bamFiles"] = [Checkpoint.getFileSignature(x) for x in self.bamFilesList]
+        params["bedFile"] = [Checkpoint.getFileSignature(x) for x in self.bedFile] if self.bedFile else None
+        params["blackListFileName"] = Checkpoint.getFileSignature(self.blackListFileName)
+        return params
+
+    def get_worker_resources_args(self):
+        r"""Returns the arguments for open_worker_resources (BAM files, blacklist, 2bit genome and lookup tables)"""
+        genome2bit = self.genome if self.motifFilter else None
+        return (tuple(self.bamFilesList), self.blackListFileName, genome2bit, self.tablesFile)
+
+    def get_worker_resources(self):
+        r"""Returns the files opened for the current process.
+
+        These are normally opened by the worker pool initializer. In case they were not (or
+        were opened for other files), e.g. when calling count_reads_in_region directly,
+        they are opened here and kept for the following calls.
+        """
+        args = self.get_worker_resources_args()
+        if _worker_resources.get("key") != args:
+            open_worker_resources(*args)
+        return _worker_resources
+
+    def share_lookup_tables(self):
+        r"""
+        Writes the lookup tables (the barcodes, group labels, barcode index and cluster info,
+        see LOOKUP_TABLES) to a temporary file, which the workers of the pool read once when
+        they start (see open_worker_resources). The tables are then left out of the copies
+        of the object sent with each genome chunk. Nothing is done without worker pool.
+
+        >>> c = CountReadsPerBin([], 50, barcodes=["AA", "CC"], stepSize=50, numberOfProcessors=2)
+        >>> c.share_lookup_tables()
+        >>> c.__getstate__()["barcodes"] is None
+        True
+        >>> copy = pickle.loads(pickle.dumps(c))
+        >>> copy.barcodes, copy.barcodeIndex
+        (['AA', 'CC'], {'AA': 0, 'CC': 1})
+        >>> c.remove_lookup_tables()
+        """
+        if self.numberOfProcessors <= 1:
+            return
+        self.tablesFile = os.path.join(tempfile.mkdtemp(prefix="sincei_tables_"), "lookupTables.pkl")
+        with open(self.tablesFile, "wb") as f:
+            pickle.dump(
+                dict((name, getattr(self, name)) for name in self.LOOKUP_TABLES), f, protocol=pickle.HIGHEST_PROTOCOL
+            )
+
+    def remove_lookup_tables(self):
+        r"""Removes the file written by share_lookup_tables"""
+        if self.tablesFile is not None:
+            shutil.rmtree(os.path.dirname(self.tablesFile), ignore_errors=True)
+            self.tablesFile = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state.get("tablesFile") is not None:
+            # the workers read the tables from the file (see share_lookup_tables)
+            for name in self.LOOKUP_TABLES:
+                state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if state.get("tablesFile") is not None:
+            self.__dict__.update(load_lookup_tables(state["tablesFile"]))
+
     def get_chunk_length(self, bamFilesHandles, genomeSize, chromSizes, chrLengths):
         # Try to determine an optimal fraction of the genome (chunkSize) that is sent to
         # workers for analysis. If too short, too much time is spent loading the files
@@ -375,7 +854,7 @@ class CountReadsPerBin(object):
             else:
                 # compute the step size, based on the number of samples
                 # and the length of the region studied
-                (chrom, start, end) = mapReduce.getUserRegion(chromSizes, self.region)[:3]
+                chrom, start, end = mapReduce.getUserRegion(chromSizes, self.region)[:3]
                 self.stepSize = max(int(float(end - start) / self.numberOfSamples), 1)
 
         # number of samples is better if large
@@ -395,6 +874,9 @@ class CountReadsPerBin(object):
             reads_per_bp = float(max_mapped) / genomeSize
             chunkSize = int(self.stepSize * 1e3 / (reads_per_bp * len(bamFilesHandles)))
 
+        if self.memoryBudget:
+            chunkSize = self.get_memory_chunk_length(genomeSize)
+
         # Ensure that chunkSize is always at least self.stepSize
         if chunkSize < self.stepSize:
             chunkSize = self.stepSize
@@ -405,6 +887,69 @@ class CountReadsPerBin(object):
 
         return chunkSize
 
+    def get_memory_chunk_length(self, genomeSize):
+        r"""Returns the chunk length (bp) for which the counts of one chunk per worker fit in the ``memoryBudget``.
+
+        A chunk holds (bins x cells) counts, accumulated as uint32 (with ``countDtype``) or as
+        64 bit values, and copied once when the chunk is assembled. With ``sparseOutput``, only
+        the (bin, cell) pairs hit by reads are stored (with their row and column), estimated
+        from the number of mapped reads with a margin of 10x for regions of high coverage. The
+        chunks are also kept small enough for all workers to get at least one of them.
+
+        >>> c = CountReadsPerBin([], 1000, barcodes=["AA", "CC"], stepSize=1000, numberOfProcessors=2)
+        >>> c.memoryBudget = 64000
+        >>> c.get_memory_chunk_length(1e9)
+        1000000
+        >>> c.barcodeIndex = dict(("bc{}".format(i), i) for i in range(2000))
+        >>> c.get_memory_chunk_length(1e9)
+        1000
+        >>> c.sparseOutput = True
+        >>> c.mappedList = [1e7]
+        >>> c.get_memory_chunk_length(1e9)
+        10000
+        """
+        itemSize = 4 if self.countDtype else 8
+        nCols = max(len(self.barcodeIndex), 1) * max(len(self.bamFilesList), 1)
+        if self.sparseOutput:
+            reads_per_bin = 10.0 * sum(self.mappedList) * self.stepSize / genomeSize if self.mappedList else nCols
+            # value, row and column
+            bytesPerBin = max(min(nCols, reads_per_bin), 1) * (itemSize + 8)
+        else:
+            bytesPerBin = nCols * itemSize
+        # the counts of a chunk are copied once when they are assembled
+        nBins = int(self.memoryBudget / (2 * bytesPerBin * self.numberOfProcessors))
+        # one chunk per worker at least
+        nBins = min(nBins, int(np.ceil(genomeSize / (self.stepSize * self.numberOfProcessors))))
+        return max(nBins, 1) * self.stepSize
+
+    def get_count_dtype(self, genomeSize):
+        r"""Returns the smallest unsigned integer type expected to hold the counts of a bin.
+
+        The expected number of reads in a bin (for all cells) is estimated from the number of
+        mapped reads, with a margin of 10x for regions of high coverage. Chunks with larger
+        counts are promoted by cast_counts.
+
+        >>> c = CountReadsPerBin([], 1000, stepSize=1000)
+        >>> c.mappedList = [1e6]
+        >>> c.get_count_dtype(1e8)
+        'uint8'
+        >>> c.binLength = 100000
+        >>> c.get_count_dtype(1e8)
+        'uint16'
+        """
+        if self.sumCoveragePerBin or (self.bedFile and not self.bed_and_bin) or len(self.mappedList) == 0:
+            # counts of bases, or regions of unknown length
+            return "uint32"
+        if self.defaultFragmentLength == "read length":
+            fragmentLength = 0
+        else:
+            fragmentLength = self.defaultFragmentLength
+        readsPerBin = 10 * max(self.mappedList) * (self.binLength + fragmentLength) / genomeSize
+        for dt in COUNT_DTYPES[:-1]:
+            if readsPerBin <= np.iinfo(dt).max:
+                return dt
+        return "uint32"
+
     def run(self, allArgs=None):
         bamFilesHandles = []
         for x in self.bamFilesList:
@@ -434,6 +979,11 @@ class CountReadsPerBin(object):
 
         genomeSize = sum(chrLengths)
 
+        if self.countDtype == "auto":
+            self.countDtype = self.get_count_dtype(genomeSize)
+            if self.verbose:
+                print("count type is {}".format(self.countDtype))
+
         chunkSize = None
         if self.bedFile is None:
             if self.genomeChunkSize is None:
@@ -443,9 +993,20 @@ class CountReadsPerBin(object):
 
         [bam_h.close() for bam_h in bamFilesHandles]
 
+        # the bins of all sizes should start at the start of the chunks
+        chunkAlignment = self.stepSize or 1
+        if self.additionalBinSizes:
+            chunkAlignment = self.additionalBinSizes[-1]
+            if chunkSize is not None:
+                chunkSize = max(int(np.ceil(chunkSize / float(chunkAlignment))), 1) * chunkAlignment
+
         if self.verbose:
             print("step size is {}".format(self.stepSize))
 
+        if self.checkpointDir:
+            self.checkpointHash = Checkpoint.getParamsHash(self.get_checkpoint_params())
+            self.completedChunks = Checkpoint.openCheckpoint(self.checkpointDir, self.checkpointHash, self.resume)
+
         if self.region:
             # in case a region is used, append the tilesize
             self.region += ":{}".format(self.binLength)
@@ -459,22 +1020,44 @@ class CountReadsPerBin(object):
         ) = deeptools.utilities.gtfOptions(allArgs)
 
         # use map reduce to call countReadsInRegions_wrapper
-        imap_res, _ = mapReduce.mapReduce(
-            [],
-            countReadsInRegions_wrapper,
-            chromsizes,
-            self_=self,
-            genomeChunkLength=chunkSize,
-            bedFile=self.bedFile,
-            blackListFileName=self.blackListFileName,
-            region=self.region,
-            includeLabels=True,
-            numberOfProcessors=self.numberOfProcessors,
-            transcriptID=transcriptID,
-            exonID=exonID,
-            keepExons=keepExons,
-            transcript_id_designator=transcript_id_designator,
-        )
+        self.share_lookup_tables()
+        try:
+            imap_res, _ = mapReduce.mapReduce(
+                [],
+                countReadsInRegions_wrapper,
+                chromsizes,
+                self_=self,
+                genomeChunkLength=chunkSize,
+                bedFile=self.bedFile,
+                blackListFileName=self.blackListFileName,
+                region=self.region,
+                includeLabels=True,
+                numberOfProcessors=self.numberOfProcessors,
+                transcriptID=transcriptID,
+                exonID=exonID,
+                keepExons=keepExons,
+                transcript_id_designator=transcript_id_designator,
+                initializer=open_worker_resources,
+                initargs=self.get_worker_resources_args(),
+                bamFiles=self.bamFilesList,
+                # chunks are only split at bin boundaries, overlapping bins at the cut points would be lost
+                splitChunks=self.bedFile is not None or self.stepSize >= self.binLength,
+                chunkAlignment=chunkAlignment,
+            )
+        finally:
+            self.remove_lookup_tables()
+        # the files are opened in the current process if no worker pool was used
+        close_worker_resources()
+
+        if self.additionalBinSizes:
+            # (counts, shard file, regions) of the chunks, for each bin size
+            levels = [(self.binLength, [x[:3] for x in imap_res])]
+            levels += [(size, [x[3][i] for x in imap_res]) for i, size in enumerate(self.additionalBinSizes)]
+            if self.shardDir:
+                return dict((size, [x[1] for x in res]) for size, res in levels), None
+            counts = dict((size, sparse.vstack([x[0] for x in res], format="csr")) for size, res in levels)
+            regions = dict((size, Regions.concat([x[2] for x in res])) for size, res in levels)
+            return counts, regions
 
         if self.out_file_for_raw_data:
             if len(non_common):
@@ -495,9 +1078,20 @@ class CountReadsPerBin(object):
 
             ofile.close()
 
+        if self.shardDir:
+            # the counts were written to shards by the workers
+            return [x[1] for x in imap_res], None
+
         try:
-            num_reads_per_bin = np.concatenate([x[0] for x in imap_res], axis=0)
-            regionList = np.concatenate([x[2] for x in imap_res])
+            if self.sparseOutput:
+                num_reads_per_bin = sparse.vstack([x[0] for x in imap_res], format="csr")
+            else:
+                num_reads_per_bin = np.concatenate([x[0] for x in imap_res], axis=0)
+            if self.save_data:
+                # region names were already written to out_file_for_raw_data
+                regionList = None
+            else:
+                regionList = Regions.concat([x[2] for x in imap_res])
             return num_reads_per_bin, regionList
 
         except ValueError:
@@ -573,23 +1167,24 @@ class CountReadsPerBin(object):
         if self.stepSize is None and bed_regions_list is None:
             raise ValueError("stepSize is not set!")
 
-        start_time = time.time()
+        if (chrom, start, end) in self.completedChunks:
+            # counted by the run that is resumed, only the shard files are sent back
+            shardFiles = self.completedChunks[(chrom, start, end)]
+            if self.additionalBinSizes:
+                return None, shardFiles[0], None, [(None, x, None) for x in shardFiles[1:]]
+            return None, shardFiles[0], None
 
-        bam_handles = []
-        for fname in self.bamFilesList:
-            try:
-                bam_handles.append(bamHandler.openBam(fname))
-            except SystemExit:
-                sys.exit(sys.exc_info()[1])
-            except:
-                bam_handles.append(pyBigWig.open(fname))
+        start_time = time.time()
+        chunkStats = ChunkStats(chrom, start, end) if self.chunkReportDir else None
 
-        blackList = None
-        if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
+        # BAM handles and blacklist are opened once per process
+        resources = self.get_worker_resources()
+        bam_handles = resources["bamHandles"]
+        blackList = resources["blackList"]
 
         # A list of lists of tuples
         transcriptsToConsider = []
+        keepWindows = None
         if bed_regions_list is not None:
             # print(bed_regions_list)
             # bed/gtf file is provided
@@ -608,13 +1203,13 @@ class CountReadsPerBin(object):
                 # simple tiling of chromosome
                 transcriptsToConsider.append([(start, end, self.binLength)])
             else:
-                # tiling with some stepsize
-                for i in range(start, end, self.stepSize):
-                    if i + self.binLength > end:
-                        break
-                    if blackList is not None and blackList.findOverlaps(chrom, i, i + self.binLength):
-                        continue
-                    transcriptsToConsider.append([(i, i + self.binLength)])
+                # windows every stepSize bp (overlapping, or with gaps between them), from one fetch of the chunk
+                tileStarts = np.arange(start, end - self.binLength + 1, self.stepSize)
+                windowsEnd = int(tileStarts[-1]) + self.binLength if len(tileStarts) else start
+                transcriptsToConsider.append([(start, windowsEnd, self.binLength, self.stepSize)])
+                if blackList is not None:
+                    # the windows overlapping the blacklist are removed once counted
+                    keepWindows = ~blackList.overlapsArray(chrom, tileStarts, tileStarts + self.binLength)
 
         #        if self.save_data:
         #            _file = open(deeptools.utilities.getTempFileName(suffix='.bed'), 'w+t')
@@ -622,16 +1217,39 @@ class CountReadsPerBin(object):
         #        else:
         #            _file_name = ''
 
+        # the reads of nearby features are fetched once per window, for each bam file
+        windowReads = [None] * len(bam_handles)
+        if bed_regions_list is not None and self.featureMergeDistance is not None:
+            features = [reg for trans in transcriptsToConsider for reg in trans]
+            windowReads = [self.get_window_reads(bam, chrom, features, chunkStats=chunkStats) for bam in bam_handles]
+
         # array to keep the read counts for the regions
         subnum_reads_per_bin = []
-        for trans in transcriptsToConsider:
-            for bam in bam_handles:
-                tcov = self.get_coverage_of_region(
-                    bam, chrom, trans
-                )  # tcov is supposed to be an np.array, but now it's a dict(barcode:array)
-                tcov_stack = np.stack(
-                    list(tcov.values()), axis=0
-                )  # col-bind the output (rownames = barcode, colnames = bins )
+        # and the counts of each bam file in the bins of additionalBinSizes
+        levels_reads_per_bin = [[] for _ in self.additionalBinSizes]
+        # the features are counted one by one, unless they can be counted at once from the window reads
+        remainingTranscripts = transcriptsToConsider
+        if windowReads[0] is not None and self.sparseOutput and not self.bed_and_bin:
+            subnum_reads_per_bin.append(
+                self.get_coverage_of_features(chrom, transcriptsToConsider, windowReads, chunkStats=chunkStats)
+            )
+            remainingTranscripts = []
+        for trans in remainingTranscripts:
+            trans_reads_per_bin = []
+            for bam, bamWindowReads in zip(bam_handles, windowReads):
+                # tcov has one column per barcode (rows = bins) if sparse, otherwise one row per barcode
+                tcov = self.get_coverage_of_region(bam, chrom, trans, chunkStats=chunkStats, windowReads=bamWindowReads)
+                if self.additionalBinSizes:
+                    tcov, levelCovs = tcov[0], tcov[1:]
+                    for i, cov in enumerate(levelCovs):
+                        levels_reads_per_bin[i].append(cov)
+                if self.sparseOutput:
+                    # tcov is a sparse matrix with rows = bins, cols = barcodes
+                    if bed_regions_list is not None and not self.bed_and_bin:
+                        tcov = sparse.csr_matrix(tcov.sum(axis=0))
+                    trans_reads_per_bin.append(tcov)
+                    continue
+                tcov_stack = tcov  # rownames = barcode, colnames = bins
                 if bed_regions_list is not None and not self.bed_and_bin:
                     # output should be list of arrays. length = nRegions, values.shape=[nBAMs*nbarcodes]
                     subnum_reads_per_bin.append([np.sum(s) for s in tcov_stack])
@@ -639,63 +1257,97 @@ class CountReadsPerBin(object):
                     # output should be list of arrays. length = nCells*nBAMs, values.shape =
                     # each entry is an array of length = nBins
                     subnum_reads_per_bin.append(tcov_stack)
+            if self.sparseOutput:
+                # the order of col should be bam1:cell1...n, bam2:cell1..n
+                subnum_reads_per_bin.append(sparse.hstack(trans_reads_per_bin, format="csr"))
 
         ## final output should be regions=rows, cells=col
         # the order of col should be bam1:cell1...n, bam2:cell1..n
-        if bed_regions_list is not None or self.numberOfSamples is not None:
+        if self.sparseOutput:
+            subnum_reads_per_bin = sparse.vstack(subnum_reads_per_bin, format="csr")
+        elif bed_regions_list is not None:
             if not self.bed_and_bin:
-                if self.groupTag and self.groupLabels:
-                    # stack the arrays column-wise, output rows=barcodes*groups*nBam, col=regions then reshape them so the regions are rows now
-                    subnum_reads_per_bin = np.asarray(subnum_reads_per_bin).reshape(
-                        (-1, len(self.groupLabels) * len(self.bamFilesList)), order="C"
-                    )
-                else:
-                    # stack the arrays column-wise, output rows=barcodes(*nBam), col=regions then reshape them so the regions are rows now
-                    subnum_reads_per_bin = np.asarray(subnum_reads_per_bin).reshape(
-                        (-1, len(self.barcodes) * len(self.bamFilesList)), order="C"
-                    )
+                # stack the arrays column-wise, output rows=barcodes(*groups)*nBam, col=regions then reshape them so the regions are rows now
+                subnum_reads_per_bin = np.asarray(subnum_reads_per_bin).reshape(
+                    (-1, len(self.barcodeIndex) * len(self.bamFilesList)), order="C"
+                )
         else:
             subnum_reads_per_bin = np.concatenate(subnum_reads_per_bin).transpose()
-        ## convert the output to a sparse matrix
-        # subnum_reads_per_bin = sc.sparse.csr_matrix(subnum_reads_per_bin)
-        ## prepare list of regions
-        regionList = []
-        idx = 0
-        for i, trans in enumerate(transcriptsToConsider):
-            if regionNames is not None:
-                bedname = regionNames[i]
-            else:
-                bedname = None
-
-            if len(trans[0]) != 3:
-                starts = ",".join([str(x[0]) for x in trans])
-                ends = ",".join([str(x[1]) for x in trans])
-                name = "{}_{}_{}::{}".format(chrom, starts, ends, bedname)
-                regionList.append(name)
-                # _file.write(name + "\n")
-            else:
-                for exon in trans:
-                    for startPos in range(exon[0], exon[1], exon[2]):
-                        if idx >= subnum_reads_per_bin.shape[0]:
-                            # At the end of chromosomes (or due to blacklisted regions), there are bins smaller than the bin size
-                            # Counts there are added to the bin before them, but range() will still try to include them.
-                            break
-                        name = "{}_{}_{}::{}".format(chrom, startPos, min(startPos + exon[2], exon[1]), bedname)
-                        regionList.append(name)
-                        # _file.write(name+"\n")
-                        idx += 1
+        if self.countDtype:
+            # compact integer counts for the transfer to the main process
+            subnum_reads_per_bin = cast_counts(subnum_reads_per_bin, self.countDtype)
 
+        ## prepare list of regions (as columns, the region names are only created if needed)
+        if len(transcriptsToConsider) and len(transcriptsToConsider[0][0]) == 2:
+            regionList = [Regions.from_blocks(chrom, transcriptsToConsider, name=regionNames)]
+        else:
+            regionList = []
+            for i, trans in enumerate(transcriptsToConsider):
+                bedname = regionNames[i] if regionNames is not None else None
+                for exon in trans:
+                    if len(exon) == 4:
+                        regionList.append(Regions.from_windows(chrom, exon[0], exon[1], exon[2], exon[3], name=bedname))
+                    else:
+                        regionList.append(Regions.from_tiles(chrom, exon[0], exon[1], exon[2], name=bedname))
+        regionList = Regions.concat(regionList)
+        if len(regionList) > subnum_reads_per_bin.shape[0]:
+            # At the end of chromosomes (or due to blacklisted regions), there are bins smaller than the bin size
+            # Counts there are added to the bin before them, but the tiles still include them.
+            regionList = regionList[: subnum_reads_per_bin.shape[0]]
+        if keepWindows is not None and not keepWindows.all():
+            subnum_reads_per_bin = subnum_reads_per_bin[keepWindows]
+            regionList = regionList[keepWindows]
+
+        if self.shardDir:
+            # write counts and regions of the chunk to a shard, only the file name is sent back
+            if self.checkpointDir:
+                _file_name = Checkpoint.getChunkFileName(self.checkpointDir, chrom, start, end)
+            else:
+                fd, _file_name = tempfile.mkstemp(suffix=".npz", dir=self.shardDir)
+                os.close(fd)
+            writeShard(_file_name, subnum_reads_per_bin, regionList)
+            regionList = None
         # save region data as text (if the mtx file is asked)
-        if self.save_data:
+        elif self.save_data:
             _file = open(deeptools.utilities.getTempFileName(suffix=".bed"), "w+t")
             _file_name = _file.name
-            for name in regionList:
+            for name in regionList.index:
                 _file.write(name + "\n")
             _file.close()
             regionList = None
         else:
             _file_name = ""
 
+        # (counts, shard file, regions) of the chunk for each of the additionalBinSizes
+        additional = []
+        for size, levelCovs in zip(self.additionalBinSizes, levels_reads_per_bin):
+            counts = sparse.hstack(levelCovs, format="csr")
+            if self.countDtype:
+                counts = cast_counts(counts, self.countDtype)
+            regions = Regions.from_tiles(chrom, transcriptsToConsider[0][0][0], transcriptsToConsider[0][0][1], size)
+            regions = regions[: counts.shape[0]]
+            if self.shardDir:
+                if self.checkpointDir:
+                    shardFile = Checkpoint.getChunkFileName(self.checkpointDir, chrom, start, end, "_{}bp".format(size))
+                else:
+                    fd, shardFile = tempfile.mkstemp(suffix=".npz", dir=self.shardDir)
+                    os.close(fd)
+                writeShard(shardFile, counts, regions)
+                additional.append((None, shardFile, None))
+            else:
+                additional.append((counts, "", regions))
+
+        if self.checkpointDir:
+            # all shards of the chunk are written
+            Checkpoint.addChunk(
+                self.checkpointDir,
+                self.checkpointHash,
+                chrom,
+                start,
+                end,
+                [_file_name] + [x[1] for x in additional],
+            )
+
         if self.verbose:
             endTime = time.time()
             rows = subnum_reads_per_bin.shape[0]
@@ -712,12 +1364,31 @@ class CountReadsPerBin(object):
                 )
             )
 
+        if chunkStats is not None:
+            writeChunkStats(self.chunkReportDir, chunkStats.finish())
+
+        if self.shardDir:
+            # the counts are not sent back to the main process
+            subnum_reads_per_bin = None
+
+        if self.additionalBinSizes:
+            return subnum_reads_per_bin, _file_name, regionList, additional
         return subnum_reads_per_bin, _file_name, regionList
 
-    def get_coverage_of_region(self, bamHandle, chrom, regions, fragmentFromRead_func=None):
+    def get_coverage_of_region(
+        self, bamHandle, chrom, regions, fragmentFromRead_func=None, chunkStats=None, windowReads=None
+    ):
         r"""
         Returns a numpy array that corresponds to the number of reads
-        that overlap with each tile.
+        that overlap with each tile. If ``sparseOutput`` is set, a CSR matrix
+        with rows = tiles and columns = barcodes is returned instead.
+        If a sincei.ChunkReport.ChunkStats object is given, the number of reads
+        fetched and rejected (per filter) are added to it. With ``additionalBinSizes``, a
+        list is returned, with the counts in the bins of each size after those of the tiles.
+        If the reads were fetched per window of features by get_window_reads, its output is
+        given as ``windowReads`` and the regions are not fetched again. The regions are
+        (start, end) tuples, (start, end, tileSize) to be tiled, or (start, end, windowSize,
+        stepSize) for windows starting every stepSize bp (the last one ending at end).
 
         >>> test = Tester()
         >>> import pysam
@@ -758,30 +1429,35 @@ class CountReadsPerBin(object):
                 nbins += (reg[1] - reg[0]) // reg[2]
                 if (reg[1] - reg[0]) % reg[2] > 0:
                     nbins += 1
-        # coverages = np.zeros(nbins, dtype='float64')
-        ## instead of an array, the coverages object is a dict with keys = barcodes, values = np arrays
-        coverages = {}
-        if self.groupTag and self.groupLabels:  # multi-sample BAM input, use the reconstructed labels
-            for b in self.groupLabels:
-                coverages[b] = np.zeros(nbins, dtype="float64")
+        elif len(regions[0]) == 4:
+            # windows of size reg[2] every reg[3] bp, the last one ends at reg[1]
+            nbins = sum((reg[1] - reg[0] - reg[2]) // reg[3] + 1 for reg in regions)
+        ## columns (barcodes) are looked up in the barcodeIndex, built once in __init__
+        barcodeIndex = self.barcodeIndex
+        useGroups = self.groupTag and self.groupLabels
+        # with countDtype, counts are accumulated as uint32 and compacted further per chunk
+        if self.sparseOutput:
+            ## (bin, cell) hits are recorded in growable buffers
+            cooBuffer = CooBuffer(dtype=np.uint32 if self.countDtype else np.int64)
+            # and those of the bins of additionalBinSizes (in bins mode, there is a single region)
+            levelBuffers = [
+                CooBuffer(dtype=np.uint32 if self.countDtype else np.int64) for _ in self.additionalBinSizes
+            ]
+            levelBins = []
+            for size in self.additionalBinSizes:
+                levelBins.append((regions[0][1] - regions[0][0]) // size)
+                if (regions[0][1] - regions[0][0]) % size > 0 and not self.sumCoveragePerBin:
+                    levelBins[-1] += 1
         else:
-            for b in self.barcodes:
-                coverages[b] = np.zeros(nbins, dtype="float64")
+            ## the coverages object is an array with rows = barcodes, cols = bins
+            coverages = np.zeros((len(barcodeIndex), nbins), dtype=np.uint32 if self.countDtype else np.float64)
 
-        if self.defaultFragmentLength == "read length":
-            extension = 0
-        else:
-            extension = self.maxPairedFragmentLength
-
-        blackList = None
-        if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
-        # raise error if motifs are to be checked but the chromosome in bam and 2bit don't match
-        if self.motifFilter and self.genome:
-            twoBitGenome = py2bit.open(self.genome, True)
-            if chrom not in twoBitGenome.chroms().keys():
-                raise NameError("chromosome {} not found in 2bit file".format(chrom))
+        readFilter = self.get_read_filter(chrom, duplicateFilter=self.duplicateFilter)
 
+        # reads fetched, reads without (whitelisted) barcode, and duplicates of the window reads
+        nFetched = 0
+        nNoBarcode = 0
+        nDuplicates = 0
         vector_start = 0
         for idx, reg in enumerate(regions):
             if len(reg) == 3:
@@ -791,25 +1467,18 @@ class CountReadsPerBin(object):
                     if not self.sumCoveragePerBin:
                         # Don't eliminate small bins! Issue 887
                         nRegBins += 1
+            elif len(reg) == 4:
+                tileSize = int(reg[2])
+                nRegBins = (reg[1] - reg[0] - tileSize) // reg[3] + 1
             else:
                 nRegBins = 1
                 tileSize = int(reg[1] - reg[0])
 
             # Blacklisted regions have a coverage of 0
-            if blackList and blackList.findOverlaps(chrom, reg[0], reg[1]):
+            window = self.get_fetch_window(chrom, reg)
+            if window is None:
                 continue
-            regStart = int(max(0, reg[0] - extension))
-            regEnd = reg[1] + int(extension)
-
-            # If alignments are extended and there's a blacklist, ensure that no
-            # reads originating in a blacklist are fetched
-            if blackList and reg[0] > 0 and extension > 0:
-                o = blackList.findOverlaps(chrom, regStart, reg[0])
-                if o is not None and len(o) > 0:
-                    regStart = o[-1][1]
-                o = blackList.findOverlaps(chrom, reg[1], regEnd)
-                if o is not None and len(o) > 0:
-                    regEnd = o[0][0]
+            regStart, regEnd = window
 
             start_time = time.time()
             # caching seems faster. TODO: profile the function
@@ -833,74 +1502,55 @@ class CountReadsPerBin(object):
                         "chromosome {} not found in bigWig file with chroms {}".format(chrom, bamHandle.chroms())
                     )
 
-            prev_pos = set()
-            lpos = None  # of previous processed read pair
-
-            for read in bamHandle.fetch(chrom, regStart, regEnd):
-                if read.is_unmapped:
-                    continue
-                if self.minMappingQuality and read.mapq < self.minMappingQuality:
-                    continue
-
-                # filter reads based on SAM flag
-                if self.samFlag_include and read.flag & self.samFlag_include != self.samFlag_include:
-                    continue
-                if self.samFlag_exclude and read.flag & self.samFlag_exclude != 0:
-                    continue
-
-                # Fragment lengths
-                tLen = deeptools.utilities.getTLen(read)
-                if self.minFragmentLength > 0 and tLen < self.minFragmentLength:
-                    continue
-                if self.maxFragmentLength > 0 and tLen > self.maxFragmentLength:
-                    continue
-
-                # Motif filter
-                if self.motifFilter:
-                    test = [checkMotifs(read, chrom, twoBitGenome, m[0], m[1]) for m in self.motifFilter]
-                    if not any(test):
-                        continue
-                # GC content filter
-                if self.GCcontentFilter:
-                    if not checkGCcontent(read, self.GCcontentFilter[0], self.GCcontentFilter[1]):
-                        continue
-
-                # Aligned fraction filter
-                if self.minAlignedFraction:
-                    if not checkAlignedFraction(read, self.minAlignedFraction):
+            if windowReads is not None:
+                # the reads were fetched once for the window of nearby features
+                fragStarts, fragEnds, fragCols, fragReads, fragWeights, nWindowDuplicates = windowReads[
+                    (regStart, regEnd)
+                ].fragments(regStart, regEnd)
+                nDuplicates += nWindowDuplicates
+                fetched = []
+            else:
+                readFilter.reset()
+                readFilter.prefetch(chrom, regStart, regEnd)
+                fetched = bamHandle.fetch(chrom, regStart, regEnd)
+
+                # fragment (block) start, end, barcode column and read number of the fetched reads
+                fragStarts = []
+                fragEnds = []
+                fragCols = []
+                fragReads = []
+                fragWeights = []
+            for read in fetched:
+                nFetched += 1
+                # the fragment of a proper pair is counted twice (once per mate) from the left-most mate
+                weight = 1
+                if self.countFragmentsOnce and self.is_proper_pair(read, self.maxPairedFragmentLength):
+                    if read.is_reverse:
                         continue
+                    weight = 2
 
-                ## get barcode from read
+                ## get barcode (column) from read
                 try:
                     bc = read.get_tag(self.cellTag)
-                    if self.groupTag:
-                        grp = read.get_tag(self.groupTag)
-                        new_bc = "::".join([grp, bc])  # new barcode tag = sample+bc tag
-                        if new_bc not in self.groupLabels:
-                            if self.verbose:
-                                sys.stderr.write(
-                                    "Encountered group: {}, not in provided labels. skipping..".format(grp)
-                                )
-                            continue
+                    if useGroups:
+                        # new barcode = sample+bc tag
+                        col = barcodeIndex.get((read.get_tag(self.groupTag), bc))
                     else:
-                        new_bc = bc
+                        col = barcodeIndex.get(bc)
                 except KeyError:
+                    nNoBarcode += 1
                     continue
                 # also keep a counter for barcodes not in whitelist?
-                if bc not in self.barcodes:
+                if col is None:
+                    nNoBarcode += 1
                     if self.verbose:
-                        sys.stderr.write("Encountered barcode: {}, not in provided whitelist. skipping..".format(bc))
+                        sys.stderr.write(
+                            "Encountered barcode: {}, not in provided whitelist/labels. skipping..".format(bc)
+                        )
+                    continue
+                # read filters, and duplicate reads with same barcode, startpos and optionally, endpos/umi
+                if readFilter.check(read, chrom, col) is not None:
                     continue
-                # get rid of duplicate reads with same barcode, startpos and optionally, endpos/umi
-                if self.duplicateFilter:
-                    tup = getDupFilterTuple(read, new_bc, self.duplicateFilter)
-                    if lpos is not None:
-                        if tup in prev_pos:
-                            continue
-                        else:
-                            prev_pos.clear()
-                    lpos = read.reference_start
-                    prev_pos.add(tup)
 
                 # since reads can be split (e.g. RNA-seq reads) each part of the
                 # read that maps is called a position block.
@@ -912,64 +1562,51 @@ class CountReadsPerBin(object):
                     # Those cases are to be skipped, hence the continue line.
                     continue
 
-                last_eIdx = None
+                # collect the blocks of the read, they are assigned to bins below for the whole fetch
                 for fragmentStart, fragmentEnd in position_blocks:
                     if fragmentEnd is None or fragmentStart is None:
                         continue
-                    fragmentLength = fragmentEnd - fragmentStart
-                    if fragmentLength == 0:
-                        continue
-                    # skip reads that are not in the region being
-                    # evaluated.
-                    if fragmentEnd <= reg[0] or fragmentStart >= reg[1]:
-                        continue
+                    fragStarts.append(fragmentStart)
+                    fragEnds.append(fragmentEnd)
+                    fragCols.append(col)
+                    fragReads.append(c)
+                    fragWeights.append(weight)
+                c += 1
 
-                    if fragmentStart < reg[0]:
-                        fragmentStart = reg[0]
-                    if fragmentEnd > reg[0] + len(coverages[new_bc]) * tileSize:
-                        fragmentEnd = reg[0] + len(coverages[new_bc]) * tileSize
-                    sIdx = vector_start + max((fragmentStart - reg[0]) // tileSize, 0)
-                    eIdx = vector_start + min(
-                        np.ceil(float(fragmentEnd - reg[0]) / tileSize).astype("int"),
-                        nRegBins,
+            rows, cols, vals = self.get_bins_of_fragments(
+                fragStarts,
+                fragEnds,
+                fragCols,
+                fragReads,
+                reg,
+                tileSize,
+                nRegBins,
+                nbins,
+                fragWeights=fragWeights if self.countFragmentsOnce else None,
+            )
+            rows += vector_start
+            if self.sparseOutput:
+                # binarized counts are clipped to 1 once the chunk is done
+                cooBuffer.extend(rows, cols, vals)
+                # the same fragments, in the larger bins
+                for i, size in enumerate(self.additionalBinSizes):
+                    levelRows, levelCols, levelVals = self.get_bins_of_fragments(
+                        fragStarts,
+                        fragEnds,
+                        fragCols,
+                        fragReads,
+                        (reg[0], reg[1], size),
+                        size,
+                        levelBins[i],
+                        levelBins[i],
+                        fragWeights=fragWeights if self.countFragmentsOnce else None,
                     )
-                    if last_eIdx is not None:
-                        sIdx = max(last_eIdx, sIdx)
-                        if sIdx >= eIdx:
-                            continue
-                    sIdx = int(sIdx)
-                    eIdx = int(eIdx)
-                    ## if sumCoverage is asked (plotFingerPrint) do cumulative coverage on that bin
-                    ## cum coverage = total no of bases covered * num reads
-                    if self.sumCoveragePerBin:
-                        if fragmentEnd < reg[0] + (sIdx + 1) * tileSize:
-                            _ = fragmentEnd - fragmentStart
-                        else:
-                            _ = reg[0] + (sIdx + 1) * tileSize - fragmentStart
-                        if _ > tileSize:
-                            _ = tileSize
-                        coverages[new_bc][sIdx] += _
-                        _ = sIdx + 1
-                        while _ < eIdx:
-                            coverages[new_bc][_] += tileSize
-                            _ += 1
-                        while eIdx - sIdx >= nRegBins:
-                            eIdx -= 1
-                        if eIdx > sIdx:
-                            _ = fragmentEnd - (reg[0] + eIdx * tileSize)
-                            if _ > tileSize:
-                                _ = tileSize
-                            elif _ < 0:
-                                _ = 0
-                            coverages[new_bc][eIdx] += _
-                    elif self.binarizeCoverage:
-                        # only return 1, since frequencies are desired
-                        coverages[new_bc][sIdx:eIdx] = 1
-                    else:
-                        # for everything except plotFingerPrint, simply count the number of reads
-                        coverages[new_bc][sIdx:eIdx] += 1
-                    last_eIdx = eIdx
-                c += 1
+                    levelBuffers[i].extend(levelRows, levelCols, levelVals)
+            elif self.binarizeCoverage:
+                # only return 1, since frequencies are desired
+                coverages[cols, rows] = 1
+            else:
+                np.add.at(coverages, (cols, rows), vals.astype(coverages.dtype))
 
             if self.verbose:
                 endTime = time.time()
@@ -987,16 +1624,397 @@ class CountReadsPerBin(object):
 
             vector_start += nRegBins
 
+        if chunkStats is not None:
+            rejected = dict(readFilter.rejected, barcode=nNoBarcode)
+            rejected["duplicate"] = rejected.get("duplicate", 0) + nDuplicates
+            chunkStats.addReads(nFetched, rejected)
+
+        if self.sparseOutput:
+            coverages = cooBuffer.to_csr((nbins, len(barcodeIndex)))
+            if self.binarizeCoverage:
+                coverages.data[:] = 1
+            if self.additionalBinSizes:
+                coverages = [coverages]
+                for levelBuffer, nLevelBins in zip(levelBuffers, levelBins):
+                    coverages.append(levelBuffer.to_csr((nLevelBins, len(barcodeIndex))))
+                    if self.binarizeCoverage:
+                        coverages[-1].data[:] = 1
+            return coverages
+
         # change zeros to NAN
         if self.zerosToNans:
-            for new_bc in coverages.keys():
-                coverages[new_bc][coverages[new_bc] == 0] = np.nan
-        # close 2bit file if opened
-        if self.motifFilter and self.genome:
-            twoBitGenome.close()
+            coverages[coverages == 0] = np.nan
 
         return coverages
 
+    def get_read_filter(self, chrom, duplicateFilter=None):
+        r"""Returns the sincei.ReadFilter with the active read filters, and the given duplicate filter"""
+        # the 2bit genome is opened once per process
+        twoBitGenome = None
+        # raise error if motifs are to be checked but the chromosome in bam and 2bit don't match
+        if self.motifFilter and self.genome:
+            twoBitGenome = self.get_worker_resources()["twoBitGenome"]
+            if chrom not in twoBitGenome.chroms().keys():
+                raise NameError("chromosome {} not found in 2bit file".format(chrom))
+
+        # only the active filters are checked, the cheapest first (see sincei.ReadFilter)
+        return ReadFilter(
+            minMappingQuality=self.minMappingQuality,
+            samFlagInclude=self.samFlag_include,
+            samFlagExclude=self.samFlag_exclude,
+            minFragmentLength=self.minFragmentLength,
+            maxFragmentLength=self.maxFragmentLength,
+            minAlignedFraction=self.minAlignedFraction,
+            GCcontentFilter=self.GCcontentFilter,
+            motifFilter=self.motifFilter,
+            twoBitGenome=twoBitGenome,
+            duplicateFilter=duplicateFilter,
+            duplicateMode="last",
+        )
+
+    def get_fetch_window(self, chrom, reg):
+        r"""
+        Returns the (start, end) of the reads to fetch for the region ``reg``: the region extended
+        by the longest fragment if the reads are extended, up to the blacklisted regions. If the
+        region overlaps the blacklist, None is returned (its coverage is 0).
+
+        >>> c = CountReadsPerBin([], stepSize=1)
+        >>> c.get_fetch_window("chr1", (5000, 5100))
+        (5000, 5100)
+        >>> c.defaultFragmentLength, c.maxPairedFragmentLength = 300, 1200
+        >>> c.get_fetch_window("chr1", (5000, 5100))
+        (3800, 6300)
+        """
+        # the blacklist is opened once per process
+        blackList = self.get_worker_resources()["blackList"]
+        if blackList is not None and blackList.overlaps(chrom, reg[0], reg[1]):
+            return None
+
+        if self.defaultFragmentLength == "read length":
+            extension = 0
+        else:
+            extension = self.maxPairedFragmentLength
+        regStart = int(max(0, reg[0] - extension))
+        regEnd = reg[1] + int(extension)
+
+        # If alignments are extended and there's a blacklist, ensure that no
+        # reads originating in a blacklist are fetched
+        if blackList is not None and reg[0] > 0 and extension > 0:
+            o = blackList.findOverlaps(chrom, regStart, reg[0])
+            if len(o) > 0:
+                regStart = o[-1][1]
+            o = blackList.findOverlaps(chrom, reg[1], regEnd)
+            if len(o) > 0:
+                regEnd = o[0][0]
+        return regStart, regEnd
+
+    def get_window_reads(self, bamHandle, chrom, regions, fragmentFromRead_func=None, chunkStats=None):
+        r"""
+        Fetches the reads of the features in ``regions`` once per window of nearby features: the
+        fetch windows of the features (see get_fetch_window) are sorted, and merged while they are
+        closer than ``featureMergeDistance``. Only the reads overlapping the fetch window of one of
+        the features are filtered and kept.
+
+        Returns a dict mapping the fetch window of each feature to the WindowReads of its window,
+        to be given to get_coverage_of_region.
+
+        >>> test = Tester()
+        >>> import pysam
+        >>> c = CountReadsPerBin([], stepSize=1, extendReads=300, featureMergeDistance=0)
+        >>> bam = pysam.AlignmentFile(test.bamFile_PE)
+        >>> windowReads = c.get_window_reads(bam, 'chr2', [(5000833, 5000834), (5000834, 5000835)])
+        >>> len(windowReads), len(set(windowReads.values()))
+        (2, 1)
+        >>> c.get_coverage_of_region(bam, 'chr2', [(5000833, 5000834), (5000834, 5000835)], windowReads=windowReads)
+        array([4., 5.])
+        """
+        if not fragmentFromRead_func:
+            fragmentFromRead_func = self.get_fragment_from_read
+        if chrom not in bamHandle.references:
+            raise NameError("chromosome {} not found in bam file".format(chrom))
+        barcodeIndex = self.barcodeIndex
+        useGroups = self.groupTag and self.groupLabels
+
+        featureWindows = set()
+        for reg in regions:
+            window = self.get_fetch_window(chrom, reg)
+            if window is not None:
+                featureWindows.add(window)
+        featureWindows = sorted(featureWindows)
+
+        # the duplicates are removed per feature, from the keys of the reads (see WindowReads)
+        readFilter = self.get_read_filter(chrom)
+        dupFilter = DuplicateFilter(self.duplicateFilter, mode="last") if self.duplicateFilter else None
+
+        windowReads = {}
+        nFetched = 0
+        nNoBarcode = 0
+        i = 0
+        while i < len(featureWindows):
+            # sweep over the sorted feature windows, and merge those closer than featureMergeDistance
+            windowStart, windowEnd = featureWindows[i]
+            j = i + 1
+            while j < len(featureWindows) and featureWindows[j][0] <= windowEnd + self.featureMergeDistance:
+                windowEnd = max(windowEnd, featureWindows[j][1])
+                j += 1
+            # feature window starts, and the largest end seen up to each of them
+            starts = [x[0] for x in featureWindows[i:j]]
+            maxEnds = np.maximum.accumulate([x[1] for x in featureWindows[i:j]])
+
+            reads = WindowReads()
+            readFilter.prefetch(chrom, windowStart, windowEnd)
+            for read in bamHandle.fetch(chrom, windowStart, windowEnd):
+                nFetched += 1
+                # reads in the gaps between the features are not needed
+                spanStart = read.reference_start
+                spanEnd = read.reference_end or spanStart + 1
+                k = bisect.bisect_left(starts, spanEnd)
+                if k == 0 or maxEnds[k - 1] <= spanStart:
+                    continue
+
+                # the fragment of a proper pair is counted twice (once per mate) from the left-most mate
+                weight = 1
+                if self.countFragmentsOnce and self.is_proper_pair(read, self.maxPairedFragmentLength):
+                    if read.is_reverse:
+                        continue
+                    weight = 2
+
+                try:
+                    bc = read.get_tag(self.cellTag)
+                    if useGroups:
+                        col = barcodeIndex.get((read.get_tag(self.groupTag), bc))
+                    else:
+                        col = barcodeIndex.get(bc)
+                except KeyError:
+                    nNoBarcode += 1
+                    continue
+                if col is None:
+                    nNoBarcode += 1
+                    continue
+                if readFilter.check(read, chrom) is not None:
+                    continue
+
+                key = dupFilter.key(read, col) if dupFilter is not None else None
+                try:
+                    blocks = fragmentFromRead_func(read)
+                except TypeError:
+                    # the read still counts for the duplicates of the next read
+                    blocks = []
+                reads.add(spanStart, spanEnd, key, col, weight, blocks)
+
+            for window in featureWindows[i:j]:
+                windowReads[window] = reads
+            i = j
+
+        if chunkStats is not None:
+            chunkStats.addReads(nFetched, dict(readFilter.rejected, barcode=nNoBarcode))
+        return windowReads
+
+    def get_coverage_of_features(self, chrom, transcripts, windowReads, chunkStats=None):
+        r"""
+        Returns the counts of the features (a CSR matrix with rows = features, and the barcodes of
+        each bam file as columns) from the reads fetched per window by get_window_reads (one dict per
+        bam file). The counts are the same as those of get_coverage_of_region for each feature (the
+        counts of its blocks are summed), but all fragments are assigned to the features at once.
+
+        >>> test = Tester()
+        >>> import pysam
+        >>> c = CountReadsPerBin([], stepSize=1, extendReads=300, sparseOutput=True, featureMergeDistance=0)
+        >>> features = [[(5000833, 5000834), (5000834, 5000835)], [(5000090, 5000100)]]
+        >>> windowReads = c.get_window_reads(pysam.AlignmentFile(test.bamFile_PE), 'chr2', features[0] + features[1])
+        >>> c.get_coverage_of_features('chr2', features, [windowReads]).toarray()
+        array([[9],
+               [1]])
+        """
+        nCells = len(self.barcodeIndex)
+        nBlocks = sum(len(trans) for trans in transcripts)
+        cooBuffer = CooBuffer(dtype=np.uint32 if self.countDtype else np.int64)
+        nDuplicates = 0
+        block = 0
+        for trans in transcripts:
+            for reg in trans:
+                window = self.get_fetch_window(chrom, reg)
+                if window is not None:
+                    for bamIdx, bamWindowReads in enumerate(windowReads):
+                        fragStarts, fragEnds, fragCols, fragReads, fragWeights, nWindowDuplicates = bamWindowReads[
+                            window
+                        ].fragments(*window)
+                        nDuplicates += nWindowDuplicates
+                        # each block is a single bin
+                        rows, cols, vals = self.get_bins_of_fragments(
+                            fragStarts,
+                            fragEnds,
+                            fragCols,
+                            fragReads,
+                            reg,
+                            int(reg[1] - reg[0]),
+                            1,
+                            len(trans),
+                            fragWeights=fragWeights if self.countFragmentsOnce else None,
+                        )
+                        cooBuffer.extend(rows + block, cols + bamIdx * nCells, vals)
+                block += 1
+
+        if chunkStats is not None:
+            chunkStats.addReads(0, {"duplicate": nDuplicates})
+        counts = cooBuffer.to_csr((nBlocks, nCells * len(windowReads)))
+        if self.binarizeCoverage:
+            counts.data[:] = 1
+        # sum the blocks of each feature
+        blockFeature = np.repeat(np.arange(len(transcripts)), [len(trans) for trans in transcripts])
+        features = sparse.csr_matrix(
+            (np.ones(nBlocks, dtype=np.int64), (blockFeature, np.arange(nBlocks))),
+            shape=(len(transcripts), nBlocks),
+        )
+        return features @ counts
+
+    def get_bins_of_fragments(
+        self, fragStarts, fragEnds, fragCols, fragReads, reg, tileSize, nRegBins, nbins, fragWeights=None
+    ):
+        r"""
+        Assigns the fragments (or blocks of split reads) collected from one fetch to the bins
+        of the region ``reg`` using vectorized operations.
+
+        The blocks of one read are counted only once per bin. Depending on ``sumCoveragePerBin``
+        the value of each (bin, barcode) entry is either the number of reads or the number
+        of bases covered in the bin.
+
+        Parameters
+        ----------
+        fragStarts, fragEnds : list
+            start and end positions of the fragments
+        fragCols : list
+            barcode column of each fragment
+        fragReads : list
+            read number of each fragment, blocks of the same read must be consecutive
+        reg : tuple
+            (start, end), (start, end, tileSize) or (start, end, tileSize, stepSize) of the region,
+            with a stepSize the bins are windows starting every stepSize bp (they can overlap)
+        tileSize : int
+            length of the bins in the region
+        nRegBins : int
+            number of bins in the region
+        nbins : int
+            total number of bins of all regions, used to trim the fragment ends
+        fragWeights : list
+            optional number of reads represented by each fragment (see ``countFragmentsOnce``)
+
+        Returns
+        -------
+        tuple
+            bin index (relative to the region start), barcode column and value of each entry.
+            Entries are not summed, the same (bin, barcode) can be repeated.
+
+        >>> c = CountReadsPerBin([], 10, stepSize=10)
+        >>> rows, cols, vals = c.get_bins_of_fragments([5, 12, 40, 44], [25, 18, 42, 46], [0, 1, 0, 0],
+        ...                                            [0, 1, 2, 2], (0, 50, 10), 10, 5, 5)
+        >>> rows, cols, vals
+        (array([0, 1, 2, 1, 4]), array([0, 0, 0, 1, 0]), array([1, 1, 1, 1, 1]))
+        >>> c.sumCoveragePerBin = True
+        >>> rows, cols, vals = c.get_bins_of_fragments([5, 12], [25, 18], [0, 1], [0, 1], (0, 50, 10), 10, 5, 5)
+        >>> rows, cols, vals
+        (array([0, 1, 2, 1]), array([0, 0, 0, 1]), array([ 5, 10, 10,  6]))
+        >>> rows, cols, vals = c.get_bins_of_fragments([5], [25], [0], [0], (0, 50, 10), 10, 5, 5, fragWeights=[2])
+        >>> vals
+        array([10, 20, 20])
+
+        Windows of 10 bp every 5 bp, the fragments are counted in all the windows they overlap
+
+        >>> c.sumCoveragePerBin = False
+        >>> rows, cols, vals = c.get_bins_of_fragments([5, 23], [12, 24], [0, 1], [0, 1], (0, 30, 10, 5), 10, 5, 5)
+        >>> rows, cols
+        (array([0, 1, 2, 3, 4]), array([0, 0, 0, 1, 1]))
+        """
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        if len(fragStarts) == 0:
+            return empty
+        fStart = np.asarray(fragStarts)
+        fEnd = np.asarray(fragEnds)
+        fCol = np.asarray(fragCols, dtype=np.int64)
+        fRead = np.asarray(fragReads, dtype=np.int64)
+        fWeight = None if fragWeights is None else np.asarray(fragWeights, dtype=np.int64)
+
+        # windows starting every stepSize bp, instead of tiles
+        stepSize = int(reg[3]) if len(reg) == 4 else None
+
+        # skip empty fragments and fragments that are not in the region being evaluated.
+        keep = (fEnd - fStart != 0) & (fEnd > reg[0]) & (fStart < reg[1])
+        fStart = np.maximum(fStart[keep], reg[0])
+        fEnd = np.minimum(fEnd[keep], reg[0] + nbins * tileSize if stepSize is None else reg[1])
+        fCol = fCol[keep]
+        fRead = fRead[keep]
+        if fWeight is not None:
+            fWeight = fWeight[keep]
+        if len(fStart) == 0:
+            return empty
+
+        if stepSize is None:
+            sIdx = np.maximum((fStart - reg[0]) // tileSize, 0).astype(np.int64)
+            # ceil division, fragment ends are exclusive
+            eIdx = np.minimum(-(-(fEnd - reg[0]) // tileSize), nRegBins).astype(np.int64)
+        else:
+            # the first window ending after the fragment start, and the last one starting before its end
+            sIdx = np.maximum(-(-(fStart - reg[0] - tileSize + 1) // stepSize), 0).astype(np.int64)
+            eIdx = np.minimum((fEnd - reg[0] - 1) // stepSize + 1, nRegBins).astype(np.int64)
+
+        # blocks of the same read should not count a bin twice: the start of a block is moved
+        # to the largest end of the previous blocks of that read (grouped cumulative maximum)
+        firstBlock = np.ones(len(fRead), dtype=bool)
+        firstBlock[1:] = fRead[1:] != fRead[:-1]
+        if not firstBlock.all():
+            offset = fRead * (nRegBins + 2)
+            lastEnd = np.maximum.accumulate(eIdx + offset) - offset
+            prevEnd = np.empty_like(lastEnd)
+            prevEnd[0] = 0
+            prevEnd[1:] = lastEnd[:-1]
+            sIdx = np.where(firstBlock, sIdx, np.maximum(sIdx, prevEnd))
+            ok = firstBlock | (sIdx < eIdx)
+            sIdx, eIdx, fStart, fEnd, fCol = sIdx[ok], eIdx[ok], fStart[ok], fEnd[ok], fCol[ok]
+            if fWeight is not None:
+                fWeight = fWeight[ok]
+
+        # expand each fragment to all the bins it overlaps
+        nCovered = np.maximum(eIdx - sIdx, 0)
+        rows = np.repeat(sIdx, nCovered) + (
+            np.arange(nCovered.sum()) - np.repeat(np.cumsum(nCovered) - nCovered, nCovered)
+        )
+        cols = np.repeat(fCol, nCovered)
+
+        if not self.sumCoveragePerBin:
+            if fWeight is not None:
+                return rows, cols, np.repeat(fWeight, nCovered)
+            return rows, cols, np.ones(len(rows), dtype=np.int64)
+
+        ## if sumCoverage is asked (plotFingerPrint) do cumulative coverage on that bin
+        ## cum coverage = total no of bases covered * num reads
+        if stepSize is not None:
+            # bases of the fragment in each window
+            windowStart = reg[0] + rows * stepSize
+            vals = np.minimum(np.repeat(fEnd, nCovered), windowStart + tileSize) - np.maximum(
+                np.repeat(fStart, nCovered), windowStart
+            )
+            if fWeight is not None:
+                vals = vals * np.repeat(fWeight, nCovered)
+            return rows, cols, vals
+        # first bin: bases covered by the fragment, the following bins are fully covered
+        firstEnd = reg[0] + (sIdx + 1) * tileSize
+        firstVal = np.minimum(np.where(fEnd < firstEnd, fEnd - fStart, firstEnd - fStart), tileSize)
+        isFirst = np.zeros(len(rows), dtype=bool)
+        isFirst[np.cumsum(nCovered)[nCovered > 0] - nCovered[nCovered > 0]] = True
+        vals = np.full(len(rows), tileSize, dtype=firstVal.dtype)
+        vals[isFirst] = firstVal[nCovered > 0]
+        # the last bin gets the bases that overlap it
+        lastIdx = np.minimum(eIdx, sIdx + nRegBins - 1)
+        lastVal = np.clip(fEnd - (reg[0] + lastIdx * tileSize), 0, tileSize)
+        useLast = (lastIdx > sIdx) & (lastVal > 0) & (lastIdx < nRegBins)
+        if fWeight is not None:
+            vals = vals * np.repeat(fWeight, nCovered)
+            lastVal = lastVal * fWeight
+        rows = np.concatenate([rows, lastIdx[useLast]])
+        cols = np.concatenate([cols, fCol[useLast]])
+        vals = np.concatenate([vals, lastVal[useLast]])
+        return rows, cols, vals
+
     def getReadLength(self, read):
         return len(read)
 
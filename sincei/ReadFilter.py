@@ -0,0 +1,197 @@
+from collections import OrderedDict
+from deeptools.utilities import getTLen
+
+from sincei.Utilities import MotifChecker, checkGCcontent, checkAlignedFraction, DuplicateFilter
+
+## Read filters shared by CountReadsPerBin (scCountReads), scBAMops, scFilterStats and GetStats
+
+# relative cost of each check, the cheapest ones are evaluated first
+FILTER_COSTS = {
+    "unmapped": 0,
+    "minMappingQuality": 1,
+    "samFlagInclude": 1,
+    "samFlagExclude": 1,
+    "markedDuplicate": 1,
+    "singleton": 1,
+    "filterRNAstrand": 1,
+    "fragmentLength": 2,
+    "blacklist": 3,
+    "minAlignedFraction": 4,
+    "GCcontent": 5,
+    "motif": 6,
+}
+
+
+def passesRNAstrand(read, filterRNAstrand):
+    r"""
+    Returns True if the read comes from the given strand (forward/reverse) of a
+    dUTP-based (reverse stranded) RNA-seq library.
+    """
+    if read.is_paired:
+        if filterRNAstrand == "forward":
+            return read.flag & 144 == 128 or read.flag & 96 == 64
+        return read.flag & 144 == 144 or read.flag & 96 == 96
+    if filterRNAstrand == "forward":
+        return read.flag & 16 == 16
+    return read.flag & 16 == 0
+
+
+class ReadFilter(object):
+    r"""
+    Ordered list of the active read filters.
+
+    Only the filters that are switched on are kept, sorted from the cheapest to the most
+    expensive check (see FILTER_COSTS). The duplicate filter is always evaluated last, so
+    that only reads passing all other filters are recorded as originals. The number of
+    reads rejected by each filter is kept in `rejected`.
+
+    Parameters
+    ----------
+    minMappingQuality : int
+        Minimum mapping quality.
+    samFlagInclude : int
+        SAM flags that must be set.
+    samFlagExclude : int
+        SAM flags that must not be set.
+    minFragmentLength : int
+        Minimum fragment length (0 to skip).
+    maxFragmentLength : int
+        Maximum fragment length (0 to skip).
+    blackList : sincei.Utilities.BlacklistIndex
+        Reads overlapping a blacklisted region are rejected.
+    minAlignedFraction : float
+        Minimum fraction of the read aligned to the genome.
+    GCcontentFilter : list
+        Lower and upper bound of the GC content of the reads.
+    motifFilter : list
+        List of [readMotif, refMotif] pairs, reads with none of the motifs are rejected.
+    twoBitGenome : py2bit object
+        The opened genome, needed for the motif filter.
+    filterRNAstrand : str
+        forward or reverse, see --filterRNAstrand.
+    filterMarkedDuplicates : bool
+        Reject reads flagged as duplicate in the BAM file.
+    filterSingletons : bool
+        Reject paired reads with unmapped mates.
+    duplicateFilter : str
+        Type of duplicate filter (see --duplicateFilter).
+    duplicateMode : str
+        How duplicates are detected, see sincei.Utilities.DuplicateFilter.
+
+    Examples
+    --------
+
+    >>> import pysam
+    >>> read = pysam.AlignedSegment()
+    >>> read.reference_id, read.reference_start, read.cigarstring, read.mapping_quality = 0, 100, "50M", 5
+    >>> rf = ReadFilter(minMappingQuality=10, maxFragmentLength=1000, duplicateFilter="start_bc")
+    >>> list(rf.filters)
+    ['unmapped', 'minMappingQuality', 'fragmentLength', 'duplicate']
+    >>> rf.check(read, "chr1", "AAC")
+    'minMappingQuality'
+    >>> read.mapping_quality = 30
+    >>> rf.check(read, "chr1", "AAC"), rf.check(read, "chr1", "AAC")
+    (None, 'duplicate')
+    >>> rf.rejected
+    {'minMappingQuality': 1, 'duplicate': 1}
+    """
+
+    def __init__(
+        self,
+        minMappingQuality=None,
+        samFlagInclude=None,
+        samFlagExclude=None,
+        minFragmentLength=0,
+        maxFragmentLength=0,
+        blackList=None,
+        minAlignedFraction=None,
+        GCcontentFilter=None,
+        motifFilter=None,
+        twoBitGenome=None,
+        filterRNAstrand=None,
+        filterMarkedDuplicates=False,
+        filterSingletons=False,
+        duplicateFilter=None,
+        duplicateMode="position",
+    ):
+        # each check returns True if the read passes it
+        checks = {"unmapped": lambda read, chrom: not read.flag & 4}
+        if minMappingQuality:
+            checks["minMappingQuality"] = lambda read, chrom: read.mapping_quality >= minMappingQuality
+        if samFlagInclude:
+            checks["samFlagInclude"] = lambda read, chrom: read.flag & samFlagInclude == samFlagInclude
+        if samFlagExclude:
+            checks["samFlagExclude"] = lambda read, chrom: read.flag & samFlagExclude == 0
+        if filterMarkedDuplicates:
+            checks["markedDuplicate"] = lambda read, chrom: not read.is_duplicate
+        if filterSingletons:
+            checks["singleton"] = lambda read, chrom: not (read.is_paired and read.mate_is_unmapped)
+        if filterRNAstrand:
+            checks["filterRNAstrand"] = lambda read, chrom: passesRNAstrand(read, filterRNAstrand)
+        if (minFragmentLength and minFragmentLength > 0) or (maxFragmentLength and maxFragmentLength > 0):
+            minLen = minFragmentLength if minFragmentLength and minFragmentLength > 0 else 0
+            maxLen = maxFragmentLength if maxFragmentLength and maxFragmentLength > 0 else float("inf")
+            checks["fragmentLength"] = lambda read, chrom: minLen <= getTLen(read) <= maxLen
+        if blackList is not None:
+            checks["blacklist"] = lambda read, chrom: not blackList.overlaps(
+                chrom,
+                read.reference_start,
+                read.reference_start + read.infer_query_length(always=False) - 1,
+            )
+        if minAlignedFraction:
+            checks["minAlignedFraction"] = lambda read, chrom: checkAlignedFraction(read, minAlignedFraction)
+        if GCcontentFilter:
+            low, high = GCcontentFilter[0], GCcontentFilter[1]
+            checks["GCcontent"] = lambda read, chrom: checkGCcontent(read, low, high)
+        self.motifChecker = None
+        if motifFilter:
+            # all motifs are checked at once, on the reference loaded per chunk
+            self.motifChecker = MotifChecker(twoBitGenome, motifFilter)
+            checks["motif"] = self.motifChecker.check
+
+        self.filters = OrderedDict(sorted(checks.items(), key=lambda x: FILTER_COSTS[x[0]]))
+        self._checks = list(self.filters.items())
+        self.dupFilter = None
+        if duplicateFilter:
+            self.dupFilter = DuplicateFilter(duplicateFilter, mode=duplicateMode)
+            self.filters["duplicate"] = self.dupFilter.isDuplicate
+        self.rejected = {}
+
+    def _reject(self, name):
+        self.rejected[name] = self.rejected.get(name, 0) + 1
+
+    def check(self, read, chrom, bc=None):
+        r"""
+        Returns the name of the first filter rejecting the read, or None if the read passes
+        all filters. The barcode (bc) is only used to detect duplicates.
+        """
+        for name, passes in self._checks:
+            if not passes(read, chrom):
+                self._reject(name)
+                return name
+        if self.dupFilter is not None and self.dupFilter.isDuplicate(read, bc):
+            self._reject("duplicate")
+            return "duplicate"
+        return None
+
+    def checkAll(self, read, chrom, bc=None):
+        r"""
+        Evaluates all filters and returns the list of the names of those rejecting the read
+        (as needed to report per filter statistics).
+        """
+        failed = [name for name, passes in self._checks if not passes(read, chrom)]
+        if self.dupFilter is not None and self.dupFilter.isDuplicate(read, bc):
+            failed.append("duplicate")
+        for name in failed:
+            self._reject(name)
+        return failed
+
+    def prefetch(self, chrom, start, end):
+        r"""Loads the data needed by the filters for the given region (the reference sequence for the motifs)"""
+        if self.motifChecker is not None:
+            self.motifChecker.prefetch(chrom, start, end)
+
+    def reset(self):
+        r"""Forgets the previously seen reads of the duplicate filter, e.g. when starting a new region"""
+        if self.dupFilter is not None:
+            self.dupFilter.reset()
@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+
+
+class Regions(object):
+    r"""Columnar list of the genomic regions (bins or BED/GTF features) counted by CountReadsPerBin.
+
+    The regions are stored as typed arrays: a categorical chromosome, start and end
+    positions (int32, or int64 for very large chromosomes) and optional names. Regions made
+    of several blocks (e.g. exons) keep their comma separated block starts and ends.
+    The string names (``chrom_start_end::name``) used as row names of the output are only
+    generated when needed, by the `index` property.
+
+    >>> r = Regions.from_tiles("chr1", 0, 250, 100)
+    >>> len(r)
+    3
+    >>> r.index.tolist()
+    ['chr1_0_100::None', 'chr1_100_200::None', 'chr1_200_250::None']
+    >>> r = Regions.concat([r[:1], Regions(["chr2"], [10], [20], name=["geneA"])])
+    >>> r.to_dataframe()
+                      chrom  start  end   name
+    chr1_0_100::None   chr1      0  100   None
+    chr2_10_20::geneA  chr2     10   20  geneA
+
+    Arrays of the names are also obtained via numpy
+
+    >>> np.asarray(r)
+    array(['chr1_0_100::None', 'chr2_10_20::geneA'], dtype=object)
+    """
+
+    def __init__(self, chrom, start, end, name=None, blockStarts=None, blockEnds=None):
+        start = np.asarray(start)
+        end = np.asarray(end)
+        if isinstance(chrom, str):
+            chrom = pd.Categorical.from_codes(np.zeros(len(start), dtype="int32"), categories=[chrom])
+        self.chrom = pd.Categorical(chrom)
+        self.start = start.astype(self._int_dtype(end))
+        self.end = end.astype(self._int_dtype(end))
+        # None if no region has a name
+        self.name = None if name is None else np.asarray(name, dtype=object)
+        # None if no region has multiple blocks, otherwise None for single block regions
+        self.blockStarts = None if blockStarts is None else np.asarray(blockStarts, dtype=object)
+        self.blockEnds = None if blockEnds is None else np.asarray(blockEnds, dtype=object)
+        self._index = None
+
+    @staticmethod
+    def _int_dtype(end):
+        if len(end) and end.max() > np.iinfo(np.int32).max:
+            return np.int64
+        return np.int32
+
+    @classmethod
+    def from_tiles(cls, chrom, start, end, tileSize, name=None):
+        r"""Returns the tiles of size tileSize between start and end (the last tile can be shorter)"""
+        starts = np.arange(start, end, tileSize)
+        ends = np.minimum(starts + tileSize, end)
+        if name is not None:
+            name = np.full(len(starts), name, dtype=object)
+        return cls(chrom, starts, ends, name=name)
+
+    @classmethod
+    def from_windows(cls, chrom, start, end, windowSize, stepSize, name=None):
+        r"""Returns the windows of size windowSize starting every stepSize bp, and ending before end
+
+        >>> Regions.from_windows("chr1", 100, 250, 100, 50).index.tolist()
+        ['chr1_100_200::None', 'chr1_150_250::None']
+        """
+        starts = np.arange(start, end - windowSize + 1, stepSize)
+        if name is not None:
+            name = np.full(len(starts), name, dtype=object)
+        return cls(chrom, starts, starts + windowSize, name=name)
+
+    @classmethod
+    def from_blocks(cls, chrom, regions, name=None):
+        r"""Returns the regions given as lists of (start, end) blocks
+
+        >>> Regions.from_blocks("chr1", [[(10, 20), (30, 40)], [(50, 60)]], name=["tx1", "tx2"]).index.tolist()
+        ['chr1_10,30_20,40::tx1', 'chr1_50_60::tx2']
+        """
+        start = [min(x[0] for x in blocks) for blocks in regions]
+        end = [max(x[1] for x in blocks) for blocks in regions]
+        blockStarts = blockEnds = None
+        if any(len(blocks) > 1 for blocks in regions):
+            blockStarts = [",".join([str(x[0]) for x in blocks]) if len(blocks) > 1 else None for blocks in regions]
+            blockEnds = [",".join([str(x[1]) for x in blocks]) if len(blocks) > 1 else None for blocks in regions]
+        return cls(chrom, start, end, name=name, blockStarts=blockStarts, blockEnds=blockEnds)
+
+    @classmethod
+    def concat(cls, regionsList):
+        r"""Concatenates a list of Regions"""
+        regionsList = [x for x in regionsList if x is not None]
+        if len(regionsList) == 0:
+            return cls([], [], [])
+        chrom = pd.api.types.union_categoricals([x.chrom for x in regionsList])
+        end = np.concatenate([x.end for x in regionsList])
+        start = np.concatenate([x.start for x in regionsList])
+
+        def _concat_optional(arrays):
+            if all(x is None for x in arrays):
+                return None
+            return np.concatenate(
+                [np.full(len(r), None, dtype=object) if x is None else x for r, x in zip(regionsList, arrays)]
+            )
+
+        return cls(
+            chrom,
+            start,
+            end,
+            name=_concat_optional([x.name for x in regionsList]),
+            blockStarts=_concat_optional([x.blockStarts for x in regionsList]),
+            blockEnds=_concat_optional([x.blockEnds for x in regionsList]),
+        )
+
+    def __len__(self):
+        return len(self.start)
+
+    def __getitem__(self, key):
+        def _take(x):
+            return None if x is None else x[key]
+
+        return Regions(
+            self.chrom[key],
+            self.start[key],
+            self.end[key],
+            name=_take(self.name),
+            blockStarts=_take(self.blockStarts),
+            blockEnds=_take(self.blockEnds),
+        )
+
+    @property
+    def index(self):
+        r"""Names of the regions, in the format chrom_start_end::name (generated on first use)"""
+        if self._index is None:
+            chrom = pd.Series(self.chrom, dtype=object).astype(str)
+            start = pd.Series(self.start).astype(str)
+            end = pd.Series(self.end).astype(str)
+            if self.blockStarts is not None:
+                isBlock = pd.notna(self.blockStarts)
+                start[isBlock] = self.blockStarts[isBlock]
+                end[isBlock] = self.blockEnds[isBlock]
+            name = pd.Series(self.names(), dtype=object).astype(str)
+            self._index = (chrom + "_" + start + "_" + end + "::" + name).to_numpy(dtype=object)
+        return self._index
+
+    def names(self):
+        r"""Returns the names of the regions, "None" for regions without name"""
+        if self.name is None:
+            return np.full(len(self), "None", dtype=object)
+        return np.where(pd.isna(self.name), "None", self.name).astype(object)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.index if dtype is None else self.index.astype(dtype)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def to_dataframe(self):
+        r"""Returns the regions as a DataFrame (chrom, start, end, name), indexed by the region names"""
+        return pd.DataFrame(
+            {
+                "chrom": self.chrom,
+                "start": self.start,
+                "end": self.end,
+                "name": pd.Categorical(self.names()),
+            },
+            index=pd.Index(self.index, dtype=object),
+        )
+
+    def to_arrays(self, prefix="regions_"):
+        r"""Returns a dict of numpy arrays (without python objects) from which the regions can be restored"""
+        arrays = {
+            prefix + "chrom_codes": self.chrom.codes,
+            prefix + "chrom_categories": np.asarray(self.chrom.categories, dtype=str),
+            prefix + "start": self.start,
+            prefix + "end": self.end,
+        }
+        for key in ["name", "blockStarts", "blockEnds"]:
+            values = getattr(self, key)
+            if values is not None:
+                # store missing values as empty strings
+                arrays[prefix + key] = np.where(pd.isna(values), "", values).astype(str)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix="regions_"):
+        r"""Restores the regions from the arrays returned by `to_arrays`
+
+        >>> r = Regions.from_blocks("chr1", [[(10, 20), (30, 40)]], name=["tx1"])
+        >>> r2 = Regions.from_arrays(r.to_arrays())
+        >>> r2.index.tolist()
+        ['chr1_10,30_20,40::tx1']
+        """
+        chrom = pd.Categorical.from_codes(
+            arrays[prefix + "chrom_codes"], categories=arrays[prefix + "chrom_categories"].tolist()
+        )
+        optional = {}
+        for key in ["name", "blockStarts", "blockEnds"]:
+            if prefix + key in arrays:
+                values = arrays[prefix + key].astype(object)
+                values[values == ""] = None
+                optional[key] = values
+        return cls(chrom, arrays[prefix + "start"], arrays[prefix + "end"], **optional)
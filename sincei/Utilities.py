@@ -1,5 +1,6 @@
-from itertools import compress
-from deeptools.utilities import getTLen
+from functools import lru_cache
+from deeptools.utilities import getTLen, mungeChromosome
+from deeptoolsintervals import GTF
 import numpy as np
 import sys
 
@@ -11,6 +12,94 @@ def checkBAMtag(bam, name, tag):
     return None
 
 
+class BlacklistIndex(object):
+    r"""Blacklisted regions as sorted, non-overlapping interval arrays per chromosome.
+
+    The blacklist (BED/GTF) is parsed once, overlapping intervals are merged, and overlaps
+    are then looked up with a binary search, for single regions or for arrays of regions.
+    As for deeptoolsintervals.GTF, the intervals and queries are half-open and chromosome
+    names are matched with or without the "chr" prefix.
+
+    >>> import tempfile
+    >>> f = tempfile.NamedTemporaryFile(mode="w", suffix=".bed", delete=False)
+    >>> _ = f.write("chr1\t100\t200\nchr1\t150\t300\nchr1\t500\t600\n")
+    >>> f.close()
+    >>> bl = BlacklistIndex(f.name)
+    >>> bl.overlaps("chr1", 50, 100), bl.overlaps("1", 299, 400), bl.overlaps("chr2", 0, 1000)
+    (False, True, False)
+    >>> bl.overlapsArray("chr1", np.array([0, 200, 300, 550]), np.array([100, 250, 500, 650]))
+    array([False,  True, False,  True])
+    >>> bl.findOverlaps("chr1", 0, 550)
+    [(100, 300), (500, 600)]
+    """
+
+    def __init__(self, blackListFileName):
+        # one file name, or a list of them
+        gtf = GTF(blackListFileName)
+        self.intervals = {}
+        for chrom in gtf.chroms:
+            o = gtf.findOverlaps(chrom, 0, np.iinfo(np.int64).max)
+            if not o:
+                continue
+            o = sorted((x[0], x[1]) for x in o)
+            # merge overlapping intervals
+            starts = [o[0][0]]
+            ends = [o[0][1]]
+            for start, end in o[1:]:
+                if start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.intervals[chrom] = (np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+
+    def get(self, chrom):
+        r"""Returns the (starts, ends) arrays of a chromosome, or None if it has no blacklisted regions"""
+        if chrom not in self.intervals:
+            chrom = mungeChromosome(chrom, self.intervals.keys())
+        return self.intervals.get(chrom)
+
+    def overlapsArray(self, chrom, starts, ends):
+        r"""Returns a boolean array, True for the regions [starts, ends) that overlap a blacklisted region"""
+        intervals = self.get(chrom)
+        if intervals is None:
+            return np.zeros(len(starts), dtype=bool)
+        # first blacklisted region ending after the region start
+        idx = np.searchsorted(intervals[1], starts, side="right")
+        mask = idx < len(intervals[0])
+        mask[mask] = intervals[0][idx[mask]] < np.asarray(ends)[mask]
+        return mask
+
+    def overlaps(self, chrom, start, end):
+        r"""Returns True if the region [start, end) overlaps a blacklisted region"""
+        intervals = self.get(chrom)
+        if intervals is None:
+            return False
+        idx = intervals[1].searchsorted(start, side="right")
+        return bool(idx < len(intervals[0]) and intervals[0][idx] < end)
+
+    def findOverlaps(self, chrom, start, end):
+        r"""Returns the (merged) blacklisted regions overlapping [start, end) as a list of (start, end)"""
+        intervals = self.get(chrom)
+        if intervals is None:
+            return []
+        first = intervals[1].searchsorted(start, side="right")
+        last = intervals[0].searchsorted(end, side="left")
+        return [(int(s), int(e)) for s, e in zip(intervals[0][first:last], intervals[1][first:last])]
+
+
+def getBlacklistIndex(blackListFileName):
+    r"""Returns the BlacklistIndex of a file (or list of files), which is built only once per process"""
+    if isinstance(blackListFileName, (list, tuple)):
+        blackListFileName = tuple(blackListFileName)
+    return _getBlacklistIndex(blackListFileName)
+
+
+@lru_cache(maxsize=None)
+def _getBlacklistIndex(blackListFileName):
+    return BlacklistIndex(list(blackListFileName) if isinstance(blackListFileName, tuple) else blackListFileName)
+
+
 def checkMotifs(read, chrom, genome, readMotif, refMotif):
     """
     Check whether a given motif is present in the read and the corresponding reference genome.
@@ -68,6 +157,116 @@ def checkMotifs(read, chrom, genome, readMotif, refMotif):
         return False
 
 
+class MotifChecker(object):
+    r"""
+    Checks the read and reference motifs of reads (see checkMotifs) for several motifs
+    at once, on reference sequence loaded in memory.
+
+    The reference is read from the 2bit file once per window (by default the chunk given
+    to `prefetch`, plus a margin), and the reference motifs of the reads are then sliced
+    from it. Reads outside of the loaded window trigger the loading of the next window.
+
+    Parameters
+    ----------
+    genome : py2bit object
+        The opened 2bit genome.
+
+    motifs : list
+        List of [readMotif, refMotif] pairs. A read passes if it has any of them.
+
+    windowSize : int
+        Size of the reference windows loaded when a read falls outside of the current one,
+        and maximum size of a prefetched window.
+
+    Examples
+    --------
+
+    >>> import pysam
+    >>> class Genome(object):  # a minimal stand-in for py2bit
+    ...     def chroms(self, chrom=None):
+    ...         return {"chr1": 20} if chrom is None else 20
+    ...     def sequence(self, chrom, start, end):
+    ...         return "GGGGGTACCCCGTAGGGGGG"[start:end]
+    >>> def makeRead(seq, pos, reverse=False):
+    ...     read = pysam.AlignedSegment()
+    ...     read.query_sequence, read.reference_start, read.is_reverse = seq, pos, reverse
+    ...     read.cigarstring = "{}M".format(len(seq))
+    ...     return read
+    >>> checker = MotifChecker(Genome(), [["A", "TA"], ["G", "GG"]])
+    >>> checker.prefetch("chr1", 0, 20)
+    >>> checker.check(makeRead("ACCCC", 6), "chr1"), checker.check(makeRead("CCCCG", 6), "chr1")
+    (True, False)
+    >>> checker.check(makeRead("CCGT", 9, reverse=True), "chr1"), checker.check(makeRead("GG", 0), "chr1")
+    (True, False)
+    >>> checker.check(makeRead("CCCC", 16, reverse=True), "chr1")
+    False
+    """
+
+    _complement = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+    def __init__(self, genome, motifs, windowSize=1000000):
+        self.genome = genome
+        self.motifs = [(m[0], m[1], len(m[1]) - 1) for m in motifs]
+        self.readMotifLen = max(len(m[0]) for m in motifs)
+        self.margin = max(x[2] for x in self.motifs) + 1000
+        self.windowSize = windowSize
+        self.chrom = None
+        self.chromLen = None
+        self.start = 0
+        self.end = 0
+        self.seq = ""
+
+    def _load(self, chrom, start, end):
+        if chrom != self.chrom:
+            if chrom not in self.genome.chroms():
+                raise NameError("chromosome {} not found in 2bit file".format(chrom))
+            self.chromLen = self.genome.chroms(chrom)
+            self.chrom = chrom
+        self.start = max(0, start - self.margin)
+        self.end = min(self.chromLen, end + self.margin)
+        self.seq = self.genome.sequence(chrom, self.start, self.end)
+
+    def prefetch(self, chrom, start, end):
+        r"""Loads the reference of the region (e.g. the genome chunk of a worker) and the margin around it"""
+        self._load(chrom, start, min(end, start + self.windowSize))
+
+    def _sequence(self, chrom, start, end):
+        r"""Returns the reference in [start, end), or an empty string if it is not within the chromosome"""
+        if start < 0:
+            return ""
+        if chrom != self.chrom or start < self.start or (end > self.end and self.end < self.chromLen):
+            self._load(chrom, start, start + self.windowSize)
+        if end > self.chromLen:
+            return ""
+        return self.seq[start - self.start : end - self.start]
+
+    def check(self, read, chrom):
+        r"""Returns True if the read has any of the motifs"""
+        seq = read.query_sequence
+        if not seq:
+            return False
+        # first bases of the read in its original orientation (as read.get_forward_sequence())
+        if read.is_reverse:
+            readStart = seq[-self.readMotifLen :].translate(self._complement)[::-1]
+            refPos = read.reference_end
+        else:
+            readStart = seq[: self.readMotifLen]
+            refPos = read.reference_start
+        for readMotif, refMotif, refMotifLen in self.motifs:
+            if not readStart.startswith(readMotif):
+                continue
+            # motifs beyond the ends of the chromosome fail without error
+            if read.is_reverse:
+                # for reverse reads ref motif begins at read-end and ends downstream
+                ref_motif = self._sequence(chrom, refPos - 1, refPos + refMotifLen)
+            else:
+                # for forward reads ref motif begins upstream and ends at read-start
+                ref_motif = self._sequence(chrom, refPos - refMotifLen, refPos + 1)
+            if ref_motif == refMotif:
+                return True
+        return False
+
+
 def checkGCcontent(read, lowFilter, highFilter, returnGC=False):
     r"""Checks if the GC content of the read is within the given range
 
@@ -98,10 +297,12 @@ def checkGCcontent(read, lowFilter, highFilter, returnGC=False):
     >>> checkGCcontent(read, 0.3, 0.7)
     True
     """
-    seq = read.get_forward_sequence()
-    total_bases = len(seq)
-    gc_bases = len([x for x in seq if x == "C" or x == "G"])
-    gc_frac = float(gc_bases) / total_bases
+    # the GC content doesn't depend on the strand, so the sequence isn't reverse-complemented
+    seq = read.query_sequence
+    if not seq:
+        gc_frac = 0.0
+    else:
+        gc_frac = (seq.count("G") + seq.count("C")) / len(seq)
     if returnGC:
         return gc_frac
     else:
@@ -111,6 +312,52 @@ def checkGCcontent(read, lowFilter, highFilter, returnGC=False):
             return False
 
 
+def getGCcontent(sequences):
+    r"""Returns the GC fraction of many sequences (e.g. read.query_sequence of a batch of reads) at once
+
+    Parameters
+    ----------
+    sequences : list
+        A list of sequences (str), empty sequences (or None) have a GC content of 0
+
+    Returns
+    -------
+    numpy.ndarray
+        The GC fraction of each sequence
+
+    Examples
+    --------
+
+    >>> getGCcontent(["ACGT", "GGGC", "ATAT", None])
+    array([0.5, 1. , 0. , 0. ])
+    """
+    sequences = [x if x else "" for x in sequences]
+    lengths = np.fromiter((len(x) for x in sequences), dtype=np.int64, count=len(sequences))
+    gc = np.zeros(len(sequences), dtype=np.float64)
+    if lengths.sum() == 0:
+        return gc
+    # look-up table of the G/C bytes, applied to all the bases at once
+    isGC = np.zeros(256, dtype=np.int64)
+    isGC[[ord("G"), ord("C"), ord("g"), ord("c")]] = 1
+    bases = isGC[np.frombuffer("".join(sequences).encode("ascii"), dtype=np.uint8)]
+    counts = np.add.reduceat(np.append(bases, 0), np.cumsum(lengths) - lengths)
+    nonEmpty = lengths > 0
+    gc[nonEmpty] = counts[nonEmpty] / lengths[nonEmpty]
+    return gc
+
+
+def getAlignedLength(read):
+    r"""Returns the number of aligned (M) bases of the read and the read length (including clipped bases)"""
+    cig = read.cigartuples
+    if not cig:
+        return 0, 0
+    matched = 0
+    for op, length in cig:
+        if op == 0:
+            matched += length
+    return matched, read.infer_read_length()
+
+
 def checkAlignedFraction(read, lowFilter):
     """
     Check whether the fraction of read length that aligns to the reference is higher than
@@ -119,14 +366,8 @@ def checkAlignedFraction(read, lowFilter):
 
     Return: Bool
     """
-    cig = read.cigartuples
-    tot = read.infer_read_length()
-    matchPos = [i[0] == 0 for i in cig]
-    matchSum = sum([i[1] for i in list(compress(cig, matchPos))])
-    if matchSum / tot >= lowFilter:
-        return True
-    else:
-        return False
+    matched, total = getAlignedLength(read)
+    return total > 0 and matched / total >= lowFilter
 
 
 def colorPicker(name):
@@ -285,6 +526,135 @@ def getDupFilterTuple(read, bc, filterArg):
     return tup
 
 
+class DuplicateFilter(object):
+    r"""
+    Detects duplicate reads while iterating over the (position sorted) reads of a region.
+
+    The same information as in getDupFilterTuple (barcode, UMI, fragment start/end, mate
+    reference and strand) is packed into a single integer: the barcode id, the positions,
+    the mate reference id and the strand in the lower 128 bits, and the UMI (2-bit encoded
+    per base) above them. UMIs with other characters than ACGT are replaced by an id.
+    The filter type is parsed only once, and the keys of the reads at the current position
+    are kept in a set which is re-used for all positions.
+
+    Parameters
+    ----------
+    filterArg : str
+        The type of duplicate filter (e.g. start_bc_umi, see --duplicateFilter).
+
+    mode : str
+        "position": a read is a duplicate if a read with the same key was seen at the same
+        start position (as in scBAMops, scFilterStats and GetStats).
+        "last": a read is a duplicate if its key is the same as the one of the last read
+        which was not a duplicate (as in ReadCounter).
+
+    Examples
+    --------
+
+    >>> import pysam
+    >>> def makeRead(pos, umi, reverse=False):
+    ...     read = pysam.AlignedSegment()
+    ...     read.reference_id = read.next_reference_id = 0
+    ...     read.reference_start, read.cigarstring, read.is_reverse = pos, "10M", reverse
+    ...     read.set_tag("RX", umi)
+    ...     return read
+    >>> dup = DuplicateFilter("start_bc_umi")
+    >>> [dup.isDuplicate(makeRead(*x), "ACGT") for x in [(10, "AAC"), (10, "AAC"), (10, "AC"), (10, "NAC"), (12, "AAC")]]
+    [False, True, False, False, False]
+    >>> dup.isDuplicate(makeRead(12, "AAC", reverse=True), "ACGT")
+    False
+    """
+
+    _umiTable = str.maketrans("ACGT0123", "0123xxxx")
+
+    def __init__(self, filterArg, mode="position"):
+        filt = filterArg.split("_")
+        self.useEnd = "end" in filt
+        self.useUmi = "umi" in filt
+        self.mode = mode
+        self.lastPosition = None
+        self._keys = set()
+        self._lastKey = None
+        self._barcodeIds = {}
+        self._umiIds = {}
+
+    def _umiCode(self, umi):
+        # 2-bit encoding, with a leading 1 to distinguish UMIs of different length
+        try:
+            return int("1" + umi.translate(self._umiTable), 4) << 1
+        except (ValueError, AttributeError):
+            return (self._umiIds.setdefault(umi, len(self._umiIds)) << 1) | 1
+
+    def key(self, read, bc):
+        r"""Returns the duplicate key of a read, as a python int"""
+        tLenDup = getTLen(read, notAbs=True)
+
+        # get fragment start and end for that read
+        if tLenDup >= 0:
+            s = read.reference_start
+            e = s + tLenDup
+        else:
+            s = read.next_reference_start
+            e = s - tLenDup
+
+        if not self.useEnd:
+            # ignore read/fragment end and mate information
+            mate_refid = read.reference_id
+            if read.is_reverse:
+                s = None
+            else:
+                e = None
+        else:
+            # use mate info, reset fragment end to mate pos if read is chimeric
+            if read.reference_id != read.next_reference_id:
+                e = read.next_reference_start
+            mate_refid = read.next_reference_id
+
+        umiCode = 0
+        if self.useUmi:
+            try:
+                umiCode = self._umiCode(read.get_tag("RX"))
+            except KeyError:
+                sys.stderr.write("UMI tag (RX) absent, skipping UMI check")
+
+        if isinstance(bc, (int, np.integer)):
+            bcId = int(bc)
+        else:
+            bcId = self._barcodeIds.setdefault(bc, len(self._barcodeIds))
+
+        # positions are shifted by 2 (they can be -1), 0 stands for None
+        key = (umiCode << 32) | bcId
+        key = (key << 32) | (0 if s is None else s + 2)
+        key = (key << 32) | (0 if e is None else e + 2)
+        key = (key << 31) | (mate_refid + 1)
+        return (key << 1) | read.is_reverse
+
+    def isDuplicate(self, read, bc):
+        r"""Returns True if the read is a duplicate of a previous read, otherwise records it"""
+        key = self.key(read, bc)
+        pos = read.reference_start
+        if self.mode == "last":
+            if self.lastPosition is not None and key == self._lastKey:
+                return True
+            self._lastKey = key
+            self.lastPosition = pos
+            return False
+
+        if pos != self.lastPosition:
+            self._keys.clear()
+            self.lastPosition = pos
+        elif key in self._keys:
+            return True
+        self._keys.add(key)
+        return False
+
+    def reset(self):
+        r"""Forgets the previous reads (e.g. when starting to iterate over a new region)"""
+        self.lastPosition = None
+        self._lastKey = None
+        self._keys.clear()
+
+
 def gini(i, X):
     r"""Computes the Gini coefficient for each row of a sparse matrix (Obs*Var).
 
@@ -330,3 +700,59 @@ def gini(i, X):
         n = array.shape[0]
         # Gini coefficient:
         return (np.sum((2 * index - n - 1) * array)) / (n * np.sum(array))
+
+
+def loadCounts(fileName, backed=False):
+    r"""Reads the anndata object written by scCountReads (or other sincei tools).
+
+    The format is determined from the file extension: .h5ad, .zarr or (default) .loom.
+
+    Parameters
+    ----------
+    fileName : str
+        input file
+    backed : bool
+        if true, the counts of .h5ad files are not loaded into memory (read-only access),
+        and .zarr files are opened lazily. This has no effect for .loom files.
+
+    Returns
+    -------
+    anndata.AnnData
+        with cells as observations and regions as variables
+    """
+    import anndata as ad
+    from scipy import sparse
+
+    if fileName.endswith(".h5ad"):
+        adata = ad.read_h5ad(fileName, backed="r" if backed else None)
+    elif fileName.rstrip("/").endswith(".zarr"):
+        if backed and hasattr(ad.experimental, "read_lazy"):
+            adata = ad.experimental.read_lazy(fileName)
+        else:
+            adata = ad.read_zarr(fileName)
+    else:
+        import scanpy as sc
+
+        adata = sc.read_loom(fileName, obs_names="obs_names", var_names="var_names")
+
+    if not backed:
+        if sparse.isspmatrix_csc(adata.X):
+            # counts are written region-wise (CSC), while the tools access them per cell
+            adata.X = adata.X.tocsr()
+        if np.issubdtype(adata.X.dtype, np.unsignedinteger):
+            # compact unsigned counts are not supported by scanpy, use float32 (as for .loom files)
+            adata.X = adata.X.astype(np.float32)
+    return adata
+
+
+def saveCounts(adata, fileName, **kwargs):
+    r"""Writes an anndata object, as .h5ad, .zarr or (default) .loom depending on the file extension.
+
+    Additional arguments are passed to ``write_loom``.
+    """
+    if fileName.endswith(".h5ad"):
+        adata.write_h5ad(fileName, compression="gzip")
+    elif fileName.rstrip("/").endswith(".zarr"):
+        adata.write_zarr(fileName)
+    else:
+        adata.write_loom(fileName, **kwargs)
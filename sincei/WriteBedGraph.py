@@ -7,7 +7,6 @@ import pyBigWig
 import math
 
 # deeptools modules
-from deeptools import mapReduce
 from deeptools.utilities import getCommonChrNames
 from deeptools import bamHandler
 from deeptools import utilities
@@ -15,6 +14,7 @@ from deeptools.writeBedGraph import bedGraphToBigWig, getGenomeChunkLength
 
 # own modules
 from sincei import ReadCounter as cr
+from sincei import MapReduce as mapReduce
 
 debug = 0
 
@@ -165,16 +165,28 @@ class WriteBedGraph(cr.CountReadsPerBin):
 
         # below we get the same ouput as in deeptools, except that the 3rd list
         # element contains multiple tmp file names, one tmp file per cluster
-        res = mapReduce.mapReduce(
-            [func_to_call, func_args],
-            writeBedGraph_wrapper,
-            chrom_names_and_size,
-            self_=self,
-            genomeChunkLength=genome_chunk_length,
-            region=self.region,
-            blackListFileName=blackListFileName,
-            numberOfProcessors=self.numberOfProcessors,
-        )
+        self.share_lookup_tables()
+        try:
+            res = mapReduce.mapReduce(
+                [func_to_call, func_args],
+                writeBedGraph_wrapper,
+                chrom_names_and_size,
+                self_=self,
+                genomeChunkLength=genome_chunk_length,
+                region=self.region,
+                blackListFileName=blackListFileName,
+                numberOfProcessors=self.numberOfProcessors,
+                initializer=cr.open_worker_resources,
+                initargs=self.get_worker_resources_args(),
+                bamFiles=self.bamFilesList,
+                # the bedGraph lines of a chunk merge the bins with equal values, cut points add lines
+                # (and change the sum used for the CPM normalization)
+                splitChunks=False,
+            )
+        finally:
+            self.remove_lookup_tables()
+        # the files are opened in the current process if no worker pool was used
+        cr.close_worker_resources()
 
         # Determine the sorted order of the temp files
         chrom_order = dict()
@@ -0,0 +1,202 @@
+import numpy as np
+import h5py
+from scipy import sparse
+
+try:
+    from anndata.io import write_elem, sparse_dataset
+except ImportError:  # anndata < 0.11
+    from anndata.experimental import write_elem, sparse_dataset
+
+from sincei.Regions import Regions
+
+## Functions to write and merge the sparse count shards written by the CountReadsPerBin workers
+
+
+def writeShard(fileName, counts, regionList):
+    r"""
+    Writes the counts (sparse matrix, rows = regions, cols = cells) of a genome chunk
+    together with the regions (a sincei.Regions object) to a .npz file.
+
+    >>> import tempfile, os
+    >>> f = tempfile.NamedTemporaryFile(suffix=".npz", delete=False).name
+    >>> writeShard(f, sparse.csr_matrix(np.array([[0, 1], [2, 0]])), Regions.from_tiles("chr1", 0, 20, 10))
+    >>> counts, regions = readShard(f)
+    >>> counts.toarray()
+    array([[0, 1],
+           [2, 0]])
+    >>> regions.index.tolist()
+    ['chr1_0_10::None', 'chr1_10_20::None']
+    >>> os.remove(f)
+    """
+    counts = sparse.csr_matrix(counts)
+    np.savez(
+        fileName,
+        data=counts.data,
+        indices=counts.indices,
+        indptr=counts.indptr,
+        shape=np.array(counts.shape),
+        **regionList.to_arrays(),
+    )
+
+
+def readShard(fileName):
+    r"""
+    Reads a shard written by writeShard.
+
+    Returns
+    -------
+    tuple
+        the counts as CSR matrix and the regions
+    """
+    with np.load(fileName) as shard:
+        counts = sparse.csr_matrix((shard["data"], shard["indices"], shard["indptr"]), shape=tuple(shard["shape"]))
+        regions = Regions.from_arrays(shard)
+    return counts, regions
+
+
+def getShardsShape(shardFiles):
+    r"""
+    Returns the total number of rows, the number of columns and the number of non-zero
+    entries of a list of shards, without loading the counts.
+    """
+    nrows = 0
+    ncols = 0
+    nnz = 0
+    for fileName in shardFiles:
+        with np.load(fileName) as shard:
+            shape = shard["shape"]
+            nrows += int(shape[0])
+            ncols = int(shape[1])
+            nnz += int(shard["indptr"][-1])
+    return nrows, ncols, nnz
+
+
+def getShardsDtype(shardFiles):
+    r"""
+    Returns the type that can hold the counts of all shards (they are promoted per chunk
+    in case of overflow, see ReadCounter.cast_counts).
+    """
+    dtypes = []
+    for fileName in shardFiles:
+        with np.load(fileName) as shard:
+            dtypes.append(shard["data"].dtype)
+    return np.result_type(*dtypes)
+
+
+def mergeShards(shardFiles):
+    r"""
+    Concatenates the shards (in the given order) into one sparse matrix.
+
+    Returns
+    -------
+    tuple
+        the counts as CSR matrix (rows = regions, cols = cells) and the regions
+    """
+    counts = []
+    regions = []
+    for fileName in shardFiles:
+        _counts, _regions = readShard(fileName)
+        counts.append(_counts)
+        regions.append(_regions)
+    return sparse.vstack(counts, format="csr"), Regions.concat(regions)
+
+
+def mergeShardsToMtx(shardFiles, mtxFile, rowNamesFile):
+    r"""
+    Writes the shards (in the given order) to a MatrixMarket file and the region names
+    to a text file. Only one shard is kept in memory at a time.
+
+    >>> import tempfile, os
+    >>> from scipy import io
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> counts = sparse.csr_matrix(np.array([[0, 1], [2, 0]]))
+    >>> writeShard(tmpdir + "/a.npz", counts, Regions.from_tiles("chr1", 0, 2, 1))
+    >>> writeShard(tmpdir + "/b.npz", sparse.csr_matrix(np.array([[3, 0]])), Regions.from_tiles("chr2", 0, 1, 1))
+    >>> mergeShardsToMtx([tmpdir + "/a.npz", tmpdir + "/b.npz"], tmpdir + "/c.mtx", tmpdir + "/r.txt")
+    >>> io.mmread(tmpdir + "/c.mtx").toarray()
+    array([[0, 1],
+           [2, 0],
+           [3, 0]])
+    >>> open(tmpdir + "/r.txt").read().split()
+    ['chr1_0_1::None', 'chr1_1_2::None', 'chr2_0_1::None']
+    """
+    nrows, ncols, nnz = getShardsShape(shardFiles)
+    mtx = open(mtxFile, "w")
+    rowNames = open(rowNamesFile, "w")
+    mtx.write("%%MatrixMarket matrix coordinate integer general\n%\n")
+    mtx.write("{} {} {}\n".format(nrows, ncols, nnz))
+    offset = 0
+    for fileName in shardFiles:
+        counts, regions = readShard(fileName)
+        counts = counts.tocoo()
+        # MatrixMarket indices are 1-based
+        entries = np.column_stack([counts.row + offset + 1, counts.col + 1, counts.data.astype(np.int64)])
+        np.savetxt(mtx, entries, fmt="%d")
+        for name in regions.index:
+            rowNames.write(name + "\n")
+        offset += counts.shape[0]
+    mtx.close()
+    rowNames.close()
+
+
+def mergeShardsToAnnData(shardFiles, fileName, obs, fileFormat="h5ad", compression="gzip"):
+    r"""
+    Writes the shards (in the given order) to an AnnData file (h5ad or zarr), with cells
+    as observations and the regions as variables. The counts are stored as a compressed
+    CSC matrix, to which the shards are appended one at a time.
+
+    Parameters
+    ----------
+    shardFiles : list
+        shard files written by writeShard
+    fileName : str
+        output file name
+    obs : pandas.DataFrame
+        observations (cells), in the order of the columns of the shards
+    fileFormat : str
+        h5ad or zarr
+    compression : str
+        compression of the h5ad datasets (zarr uses its default compressor)
+
+    >>> import tempfile, os, anndata, pandas as pd
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> counts = sparse.csr_matrix(np.array([[0, 1], [2, 0]], dtype=np.uint8))
+    >>> writeShard(tmpdir + "/a.npz", counts, Regions.from_tiles("chr1", 0, 2, 1))
+    >>> counts = sparse.csr_matrix(np.array([[300, 0]], dtype=np.uint16))
+    >>> writeShard(tmpdir + "/b.npz", counts, Regions.from_tiles("chr2", 0, 1, 1))
+    >>> obs = pd.DataFrame(index=["cell1", "cell2"])
+    >>> mergeShardsToAnnData([tmpdir + "/a.npz", tmpdir + "/b.npz"], tmpdir + "/c.h5ad", obs)
+    >>> adata = anndata.read_h5ad(tmpdir + "/c.h5ad")
+    >>> adata.X.toarray()
+    array([[  0,   2, 300],
+           [  1,   0,   0]], dtype=uint16)
+    >>> adata.var_names.tolist()
+    ['chr1_0_1::None', 'chr1_1_2::None', 'chr2_0_1::None']
+    """
+    dtype = getShardsDtype(shardFiles)
+    if fileFormat == "zarr":
+        import zarr
+
+        store = zarr.open_group(fileName, mode="w")
+        datasetKwargs = {}
+    else:
+        store = h5py.File(fileName, "w")
+        datasetKwargs = {"compression": compression}
+
+    write_elem(store, "obs", obs)
+    X = None
+    regions = []
+    for shardFile in shardFiles:
+        counts, _regions = readShard(shardFile)
+        # cells x regions, the regions of the next shards are appended as columns
+        counts = counts.T.tocsc().astype(dtype)
+        if X is None:
+            write_elem(store, "X", counts, dataset_kwargs=datasetKwargs)
+            X = sparse_dataset(store["X"])
+        else:
+            X.append(counts)
+        regions.append(_regions)
+    write_elem(store, "var", Regions.concat(regions).to_dataframe())
+
+    if fileFormat != "zarr":
+        store.close()
@@ -5,11 +5,13 @@ import argparse
 import pysam
 import os
 import sys
+import shutil
+import tempfile
 import pandas as pd
 import py2bit
 from deeptools import parserCommon
 from deeptools.bamHandler import openBam
-from deeptools.mapReduce import mapReduce
+from sincei.MapReduce import mapReduce
 from deeptools.utilities import getTLen, smartLabels, getTempFileName
 
 # logs
@@ -24,7 +26,8 @@ warnings.simplefilter(action="ignore", category=FutureWarning)
 # sys.path.append(scriptdir)
 
 from sincei import ParserCommon
-from sincei.Utilities import checkMotifs, checkGCcontent, getDupFilterTuple
+from sincei.ReadFilter import ReadFilter
+from sincei import ChunkReport
 from sincei._version import __version__
 
 ## UPDATE: add group tag to BAM file based on a 2-columns mapping file (barcode -> group)
@@ -36,7 +39,7 @@ def parseArguments():
     bamParser = ParserCommon.bamOptions(suppress_args=["binSize", "distanceBetweenBins"])
     filterParser = ParserCommon.filterOptions()
     readParser = ParserCommon.readOptions(suppress_args=["extendReads", "centerReads"])
-    otherParser = ParserCommon.otherOptions()
+    otherParser = ParserCommon.otherOptions(chunkReport=True)
     parser = argparse.ArgumentParser(
         parents=[
             ioParser,
@@ -158,6 +161,7 @@ def shiftRead(b, chromDict, args):
 
 def filterWorker(arglist):
     chrom, start, end, args, chromDict = arglist
+    chunkStats = ChunkReport.ChunkStats(chrom, start, end) if args.chunkReportDir else None
     fh = openBam(args.bamfile)
     # open 2 bit if needed
     if args.genome2bit:
@@ -176,12 +180,29 @@ def filterWorker(arglist):
         onameFiltered = None
         ofiltered = None
 
-    prev_pos = set()
-    lpos = None
+    readFilter = ReadFilter(
+        minMappingQuality=args.minMappingQuality,
+        samFlagInclude=args.samFlagInclude,
+        samFlagExclude=args.samFlagExclude,
+        minFragmentLength=args.minFragmentLength,
+        maxFragmentLength=args.maxFragmentLength,
+        minAlignedFraction=args.minAlignedFraction,
+        GCcontentFilter=args.GCcontentFilter,
+        motifFilter=args.motifFilter,
+        twoBitGenome=twoBitGenome if args.genome2bit else None,
+        filterRNAstrand=args.filterRNAstrand,
+        duplicateFilter=args.duplicateFilter,
+    )
+
+    readFilter.prefetch(chrom, start, end)
 
     nFiltered = 0
     total = 0
+    # reads fetched, and reads without barcode or group
+    nFetched = 0
+    nNoBarcode = 0
     for read in fh.fetch(chrom, start, end):
+        nFetched += 1
         if read.pos < start:
             # ensure that we never double count (in case distanceBetweenBins == 0)
             continue
@@ -191,6 +212,7 @@ def filterWorker(arglist):
             bc = read.get_tag(args.cellTag)
         except KeyError:
             nFiltered += 1
+            nNoBarcode += 1
             continue
         if isinstance(args.groupInfo, pd.DataFrame):
             smpl = read.get_tag(args.groupTag)
@@ -204,112 +226,18 @@ def filterWorker(arglist):
                 if args.verbose:
                     sys.stderr.write("Encountered read tags not in groupInfo file, skipped..")
                 nFiltered += 1
+                nNoBarcode += 1
                 if ofiltered:
                     ofiltered.write(read)
                 continue
 
-        ## -- begin filtering -- ##
-        if read.flag & 4:
-            # Ignore unmapped reads, they were counted already
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-
-        if args.minMappingQuality and read.mapq < args.minMappingQuality:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-
-        if args.samFlagInclude and read.flag & args.samFlagInclude != args.samFlagInclude:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-        if args.samFlagExclude and read.flag & args.samFlagExclude != 0:
+        ## -- filtering, the cheapest filters first -- ##
+        if readFilter.check(read, chrom, bc) is not None:
             nFiltered += 1
             if ofiltered:
                 ofiltered.write(read)
             continue
 
-        tLen = getTLen(read)
-        if args.minFragmentLength > 0 and tLen < args.minFragmentLength:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-        if args.maxFragmentLength > 0 and tLen > args.maxFragmentLength:
-            nFiltered += 1
-            if ofiltered:
-                ofiltered.write(read)
-            continue
-
-        if args.duplicateFilter:
-            tup = getDupFilterTuple(read, bc, args.duplicateFilter)
-            if lpos is not None and lpos == read.reference_start and tup in prev_pos:
-                nFiltered += 1
-                if ofiltered:
-                    ofiltered.write(read)
-                continue
-            if lpos != read.reference_start:
-                prev_pos.clear()
-            lpos = read.reference_start
-            prev_pos.add(tup)
-
-        # remove reads with low/high GC content
-        if args.GCcontentFilter:
-            if not checkGCcontent(read, args.GCcontentFilter[0], args.GCcontentFilter[1]):
-                nFiltered += 1
-                if ofiltered:
-                    ofiltered.write(read)
-                continue
-
-        # remove reads that don't pass the motif filter
-        if args.motifFilter:
-            if not checkMotifs(read, chrom, twoBitGenome, args.motifFilter[0], args.motifFilter[1]):
-                nFiltered += 1
-                if ofiltered:
-                    ofiltered.write(read)
-                continue
-
-        # filterRNAstrand
-        if args.filterRNAstrand:
-            if read.is_paired:
-                if args.filterRNAstrand == "forward":
-                    if read.flag & 144 == 128 or read.flag & 96 == 64:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-                elif args.filterRNAstrand == "reverse":
-                    if read.flag & 144 == 144 or read.flag & 96 == 96:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-            else:
-                if args.filterRNAstrand == "forward":
-                    if read.flag & 16 == 16:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-                elif args.filterRNAstrand == "reverse":
-                    if read.flag & 16 == 0:
-                        pass
-                    else:
-                        nFiltered += 1
-                        if ofiltered:
-                            ofiltered.write(read)
-                        continue
-
         if args.shift:
             read = shiftRead(read, chromDict, args)
             if not read:
@@ -328,6 +256,10 @@ def filterWorker(arglist):
     if args.genome2bit:
         twoBitGenome.close()
 
+    if chunkStats is not None:
+        chunkStats.addReads(nFetched, dict(readFilter.rejected, barcode=nNoBarcode))
+        ChunkReport.writeChunkStats(args.chunkReportDir, chunkStats.finish())
+
     return tid, start, total, nFiltered, oname, onameFiltered
 
 
@@ -400,22 +332,32 @@ def main(args=None):
             print("MotifFilter asked but genome (2bit) file not provided.")
             sys.exit(1)
         else:
-            args.motifFilter = args.motifFilter.strip(" ").split(",")
+            args.motifFilter = [x.strip(" ").split(",") for x in args.motifFilter]
 
     if args.GCcontentFilter:
         gc = args.GCcontentFilter.strip(" ").split(",")
         args.GCcontentFilter = [float(x) for x in gc]
 
+    # the workers write the statistics of the chunks here, if asked
+    args.chunkReportDir = tempfile.mkdtemp(prefix="scBAMops_report_") if args.chunkReport else None
+
     # Filter, writing the results to a bunch of temporary files
-    res = mapReduce(
-        [args, chromDict],
-        filterWorker,
-        chrom_sizes,
-        region=args.region,
-        blackListFileName=args.blackListFileName,
-        numberOfProcessors=args.numberOfProcessors,
-        verbose=args.verbose,
-    )
+    try:
+        res = mapReduce(
+            [args, chromDict],
+            filterWorker,
+            chrom_sizes,
+            region=args.region,
+            blackListFileName=args.blackListFileName,
+            numberOfProcessors=args.numberOfProcessors,
+            verbose=args.verbose,
+            bamFiles=[args.bamfile],
+        )
+        if args.chunkReportDir:
+            ChunkReport.writeReport(args.chunkReportDir, args.chunkReport)
+    finally:
+        if args.chunkReportDir:
+            shutil.rmtree(args.chunkReportDir, ignore_errors=True)
 
     res = sorted(res)  # The temp files are now in order for concatenation
     nFiltered = sum([x[3] for x in res])
@@ -5,6 +5,8 @@ import argparse
 import sys
 import os
 import itertools
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
 from deeptools.getScaleFactor import get_scale_factor
@@ -23,6 +25,7 @@ warnings.simplefilter(action="ignore", category=FutureWarning)
 
 from sincei import ParserCommon
 from sincei import WriteBedGraph
+from sincei import ChunkReport
 
 debug = 0
 
@@ -32,7 +35,7 @@ def parseArguments():
     bam_args = ParserCommon.bamOptions(default_opts={"binSize": 100})
     read_args = ParserCommon.readOptions()
     filter_args = ParserCommon.filterOptions()
-    other_args = ParserCommon.otherOptions()
+    other_args = ParserCommon.otherOptions(chunkReport=True)
     parser = argparse.ArgumentParser(
         parents=[io_args, get_args(), bam_args, filter_args, read_args, other_args],
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -226,6 +229,9 @@ def main(args=None):
     if args.filterRNAstrand and not args.Offset:
         args.Offset = [1, -1]
 
+    # the workers write the statistics of the chunks here, if asked
+    reportDir = tempfile.mkdtemp(prefix="scBulkCoverage_report_") if args.chunkReport else None
+
     if args.MNase:
         # check that library is paired end
         # using getFragmentAndReadSize
@@ -277,6 +283,7 @@ def main(args=None):
             chrsToSkip=args.ignoreForNormalization,
             binarizeCoverage=coverageAsFrequency,
             verbose=args.verbose,
+            chunkReportDir=reportDir,
         )
 
     elif args.Offset:
@@ -318,6 +325,7 @@ def main(args=None):
             chrsToSkip=args.ignoreForNormalization,
             binarizeCoverage=coverageAsFrequency,
             verbose=args.verbose,
+            chunkReportDir=reportDir,
         )
         wr.filter_strand = args.filterRNAstrand
         wr.Offset = args.Offset
@@ -349,17 +357,24 @@ def main(args=None):
             chrsToSkip=args.ignoreForNormalization,
             binarizeCoverage=coverageAsFrequency,
             verbose=args.verbose,
+            chunkReportDir=reportDir,
         )
 
-    wr.run(
-        WriteBedGraph.scaleCoverage,
-        func_args,
-        args.outFilePrefix,
-        blackListFileName=args.blackListFileName,
-        normUsing=args.normalizeUsing,
-        format=args.outFileFormat,
-        smoothLength=None,
-    )
+    try:
+        wr.run(
+            WriteBedGraph.scaleCoverage,
+            func_args,
+            args.outFilePrefix,
+            blackListFileName=args.blackListFileName,
+            normUsing=args.normalizeUsing,
+            format=args.outFileFormat,
+            smoothLength=None,
+        )
+        if reportDir:
+            ChunkReport.writeReport(reportDir, args.chunkReport)
+    finally:
+        if reportDir:
+            shutil.rmtree(reportDir, ignore_errors=True)
 
 
 class OffsetFragment(WriteBedGraph.WriteBedGraph):
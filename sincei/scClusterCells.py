@@ -36,6 +36,7 @@ import scanpy as sc
 # sys.path.append(scriptdir)
 
 from sincei import ParserCommon
+from sincei.Utilities import loadCounts, saveCounts
 from sincei.TopicModels import TOPICMODEL
 from sincei.GLMPCA import GLMPCA, EXPONENTIAL_FAMILY_DICT
 
@@ -144,7 +145,7 @@ def main(args=None):
         logger.setLevel(logging.CRITICAL)
         warnings.filterwarnings("ignore")
 
-    adata = sc.read_loom(args.input, obs_names="obs_names", var_names="var_names")
+    adata = loadCounts(args.input)
     mtx = sparse.csr_matrix(adata.X.copy().transpose())  # features x cells
     cells = copy.deepcopy(adata.obs_names.to_list())
     regions = copy.deepcopy(adata.var_names.to_list())
@@ -210,7 +211,7 @@ def main(args=None):
     sc.pl.paga(adata, plot=False, threshold=0.1)
     sc.tl.umap(adata, min_dist=0.1, spread=5, init_pos="paga")
 
-    adata.write_loom(args.outFile, write_obsm_varm=True)
+    saveCounts(adata, args.outFile, write_obsm_varm=True)
 
     if args.outFileUMAP:
         ## plot UMAP
@@ -25,6 +25,7 @@ import scanpy as sc
 # sys.path.append(scriptdir)
 from sincei import ParserCommon
 from sincei.ParserCommon import smartLabel
+from sincei.Utilities import loadCounts, saveCounts
 
 
 def parseArguments():
@@ -54,7 +55,7 @@ def get_args():
         "--input",
         "-i",
         metavar="LOOM",
-        help="Input files in .loom format",
+        help="Input files in .loom format (or .h5ad/.zarr, as written by scCountReads)",
         nargs="+",
         required=True,
     )
@@ -115,7 +116,7 @@ def main(args=None):
     if not args.labels:
         # try smartlabel
         args.labels = [smartLabel(x) for x in args.input]
-    adata_list = [sc.read_loom(x, obs_names="obs_names", var_names="var_names") for x in args.input]
+    adata_list = [loadCounts(x) for x in args.input]
 
     ## concatenate labels and match chrom, start, end
     var_list = []
@@ -141,5 +142,5 @@ def main(args=None):
 
     sys.stdout.write("Combined cells: {} \n".format(adata.shape[0]))
     sys.stdout.write("Combined features: {} \n".format(adata.shape[1]))
-    adata.write_loom(args.outFile)
+    saveCounts(adata, args.outFile)
     return 0
@@ -23,7 +23,7 @@ warnings.simplefilter(action="ignore", category=FutureWarning)
 # scriptdir=os.path.abspath(os.path.join(__file__, "../../sincei"))
 # sys.path.append(scriptdir)
 from sincei import ParserCommon
-from sincei.Utilities import gini
+from sincei.Utilities import gini, loadCounts, saveCounts
 
 
 ### ------ Functions ------
@@ -186,7 +186,7 @@ def main(args=None):
         logger.setLevel(logging.CRITICAL)
         warnings.filterwarnings("ignore")
 
-    adata = sc.read_loom(args.input, obs_names="obs_names", var_names="var_names")
+    adata = loadCounts(args.input)
     ## add QC stats to the anndata object
     # 1. scanpy metrics # fraction of regions/genes with signal are included in the metrics (pct_dropouts/n_genes_by_counts)
     try:
@@ -266,6 +266,6 @@ def main(args=None):
         )
         sys.stdout.write("Remaining cells: {} \n".format(adata_filt.shape[0]))
         sys.stdout.write("Remaining features: {} \n".format(adata_filt.shape[1]))
-        adata_filt.write_loom(args.outFile)
+        saveCounts(adata_filt, args.outFile)
 
     return 0
@@ -3,9 +3,11 @@
 
 import os
 import sys
+import shutil
+import tempfile
 import argparse
 import numpy as np
-from scipy import sparse, io
+from scipy import sparse
 import re
 import pandas as pd
 import anndata as ad
@@ -25,6 +27,10 @@ warnings.simplefilter(action="ignore", category=FutureWarning)
 
 from sincei import ReadCounter as countR
 from sincei import ParserCommon
+from sincei import WriteCounts
+from sincei import ChunkReport
+from sincei import Checkpoint
+from sincei import FragmentStore
 
 old_settings = np.seterr(all="ignore")
 
@@ -37,6 +43,10 @@ def parseArguments(args=None):
             The analysis can be performed for the entire genome by running the program in 'bins' mode.
             If you want to count the read coverage for specific regions only, use the ``features`` mode instead.
             The standard output of ``scCountReads`` is a ".loom" file with counts, along with rowName (features) and colNames (cell barcodes).
+            In 'bins' mode, a fragment store written by ``scFragmentStore`` can be given instead of the BAM file(s), to count
+            the stored reads in bins without reading the BAM files again. The counts are those of the BAM files without
+            --extendReads. The read filters are applied when the store is written, only --minMappingQuality,
+            --duplicateFilter, --blackListFileName and --region can be given to count a store.
 
             A detailed sub-commands help is available by typing:
 
@@ -63,7 +73,7 @@ def parseArguments(args=None):
 
     read_args = ParserCommon.readOptions(suppress_args=["filterRNAstrand"])
     filter_args = ParserCommon.filterOptions()
-    other_args = ParserCommon.otherOptions()
+    other_args = ParserCommon.otherOptions(chunkReport=True)
 
     # bins mode options
     subparsers.add_parser(
@@ -79,7 +89,7 @@ def parseArguments(args=None):
             ParserCommon.bamOptions(default_opts={"binSize": 10000, "distanceBetweenBins": 0}),
             read_args,
             filter_args,
-            get_args(),
+            get_args(bins=True),
             other_args,
         ],
         help="The reads are counted in bins of equal size. The bin size and distance between bins can be adjusted.",
@@ -115,9 +125,31 @@ def parseArguments(args=None):
     return parser
 
 
-def get_args():
+def get_args(bins=False):
     parser = argparse.ArgumentParser(add_help=False)
     optional = parser.add_argument_group("Misc arguments")
+    if bins:
+        optional.add_argument(
+            "--additionalBinSizes",
+            type=int,
+            nargs="+",
+            default=None,
+            metavar="INT",
+            help="Also count the reads in bins of these sizes (multiples of --binSize), from the same pass over "
+            "the BAM files. The counts are written to <prefix>_<size>bp.<format>, in addition to the counts in "
+            "bins of --binSize. Can not be used with --distanceBetweenBins.",
+        )
+    else:
+        optional.add_argument(
+            "--featureMergeDistance",
+            type=int,
+            default=None,
+            metavar="INT",
+            help="Fetch the reads of the features closer than this distance (in bp) together, once for each "
+            "cluster of nearby features, instead of once per feature. The counts are the same, but the reads "
+            "shared by nearby or overlapping features (e.g. promoters or peaks) are only read and filtered once. "
+            "By default, the reads of each feature are fetched separately.",
+        )
     optional.add_argument(
         "--genomeChunkSize",
         type=int,
@@ -127,13 +159,64 @@ def get_args():
         "density of the BAM file.",
     )
 
+    optional.add_argument(
+        "--memoryBudget",
+        type=ParserCommon.memorySize,
+        default=None,
+        metavar="SIZE",
+        help="Memory available for the counts of the genome chunks processed at the same time by all "
+        "processors, e.g. 8G or 500M (megabytes if no unit is given). If set (and --genomeChunkSize is not), "
+        "the chunk size is determined from this budget, the number of cells, the bin size, the count type "
+        "and the number of processors, instead of from the read density only. Use it to avoid running out "
+        "of memory with many cells, or to process larger chunks with few cells.",
+    )
+
+    optional.add_argument(
+        "--countDtype",
+        type=str,
+        default="auto",
+        choices=["auto", "uint8", "uint16", "uint32"],
+        help="Integer type used to store the counts. With the default (auto), the smallest type expected to "
+        "hold the counts is selected based on the bin size and sequencing depth. In all cases, a larger type is "
+        "used for parts of the genome where the counts do not fit.",
+    )
+
+    optional.add_argument(
+        "--countFragmentsOnce",
+        action="store_true",
+        help="For paired-end data with --extendReads, only process the left-most mate of each "
+        "proper pair and count its fragment for both mates. The counts are the same as by default "
+        "(unless the mates are filtered differently), but each fragment is only fetched and filtered "
+        "once, which is faster. Can not be combined with --duplicateFilter, or with --samFlagInclude/"
+        "--samFlagExclude flags that differ between the mates (16, 32, 64, 128).",
+    )
+
+    optional.add_argument(
+        "--checkpointDir",
+        metavar="DIR",
+        default=None,
+        help="Write the counts of each genome chunk to this directory as soon as the chunk is done, "
+        "so that an interrupted run can be resumed with --resume. The directory is emptied once the "
+        "output is written.",
+    )
+
+    optional.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the run interrupted with the same --checkpointDir: only the chunks missing in the "
+        "checkpoint are counted. Chunks counted with other parameters or input files are counted again.",
+    )
+
     optional.add_argument(
         "--outFileFormat",
         type=str,
         default="loom",
-        choices=["loom", "mtx"],
+        choices=["loom", "h5ad", "zarr", "mtx"],
         help="Output file format. Default is to write an anndata object of name "
         "<prefix>.loom, which can either be opened in scanpy, or by downstream tools. "
+        '"h5ad" and "zarr" write the anndata object as <prefix>.h5ad or <prefix>.zarr, with '
+        "compressed sparse counts that are written chunk by chunk. These are faster to write and read "
+        "for large datasets, and can be opened lazily (e.g. anndata.read_h5ad(file, backed='r')). "
         '"mtx" refers to the MatrixMarket sparse-matrix format. The output in this case would be '
         "<prefix>.counts.mtx, along with <prefix>.rownames.txt and <prefix>.colnames.txt",
     )
@@ -153,19 +236,37 @@ def main(args=None):
     if not args.verbose:
         logger.setLevel(logging.CRITICAL)
         warnings.filterwarnings("ignore")
+    if args.resume and not args.checkpointDir:
+        exit("ERROR: --resume requires --checkpointDir.")
+    if args.countFragmentsOnce and (
+        args.duplicateFilter
+        or (args.samFlagInclude or 0) & countR.MATE_SPECIFIC_FLAGS
+        or (args.samFlagExclude or 0) & countR.MATE_SPECIFIC_FLAGS
+    ):
+        exit(
+            "ERROR: --countFragmentsOnce can not be combined with --duplicateFilter, or with SAM flags that "
+            "differ between the mates (16, 32, 64, 128)."
+        )
 
     if "BED" in args:
         bed_regions = args.BED
     else:
         bed_regions = None
 
-    ## create row/colNames
-    if args.outFileFormat == "mtx":
-        mtxFile = args.outFilePrefix + ".counts.mtx"
-        rowNamesFile = args.outFilePrefix + ".rownames.txt"
-        colNamesFile = args.outFilePrefix + ".colnames.txt"
-    else:
-        rowNamesFile = None
+    # the workers write their counts as sparse shards here, which are then merged into the output
+    shardDir = tempfile.mkdtemp(prefix="scCountReads_")
+
+    if len(args.bamfiles) == 1 and FragmentStore.isFragmentStore(args.bamfiles[0]):
+        # the fragments were extracted from the BAM files by scFragmentStore
+        try:
+            for binSize in [args.binSize] + (args.additionalBinSizes or []):
+                shardFiles, newlabels = countFragmentStore(args, shardDir, binSize)
+                writeOutput(args, newlabels, shardFiles, getOutFilePrefix(args, binSize))
+        finally:
+            shutil.rmtree(shardDir, ignore_errors=True)
+        return
+    # and the statistics of the chunks, if asked
+    reportDir = tempfile.mkdtemp(prefix="scCountReads_report_") if args.chunkReport else None
 
     stepSize = args.binSize + args.distanceBetweenBins
     c = countR.CountReadsPerBin(
@@ -181,6 +282,7 @@ def main(args=None):
         GCcontentFilter=args.GCcontentFilter,
         numberOfSamples=None,
         genomeChunkSize=args.genomeChunkSize,
+        memoryBudget=args.memoryBudget,
         numberOfProcessors=args.numberOfProcessors,
         verbose=args.verbose,
         region=args.region,
@@ -195,14 +297,127 @@ def main(args=None):
         minFragmentLength=args.minFragmentLength,
         maxFragmentLength=args.maxFragmentLength,
         zerosToNans=False,
-        out_file_for_raw_data=rowNamesFile,
+        sparseOutput=True,
+        countDtype=args.countDtype,
+        shardDir=shardDir,
+        countFragmentsOnce=args.countFragmentsOnce,
+        chunkReportDir=reportDir,
+        additionalBinSizes=getattr(args, "additionalBinSizes", None),
+        checkpointDir=args.checkpointDir,
+        resume=args.resume,
+        featureMergeDistance=getattr(args, "featureMergeDistance", None),
+    )
+
+    try:
+        shardFiles, _ = c.run(allArgs=args)
+        if reportDir:
+            ChunkReport.writeReport(reportDir, args.chunkReport)
+        if c.additionalBinSizes:
+            # the shards of each bin size
+            for binSize in sorted(shardFiles):
+                writeOutput(args, newlabels, shardFiles[binSize], getOutFilePrefix(args, binSize))
+        else:
+            writeOutput(args, newlabels, shardFiles)
+        if args.checkpointDir:
+            # the checkpoint is only kept if the run fails
+            Checkpoint.removeCheckpoint(args.checkpointDir)
+    finally:
+        shutil.rmtree(shardDir, ignore_errors=True)
+        if reportDir:
+            shutil.rmtree(reportDir, ignore_errors=True)
+
+
+def getOutFilePrefix(args, binSize):
+    r"""Returns the output prefix of the counts in bins of binSize (with --additionalBinSizes)"""
+    if binSize == args.binSize:
+        return args.outFilePrefix
+    return "{}_{}bp".format(args.outFilePrefix, binSize)
+
+
+def countFragmentStore(args, shardDir, binSize):
+    r"""
+    Counts the reads of a store written by scFragmentStore in bins of binSize, instead of the
+    reads of BAM files (the counts are the same as those of the BAM files without --extendReads).
+    The read filters were applied when the store was written, only a higher --minMappingQuality
+    and the removal of duplicates (--duplicateFilter) are applied here. The options that need
+    the reads themselves are rejected.
+
+    Returns
+    -------
+    tuple
+        The count shards (one per chunk of the genome) and the labels of the cells
+        (those of the store with a barcode in the whitelist).
+    """
+    if args.command != "bins":
+        exit("ERROR: the counts of a fragment store can only be computed in bins mode.")
+    unsupported = [
+        ("--distanceBetweenBins", args.distanceBetweenBins),
+        ("--samFlagInclude", args.samFlagInclude),
+        ("--samFlagExclude", args.samFlagExclude),
+        ("--minFragmentLength", args.minFragmentLength),
+        ("--maxFragmentLength", args.maxFragmentLength),
+        ("--extendReads", args.extendReads),
+        ("--centerReads", args.centerReads),
+        ("--motifFilter", args.motifFilter),
+        ("--GCcontentFilter", args.GCcontentFilter),
+        ("--minAlignedFraction", args.minAlignedFraction),
+        ("--countFragmentsOnce", args.countFragmentsOnce),
+        ("--memoryBudget", args.memoryBudget),
+        ("--checkpointDir", args.checkpointDir),
+        ("--chunkReport", args.chunkReport),
+    ]
+    unsupported = [name for name, value in unsupported if value]
+    if unsupported:
+        exit(
+            "ERROR: {} can not be used with a fragment store. The read filters are applied when the "
+            "store is written (see scFragmentStore).".format(", ".join(unsupported))
+        )
+    countDtype = "uint8" if args.countDtype == "auto" else args.countDtype
+
+    with FragmentStore.FragmentStore(args.bamfiles[0]) as store:
+        labels = store.labels
+        if args.duplicateFilter and args.duplicateFilter != store.duplicateFilter:
+            exit(
+                "ERROR: the duplicates of the fragment store were detected with {}, not with --duplicateFilter {}. "
+                "Write the store with this --duplicateFilter.".format(store.duplicateFilter, args.duplicateFilter)
+            )
+    # the column of each barcode id of the store, -1 for the barcodes not in the whitelist
+    barcodes = set(args.barcodes)
+    keep = [i for i, label in enumerate(labels) if label.split("::")[-1] in barcodes]
+    columnIndex = np.full(len(labels), -1, dtype=np.int64)
+    columnIndex[keep] = np.arange(len(keep))
+    newlabels = [labels[i] for i in keep]
+
+    shardFiles = FragmentStore.countStore(
+        args.bamfiles[0],
+        binSize,
+        shardDir,
+        columnIndex=columnIndex,
+        nColumns=len(newlabels),
+        region=args.region,
+        blackListFileName=args.blackListFileName,
+        genomeChunkSize=args.genomeChunkSize,
+        numberOfProcessors=args.numberOfProcessors,
+        countDtype=countDtype,
+        verbose=args.verbose,
+        minMappingQuality=args.minMappingQuality,
+        removeDuplicates=args.duplicateFilter is not None,
     )
+    return shardFiles, newlabels
 
-    num_reads_per_bin, regionList = c.run(allArgs=args)
 
-    sys.stderr.write("Number of bins/features " "found: {}\n".format(num_reads_per_bin.shape[0]))
+def writeOutput(args, newlabels, shardFiles, outFilePrefix=None):
+    r"""
+    Merges the count shards into the output file, keeping only one shard in memory for
+    the .mtx, .h5ad and .zarr outputs, and only the sparse matrix for the .loom output.
+    The output is written to outFilePrefix (by default, --outFilePrefix).
+    """
+    if outFilePrefix is None:
+        outFilePrefix = args.outFilePrefix
+    nRegions = WriteCounts.getShardsShape(shardFiles)[0]
+    sys.stderr.write("Number of bins/features " "found: {}\n".format(nRegions))
 
-    if num_reads_per_bin.shape[0] < 1:
+    if nRegions < 1:
         exit(
             "ERROR: too few non zero bins/features found.\n"
             "If using --region please check that this "
@@ -211,35 +426,32 @@ def main(args=None):
 
     ## write mtx/rownames if asked
     if args.outFileFormat == "mtx":
-        f = open(colNamesFile, "w")
+        f = open(outFilePrefix + ".colnames.txt", "w")
         f.write("\n".join(newlabels))
         f.write("\n")
         f.close()
-        ## write the matrix as .mtx
-        sp = sparse.csr_matrix(num_reads_per_bin)
-        io.mmwrite(mtxFile, sp, field="integer")
+        ## write the matrix as .mtx, and the region names
+        WriteCounts.mergeShardsToMtx(shardFiles, outFilePrefix + ".counts.mtx", outFilePrefix + ".rownames.txt")
+        return
+
+    obs = pd.DataFrame(
+        {
+            "sample": [x.split("::")[-2] for x in newlabels],
+            "barcodes": [x.split("::")[-1] for x in newlabels],
+        },
+        index=newlabels,
+    )
+    if args.outFileFormat in ["h5ad", "zarr"]:
+        # the shards are appended to the anndata file one by one
+        WriteCounts.mergeShardsToAnnData(
+            shardFiles, "{}.{}".format(outFilePrefix, args.outFileFormat), obs, fileFormat=args.outFileFormat
+        )
     else:
         # write anndata
-        adata = ad.AnnData(num_reads_per_bin.T)
-        adata.obs = pd.DataFrame(
-            {
-                "sample": [x.split("::")[-2] for x in newlabels],
-                "barcodes": [x.split("::")[-1] for x in newlabels],
-            },
-            index=newlabels,
-        )
-
-        rows = list(regionList)
-
-        adata.var = pd.DataFrame(
-            {
-                "chrom": [x.split("_")[0] for x in rows],
-                "start": [x.split("_")[1] for x in rows],
-                "end": [y.split("::")[0] for y in [x.split("_")[2] for x in rows]],
-                "name": [x.split("::")[1] for x in rows],
-            },
-            index=rows,
-        )
+        num_reads_per_bin, regionList = WriteCounts.mergeShards(shardFiles)
+        adata = ad.AnnData(num_reads_per_bin.T.tocsr())
+        adata.obs = obs
+        adata.var = regionList.to_dataframe()
 
         # export as loom
-        adata.write_loom(args.outFilePrefix + ".loom")
+        adata.write_loom(outFilePrefix + ".loom")
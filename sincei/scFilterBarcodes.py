@@ -6,8 +6,7 @@ import sys
 import os
 
 from deeptools import parserCommon, bamHandler, utilities
-from deeptools.mapReduce import mapReduce
-from deeptoolsintervals import GTF
+from sincei.MapReduce import mapReduce
 import numpy as np
 import pandas as pd
 from collections import Counter
@@ -114,10 +113,10 @@ def getFiltered_worker(arglist):
     # Fix the bounds
     if end <= start:
         end = start + 1
-    ## open blacklist file
+    ## blacklist (parsed once per process)
     blackList = None
     if args.blackListFileName is not None:
-        blackList = GTF(args.blackListFileName)
+        blackList = getBlacklistIndex(args.blackListFileName)
 
     fh = bamHandler.openBam(args.bamfile)
     chromUse = utilities.mungeChromosome(chrom, fh.references)
@@ -136,7 +135,7 @@ def getFiltered_worker(arglist):
             continue
 
         ## reads in blacklisted regions
-        if blackList and blackList.findOverlaps(
+        if blackList is not None and blackList.overlaps(
             chrom,
             read.reference_start,
             read.reference_start + read.infer_query_length(always=False) - 1,
@@ -203,6 +202,9 @@ def main(args=None):
         blackListFileName=args.blackListFileName,
         numberOfProcessors=args.numberOfProcessors,
         verbose=args.verbose,
+        # the barcodes are counted per bin, so the bins are only dispatched by read density
+        bamFiles=[args.bamfile],
+        splitChunks=False,
     )
     ## res, should be a list of sets
     # final_set = list(set().union(*res))
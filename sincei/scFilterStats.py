@@ -4,11 +4,12 @@
 import argparse
 import sys
 import os
+import shutil
+import tempfile
 
 from deeptools import parserCommon, bamHandler, utilities
-from deeptools.mapReduce import mapReduce
+from sincei.MapReduce import mapReduce
 from deeptools.utilities import smartLabels
-from deeptoolsintervals import GTF
 
 import numpy as np
 import py2bit
@@ -26,6 +27,8 @@ warnings.simplefilter(action="ignore", category=FutureWarning)
 # sys.path.append(scriptdir)
 from sincei.Utilities import *
 from sincei import ParserCommon
+from sincei.ReadFilter import ReadFilter
+from sincei import ChunkReport
 
 
 def parseArguments():
@@ -45,7 +48,7 @@ def parseArguments():
             "centerReads",
         ]
     )
-    other_args = ParserCommon.otherOptions()
+    other_args = ParserCommon.otherOptions(chunkReport=True)
 
     parser = argparse.ArgumentParser(
         parents=[io_args, bam_args, filter_args, read_args, other_args],
@@ -84,20 +87,33 @@ def getFiltered_worker(arglist):
         end -= args.distanceBetweenBins
     if end <= start:
         end = start + 1
+    chunkStats = ChunkReport.ChunkStats(chrom, start, end) if args.chunkReportDir else None
     ## open genome if needed
     if args.genome2bit:
         twoBitGenome = py2bit.open(args.genome2bit, True)
-    ## open blacklist file
+    ## blacklist (parsed once per process)
     blackList = None
     if args.blackListFileName is not None:
-        blackList = GTF(args.blackListFileName)
+        blackList = getBlacklistIndex(args.blackListFileName)
 
     o = []
     for fname in args.bamfiles:
         fh = bamHandler.openBam(fname)
         chromUse = utilities.mungeChromosome(chrom, fh.references)
-        prev_pos = set()
-        lpos = None
+        readFilter = ReadFilter(
+            minMappingQuality=args.minMappingQuality,
+            samFlagInclude=args.samFlagInclude,
+            samFlagExclude=args.samFlagExclude,
+            blackList=blackList,
+            minAlignedFraction=args.minAlignedFraction,
+            GCcontentFilter=args.GCcontentFilter,
+            motifFilter=args.motifFilter,
+            twoBitGenome=twoBitGenome if args.genome2bit else None,
+            filterRNAstrand=args.filterRNAstrand,
+            filterMarkedDuplicates=True,
+            filterSingletons=True,
+            duplicateFilter=args.duplicateFilter,
+        )
 
         ## a dict with barcodes = keys
         # metrics
@@ -112,6 +128,20 @@ def getFiltered_worker(arglist):
         filterMotifs = {}
         filterGC = {}
         minAlignedFraction = {}
+        # the metrics counted for each filter of the ReadFilter
+        counters = {
+            "blacklist": blacklisted,
+            "minMappingQuality": minMapq,
+            "samFlagInclude": samFlagInclude,
+            "samFlagExclude": samFlagExclude,
+            "duplicate": internalDupes,
+            "markedDuplicate": externalDupes,
+            "singleton": singletons,
+            "filterRNAstrand": filterRNAstrand,
+            "motif": filterMotifs,
+            "GCcontent": filterGC,
+            "minAlignedFraction": minAlignedFraction,
+        }
         # trackers
         nFiltered = {}
         total = {}  # This is only used to estimate the percentage affected
@@ -132,13 +162,20 @@ def getFiltered_worker(arglist):
             filterGC[b] = 0
             minAlignedFraction[b] = 0
 
+        readFilter.prefetch(chrom, start, end)
+        # reads fetched, and reads without (whitelisted) barcode
+        nFetched = 0
+        nNoBarcode = 0
         for read in fh.fetch(chromUse, start, end):
+            nFetched += 1
             try:
                 bc = read.get_tag(args.cellTag)
             except KeyError:
+                nNoBarcode += 1
                 continue
             # also keep a counter for barcodes not in whitelist?
             if bc not in args.barcodes:
+                nNoBarcode += 1
                 continue
 
             filtered[bc] = 0
@@ -150,93 +187,17 @@ def getFiltered_worker(arglist):
                 # Ignore unmapped reads, they were counted already
                 continue
 
-            if args.minMappingQuality and read.mapq < args.minMappingQuality:
-                filtered[bc] = 1
-                minMapq[bc] += 1
-            if args.samFlagInclude and read.flag & args.samFlagInclude != args.samFlagInclude:
-                filtered[bc] = 1
-                samFlagInclude[bc] += 1
-            if args.samFlagExclude and read.flag & args.samFlagExclude != 0:
-                filtered[bc] = 1
-                samFlagExclude[bc] += 1
-
-            if args.minAlignedFraction:
-                if not checkAlignedFraction(read, args.minAlignedFraction):
-                    filtered[bc] = 1
-                    minAlignedFraction[bc] += 1
-
-            ## reads in blacklisted regions
-            if blackList and blackList.findOverlaps(
-                chrom,
-                read.reference_start,
-                read.reference_start + read.infer_query_length(always=False) - 1,
-            ):
-                filtered[bc] = 1
-                blacklisted[bc] += 1
-
-            ## Duplicates
-            if args.duplicateFilter:
-                tup = getDupFilterTuple(read, bc, args.duplicateFilter)
-                if lpos is not None and lpos == read.reference_start and tup in prev_pos:
-                    filtered[bc] = 1
-                    internalDupes[bc] += 1
-                if lpos != read.reference_start:
-                    prev_pos.clear()
-                lpos = read.reference_start
-                prev_pos.add(tup)
-            if read.is_duplicate:
-                filtered[bc] = 1
-                externalDupes[bc] += 1
-            if read.is_paired and read.mate_is_unmapped:
-                filtered[bc] = 1
-                singletons[bc] += 1
-
-            ## remove reads with low/high GC content
-            if args.GCcontentFilter:
-                if not checkGCcontent(read, args.GCcontentFilter[0], args.GCcontentFilter[1]):
-                    filtered[bc] = 1
-                    filterGC[bc] += 1
-
-            ## remove reads that don't pass the motif filter
-            if args.motifFilter:
-                test = [checkMotifs(read, chrom, twoBitGenome, m[0], m[1]) for m in args.motifFilter]
-                # if none given motif found, return true
-                if not any(test):
-                    filtered[bc] = 1
-                    filterMotifs[bc] += 1
-
-            # filterRNAstrand
-            if args.filterRNAstrand:
-                if read.is_paired:
-                    if args.filterRNAstrand == "forward":
-                        if read.flag & 144 == 128 or read.flag & 96 == 64:
-                            pass
-                        else:
-                            filtered[bc] = 1
-                            filterRNAstrand[bc] += 1
-                    elif args.filterRNAstrand == "reverse":
-                        if read.flag & 144 == 144 or read.flag & 96 == 96:
-                            pass
-                        else:
-                            filtered[bc] = 1
-                            filterRNAstrand[bc] += 1
-                else:
-                    if args.filterRNAstrand == "forward":
-                        if read.flag & 16 == 16:
-                            pass
-                        else:
-                            filtered[bc] = 1
-                            filterRNAstrand[bc] += 1
-                    elif args.filterRNAstrand == "reverse":
-                        if read.flag & 16 == 0:
-                            pass
-                        else:
-                            filtered[bc] = 1
-                            filterRNAstrand[bc] += 1
+            ## all filters are evaluated, to count the reads rejected by each of them
+            failed = readFilter.checkAll(read, chrom, bc)
+            for name in failed:
+                counters[name][bc] += 1
+            filtered[bc] = 1 if failed else 0
 
             total[bc] += 1
             nFiltered[bc] += filtered[bc]
         fh.close()
+        if chunkStats is not None:
+            chunkStats.addReads(nFetched, dict(readFilter.rejected, barcode=nNoBarcode))
 
         # first make a tuple where each entry is a dict of barcodes:value
         tup = (
@@ -264,6 +225,9 @@ def getFiltered_worker(arglist):
         out = np.stack([v for k, v in merged.items()])
         # out is an array with row = len(barcode) [384], column = len(stats) [11]
         o.append(out)
+
+    if chunkStats is not None:
+        ChunkReport.writeChunkStats(args.chunkReportDir, chunkStats.finish())
     return o
 
 
@@ -285,25 +249,33 @@ def main(args=None):
         checkBAMtag(x, bam, args.cellTag)
         if args.groupTag:
             checkBAMtag(x, bam, args.groupTag)
-            sys.stderr.write(
-                "--groupTag is not implemented for scFilterStats yet! \
-            Please split your BAM file by {} and re-run scFilterStats. \n".format(
-                    args.groupTag
-                )
-            )
+            sys.stderr.write("--groupTag is not implemented for scFilterStats yet! \
+            Please split your BAM file by {} and re-run scFilterStats. \n".format(args.groupTag))
             exit(1)
         x.close()
 
+    # the workers write the statistics of the chunks here, if asked
+    args.chunkReportDir = tempfile.mkdtemp(prefix="scFilterStats_report_") if args.chunkReport else None
+
     # Get the remaining metrics
-    res = mapReduce(
-        [args],
-        getFiltered_worker,
-        chrom_sizes,
-        genomeChunkLength=args.binSize + args.distanceBetweenBins,
-        blackListFileName=args.blackListFileName,
-        numberOfProcessors=args.numberOfProcessors,
-        verbose=args.verbose,
-    )
+    try:
+        res = mapReduce(
+            [args],
+            getFiltered_worker,
+            chrom_sizes,
+            genomeChunkLength=args.binSize + args.distanceBetweenBins,
+            blackListFileName=args.blackListFileName,
+            numberOfProcessors=args.numberOfProcessors,
+            verbose=args.verbose,
+            # the chunks are the sampled bins, they are only dispatched by read density
+            bamFiles=args.bamfiles,
+            splitChunks=False,
+        )
+        if args.chunkReportDir:
+            ChunkReport.writeReport(args.chunkReportDir, args.chunkReport)
+    finally:
+        if args.chunkReportDir:
+            shutil.rmtree(args.chunkReportDir, ignore_errors=True)
     ## res, should be the list of np.arrays of length (len(barcodes) * 9)
 
     ## final output is an array where nrows = bamfiles*barcodes, ncol = No. of stats
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+
+# logs
+import warnings
+import logging
+
+logger = logging.getLogger()
+warnings.simplefilter(action="ignore", category=FutureWarning)
+
+from sincei import ParserCommon
+from sincei.FragmentStore import FragmentStoreWriter
+
+
+def parseArguments():
+    io_args = ParserCommon.inputOutputOptions(
+        opts=["bamfiles", "barcodes", "outFile"], requiredOpts=["barcodes", "outFile"]
+    )
+    bam_args = ParserCommon.bamOptions(suppress_args=["binSize", "distanceBetweenBins"])
+    filter_args = ParserCommon.filterOptions()
+    read_args = ParserCommon.readOptions(suppress_args=["filterRNAstrand", "extendReads", "centerReads"])
+    other_args = ParserCommon.otherOptions()
+
+    parser = argparse.ArgumentParser(
+        parents=[io_args, bam_args, filter_args, read_args, get_args(), other_args],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+``scFragmentStore`` extracts the fragments of the BAM file(s) that pass the read filters, and writes
+them to a compressed, indexed fragment store (an HDF5 file). The BAM files are read only once: the store
+can then be given to ``scCountReads bins`` instead of the BAM files, to count the reads in bins of any
+size without reading the BAM files again.
+
+One fragment is stored per proper pair (spanning both mates, with the end of the first mate and the start
+of the second one) and per read otherwise, with its chromosome, start, end, cell barcode, strand, mapping
+quality and whether it is a duplicate. Duplicates (detected with --duplicateFilter, or marked in the BAM
+file) are kept in the store and can be removed when counting, with the same --duplicateFilter.
+
+``scCountReads bins`` counts the reads of the store as those of the BAM files without --extendReads: both
+mates of a proper pair are counted. The differences are that split reads are counted as if they were not
+split, and that the filters (given here) are applied to the first mate of a proper pair, and decide for
+both mates. Except for --minMappingQuality and --duplicateFilter, the read filters can not be given to
+``scCountReads`` when counting a store, they have to be given here.
+""",
+        usage="Example usage: scFragmentStore -b sample1.bam sample2.bam -bc barcodes.txt -o fragments.h5",
+        add_help=False,
+    )
+
+    return parser
+
+
+def get_args():
+    parser = argparse.ArgumentParser(add_help=False)
+    optional = parser.add_argument_group("Misc arguments")
+    optional.add_argument(
+        "--genomeChunkSize",
+        type=int,
+        default=None,
+        help="Manually specify the size of the genome provided to each processor. "
+        "The default value of None specifies that this is determined by read "
+        "density of the BAM file.",
+    )
+    optional.add_argument(
+        "--maxPairedFragmentLength",
+        type=int,
+        default=1000,
+        help="Longest fragment of a proper pair. The mates of longer fragments are stored as two fragments.",
+    )
+    return parser
+
+
+def main(args=None):
+    args, newlabels = ParserCommon.validateInputs(parseArguments().parse_args(args))
+    if not args.verbose:
+        logger.setLevel(logging.CRITICAL)
+        warnings.filterwarnings("ignore")
+
+    writer = FragmentStoreWriter(
+        args.bamfiles,
+        barcodes=args.barcodes,
+        cellTag=args.cellTag,
+        groupTag=args.groupTag,
+        groupLabels=newlabels,
+        motifFilter=args.motifFilter,
+        genome2bit=args.genome2bit,
+        GCcontentFilter=args.GCcontentFilter,
+        genomeChunkSize=args.genomeChunkSize,
+        numberOfProcessors=args.numberOfProcessors,
+        verbose=args.verbose,
+        region=args.region,
+        blackListFileName=args.blackListFileName,
+        minMappingQuality=args.minMappingQuality,
+        duplicateFilter=args.duplicateFilter,
+        samFlag_include=args.samFlagInclude,
+        samFlag_exclude=args.samFlagExclude,
+        minFragmentLength=args.minFragmentLength,
+        maxFragmentLength=args.maxFragmentLength,
+        minAlignedFraction=args.minAlignedFraction,
+        maxPairedFragmentLength=args.maxPairedFragmentLength,
+    )
+    writer.run(args.outFile)
+    return 0
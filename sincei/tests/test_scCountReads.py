@@ -1,7 +1,13 @@
 from sincei.scCountReads import *
 from sincei import ReadCounter as countR
 from sincei.Utilities import *
+from sincei import ChunkReport
+from sincei import FragmentStore
+from sincei import MapReduce, scBulkCoverage
 
+import json
+import pytest
+import scipy.io
 import pandas as pd
 import numpy as np
 import numpy.testing as nt
@@ -28,7 +34,7 @@ def getCountReadsArgs(T):
     return args, newlabels
 
 
-def getCountReadsOutput(arg, dedup):
+def getCountReadsOutput(arg, dedup, **kwargs):
     """
     Setup the CR object based on testdata (2x bams, 5 barcodes) and input args
     """
@@ -51,6 +57,7 @@ def getCountReadsOutput(arg, dedup):
         duplicateFilter=args.duplicateFilter,
         zerosToNans=False,
         out_file_for_raw_data=None,
+        **kwargs,
     )
     num_reads_per_bin, regionList = c.run(allArgs=args)
 
@@ -190,3 +197,292 @@ def testCountReads_gtf_dedup():
     # Test
     nt.assert_array_equal(valid_regions, observed_regions)
     nt.assert_array_equal(valid_counts, observed_counts)
+
+
+def testCountReads_sparse():
+    for T in ["bins", "bed", "gtf"]:
+        for dedup in [None, "start_bc_umi"]:
+            # Expected output
+            valid_counts, valid_regions = getExpectedOutput(T, dedup)
+            # Actual output
+            observed_counts, observed_regions = getCountReadsOutput(T, dedup, sparseOutput=True)
+            # Test
+            assert sparse.issparse(observed_counts)
+            nt.assert_array_equal(valid_regions, observed_regions)
+            nt.assert_array_equal(valid_counts, observed_counts.toarray())
+
+
+def testCountReads_shards():
+    for T in ["bins", "gtf"]:
+        # Expected output
+        valid_counts, valid_regions = getExpectedOutput(T, None)
+        # Actual output, written as shards by the workers
+        shardDir = tempfile.mkdtemp()
+        shardFiles, _ = getCountReadsOutput(T, None, sparseOutput=True, shardDir=shardDir)
+        observed_counts, observed_regions = WriteCounts.mergeShards(shardFiles)
+        shutil.rmtree(shardDir)
+        # Test
+        nt.assert_array_equal(valid_regions, observed_regions)
+        nt.assert_array_equal(valid_counts, observed_counts.toarray())
+
+
+def testCountReads_countDtype():
+    for sparseOutput in [False, True]:
+        # Expected output
+        valid_counts, valid_regions = getExpectedOutput("bed", None)
+        # Actual output, as uint8 (all counts are < 256)
+        observed_counts, observed_regions = getCountReadsOutput(
+            "bed", None, sparseOutput=sparseOutput, countDtype="uint8"
+        )
+        # Test
+        assert observed_counts.dtype == np.uint8
+        nt.assert_array_equal(valid_regions, observed_regions)
+        nt.assert_array_equal(valid_counts, sparse.csr_matrix(observed_counts).toarray())
+
+
+def testCountReads_countFragmentsOnce():
+    args, newlabels = getCountReadsArgs("bins")
+    counts = []
+    for countFragmentsOnce in [False, True]:
+        c = countR.CountReadsPerBin(
+            args.bamfiles,
+            binLength=args.binSize,
+            stepSize=args.binSize,
+            barcodes=args.barcodes,
+            cellTag=args.cellTag,
+            groupLabels=newlabels,
+            region=args.region,
+            sparseOutput=True,
+        )
+        # extend the reads to the fragments, without estimating the fragment length from the BAM files
+        c.defaultFragmentLength = 300
+        c.maxPairedFragmentLength = 1200
+        c.countFragmentsOnce = countFragmentsOnce
+        observed_counts, observed_regions = c.run(allArgs=args)
+        counts.append(observed_counts.toarray())
+    # Test, only processing the left-most mates gives the same counts
+    assert counts[0].sum() > 0
+    nt.assert_array_equal(counts[0], counts[1])
+    # Test, the filters that can reject one mate only are not allowed
+    for filters in [dict(duplicateFilter="start_bc"), dict(samFlag_include=128), dict(samFlag_exclude=64)]:
+        with pytest.raises(ValueError):
+            countR.CountReadsPerBin(args.bamfiles, extendReads=300, countFragmentsOnce=True, **filters)
+    countR.CountReadsPerBin(args.bamfiles, extendReads=300, countFragmentsOnce=True, samFlag_exclude=1024)
+
+
+def testCountReads_chunkReport():
+    reportDir = tempfile.mkdtemp()
+    getCountReadsOutput("bins", "start_bc_umi", chunkReportDir=reportDir)
+    records = ChunkReport.readChunkStats(reportDir)
+    ChunkReport.writeReport(reportDir, reportDir + "/report.json")
+    with open(reportDir + "/report.json") as f:
+        summary = json.load(f)["summary"]
+    shutil.rmtree(reportDir)
+    # Test, one record per chunk, with the reads fetched and rejected per filter
+    assert len(records) == summary["chunks"] > 0
+    assert records[0]["chrom"] == "chr1"
+    assert summary["readsFetched"] > summary["rejected"]["duplicate"] > 0
+
+
+def testCountReads_fragmentStore():
+    args, newlabels = getCountReadsArgs("bins")
+    tmpDir = tempfile.mkdtemp()
+    storeFile = os.path.join(tmpDir, "fragments.h5")
+    FragmentStore.FragmentStoreWriter(
+        args.bamfiles,
+        barcodes=args.barcodes,
+        cellTag=args.cellTag,
+        groupLabels=newlabels,
+        region=args.region,
+        samFlag_include=2,
+        duplicateFilter="start_bc_umi",
+    ).run(storeFile)
+    # the blacklist splits the region in two chunks
+    blackListFile = os.path.join(tmpDir, "blacklist.bed")
+    with open(blackListFile, "w") as f:
+        f.write("chr1\t23370000\t23375000\n")
+    c = countR.CountReadsPerBin(
+        args.bamfiles,
+        binLength=args.binSize,
+        stepSize=args.binSize,
+        barcodes=args.barcodes,
+        cellTag=args.cellTag,
+        groupLabels=newlabels,
+        region=args.region,
+        blackListFileName=blackListFile,
+        samFlag_include=2,
+        sparseOutput=True,
+    )
+    valid_counts, valid_regions = c.run(allArgs=args)
+    # Actual output, the store counted by two processes
+    storeArgs = "bins -b {} -bc {}test_barcodes.txt -o {}/counts --region {} -bl {} --outFileFormat mtx".format(
+        storeFile, ROOT, tmpDir, args.region, blackListFile
+    ).split()
+    main(storeArgs + ["-p", "2"])
+    observed_counts = scipy.io.mmread(tmpDir + "/counts.counts.mtx").toarray()
+    observed_regions = [x.strip() for x in open(tmpDir + "/counts.rownames.txt")]
+    with FragmentStore.FragmentStore(storeFile) as store:
+        counts, _ = store.count_bins("chr1", 23360000, 23385000, args.binSize)
+        dedup_counts, _ = store.count_bins("chr1", 23360000, 23385000, args.binSize, removeDuplicates=True)
+        assert store.labels == newlabels
+    # the options that need the reads are rejected
+    with pytest.raises(SystemExit, match="--samFlagExclude, --extendReads"):
+        main(storeArgs + ["--samFlagExclude", "16", "--extendReads", "300"])
+    shutil.rmtree(tmpDir)
+    # Test, the reads are counted as from the BAM files (both mates of the proper pairs)
+    assert valid_counts.sum() > 0
+    nt.assert_array_equal(valid_regions.index, observed_regions)
+    nt.assert_array_equal(valid_counts.toarray(), observed_counts)
+    assert 0 < dedup_counts.sum() < counts.sum()
+
+
+def testCountReads_additionalBinSizes():
+    args, newlabels = getCountReadsArgs("bins")
+
+    def count(binSize, **kwargs):
+        c = countR.CountReadsPerBin(
+            args.bamfiles,
+            binLength=binSize,
+            stepSize=binSize,
+            barcodes=args.barcodes,
+            cellTag=args.cellTag,
+            groupLabels=newlabels,
+            region="chr1:23360000:23400000",
+            duplicateFilter="start_bc_umi",
+            sparseOutput=True,
+            **kwargs,
+        )
+        return c.run(allArgs=args)
+
+    # Actual output, counted in a single pass
+    observed_counts, observed_regions = count(5000, additionalBinSizes=[10000, 20000])
+    # Test, same as separate runs for each bin size
+    assert sorted(observed_counts) == [5000, 10000, 20000]
+    for binSize in [5000, 10000, 20000]:
+        valid_counts, valid_regions = count(binSize)
+        assert valid_counts.sum() > 0
+        nt.assert_array_equal(valid_regions.index, observed_regions[binSize].index)
+        nt.assert_array_equal(valid_counts.toarray(), observed_counts[binSize].toarray())
+
+
+def testCountReads_slidingWindows():
+    args, newlabels = getCountReadsArgs("bins")
+
+    def count(stepSize, **kwargs):
+        c = countR.CountReadsPerBin(
+            args.bamfiles,
+            binLength=1000,
+            stepSize=stepSize,
+            barcodes=args.barcodes,
+            cellTag=args.cellTag,
+            groupLabels=newlabels,
+            region=args.region,
+            **kwargs,
+        )
+        return c.run(allArgs=args)
+
+    # Expected output, every other bin
+    valid_counts, valid_regions = count(1000, sparseOutput=True)
+    # Actual output, windows with a gap between them (sparse and dense)
+    observed_counts, observed_regions = count(2000, sparseOutput=True)
+    dense_counts, dense_regions = count(2000)
+    # Test
+    assert valid_counts.sum() > 0
+    nt.assert_array_equal(valid_regions.index[::2], observed_regions.index)
+    nt.assert_array_equal(valid_counts.toarray()[::2], observed_counts.toarray())
+    nt.assert_array_equal(dense_regions.index, observed_regions.index)
+    nt.assert_array_equal(dense_counts, observed_counts.toarray())
+
+
+def testCountReads_featureMergeDistance():
+    for T in ["bed", "gtf"]:
+        for dedup in [None, "start_bc_umi"]:
+            # Expected output
+            valid_counts, valid_regions = getExpectedOutput(T, dedup)
+            # Actual output, with the reads of nearby features fetched together
+            observed_counts, observed_regions = getCountReadsOutput(
+                T, dedup, sparseOutput=True, featureMergeDistance=1000
+            )
+            # Test
+            nt.assert_array_equal(valid_regions, observed_regions)
+            nt.assert_array_equal(valid_counts, observed_counts.toarray())
+
+
+def testCountReads_checkpoint():
+    # Expected output
+    valid_counts, valid_regions = getExpectedOutput("bins", None)
+    checkpointDir = os.path.join(tempfile.mkdtemp(), "checkpoint")
+    shardFiles, _ = getCountReadsOutput("bins", None, sparseOutput=True, checkpointDir=checkpointDir)
+    # Interrupted run: the manifest only has an incomplete line, the chunk is counted again
+    manifest = os.path.join(checkpointDir, Checkpoint.MANIFEST)
+    with open(manifest, "w") as f:
+        f.write('{"chrom": "chr1"')
+    shardFiles, _ = getCountReadsOutput("bins", None, sparseOutput=True, checkpointDir=checkpointDir, resume=True)
+    assert len(Checkpoint.readManifest(checkpointDir)) == 1
+    # Actual output, the resumed run re-uses the completed chunk
+    mtime = os.path.getmtime(shardFiles[0])
+    resumedFiles, _ = getCountReadsOutput("bins", None, sparseOutput=True, checkpointDir=checkpointDir, resume=True)
+    assert resumedFiles == shardFiles and os.path.getmtime(resumedFiles[0]) == mtime
+    observed_counts, observed_regions = WriteCounts.mergeShards(resumedFiles)
+    Checkpoint.removeCheckpoint(checkpointDir)
+    # Test
+    nt.assert_array_equal(valid_regions, observed_regions)
+    nt.assert_array_equal(valid_counts, observed_counts.toarray())
+
+
+def testCountReads_workerPool():
+    args, newlabels = getCountReadsArgs("bins")
+
+    def count(numberOfProcessors):
+        # several chunks, so that a worker pool is used with more than one processor
+        c = countR.CountReadsPerBin(
+            args.bamfiles,
+            binLength=10000,
+            stepSize=10000,
+            barcodes=args.barcodes,
+            cellTag=args.cellTag,
+            groupLabels=newlabels,
+            region="chr1",
+            genomeChunkSize=20000000,
+            numberOfProcessors=numberOfProcessors,
+            sparseOutput=True,
+        )
+        counts, regions = c.run(allArgs=args)
+        assert c.tablesFile is None
+        return counts, regions
+
+    # Expected output
+    valid_counts, valid_regions = count(1)
+    # Actual output, the workers read the barcode tables from the file written by the main process
+    observed_counts, observed_regions = count(2)
+    # Test
+    assert valid_counts.sum() > 0
+    nt.assert_array_equal(valid_regions.index, observed_regions.index)
+    nt.assert_array_equal(valid_counts.toarray(), observed_counts.toarray())
+
+
+def testBulkCoverage_chunkSplitting(monkeypatch):
+    tmpDir = tempfile.mkdtemp()
+    groupInfo = os.path.join(tmpDir, "groups.tsv")
+    barcodes = [x.strip() for x in open(ROOT + "test_barcodes.txt")]
+    with open(groupInfo, "w") as f:
+        f.write("sample\tbarcode\tcluster\n")
+        for i, (sample, bc) in enumerate((s, b) for s in ["SL2-1", "SL2-2"] for b in barcodes):
+            f.write("{}\t{}\tg{}\n".format(sample, bc, i % 2))
+
+    def bulkCoverage(prefix):
+        scBulkCoverage.main(
+            "-b {0}SL2-1.bam {0}SL2-2.bam --smartLabels -i {1} -o {2} --region chr1 -p 3 -bs 50 "
+            "--outFileFormat bedgraph --normalizeUsing CPM".format(ROOT, groupInfo, prefix).split()
+        )
+        return [open("{}_{}.bedgraph".format(prefix, g)).read() for g in ["g0", "g1"]]
+
+    # Actual output, the tasks are ordered by the read density of the BAM index
+    observed = bulkCoverage(os.path.join(tmpDir, "density"))
+    # Expected output, without the read density (the chunks can not be split)
+    monkeypatch.setattr(MapReduce, "getIndexDensity", lambda bamFiles: None)
+    valid = bulkCoverage(os.path.join(tmpDir, "chunks"))
+    shutil.rmtree(tmpDir)
+    # Test, the CPM normalized coverage is not changed by the cut points of split chunks
+    assert len(valid[0]) > 0
+    assert observed == valid